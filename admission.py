@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+from const_vars import (JOBS_COLLECTION, METRICS_COLLECTION, READINESS_COLLECTION, READINESS_STALE_AFTER,
+                        ADMISSION_SLO_SECONDS, ADMISSION_WINDOW, ADMISSION_REFRESH_INTERVAL)
+from pipeline_metrics import METRICS
+
+# Per item latencies of the last @window finished pipelines (see InitialPipeline.save_metrics),
+# the items waiting in the job queue and the workers of the live ready pipeline processes.
+ADMISSION_STATS_QUERY = '''
+LET recent = (
+    FOR report IN @@metrics
+        FILTER report.finished_at != null
+        SORT report.finished_at DESC
+        LIMIT @window
+        RETURN report
+)
+LET stages = (
+    FOR report IN recent
+        FOR summary IN report.metrics.pipeline_stage_seconds || []
+            COLLECT stage = summary.labels.stage
+            AGGREGATE seconds = SUM(summary.sum / (report.num_items || 1)), count = SUM(summary.count)
+            RETURN { stage: stage, mean: seconds / count }
+)
+LET item_seconds = (
+    FOR report IN recent
+        FOR summary IN report.metrics.pipeline_job_seconds || []
+            RETURN summary.sum / summary.count / (report.num_items || 1)
+)
+LET queued_items = SUM(
+    FOR job IN @@jobs
+        FILTER job.status IN ["queued", "leased"]
+        RETURN LENGTH(job.payload.urls) || 1
+)
+LET ready_workers = SUM(
+    FOR process IN @@readiness
+        FILTER process.ready AND process.updated_at > DATE_NOW() - @stale_ms
+        RETURN process.workers || 1
+)
+RETURN { stages: stages, item_seconds: item_seconds, queued_items: queued_items, ready_workers: ready_workers }
+'''
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+class AdmissionController:
+    """
+    Estimates when a new submission would finish and rejects it if that breaks the latency SLO.
+    Every worker runs the stages as a pipeline, so the queue drains at one item per bottleneck stage
+    latency per ready worker, and the new items then take the p90 latency of recent items.
+    The statistics are refreshed at most every refresh_interval seconds, the items admitted in between
+    are added to the queue so a burst of submissions sees itself.
+    slo of 0 admits everything but still returns the estimate.
+    """
+    def __init__(self, db, slo=ADMISSION_SLO_SECONDS, window=ADMISSION_WINDOW, refresh_interval=ADMISSION_REFRESH_INTERVAL):
+        self.db = db
+        self.slo = slo
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.stats = None
+        self.refreshed_at = 0
+        self.admitted_items = 0
+
+    def refresh(self):
+        with METRICS.db_roundtrip('admission_stats'):
+            self.stats = list(self.db.aql.execute(ADMISSION_STATS_QUERY, bind_vars={
+                '@metrics': METRICS_COLLECTION, '@jobs': JOBS_COLLECTION, '@readiness': READINESS_COLLECTION,
+                'window': self.window, 'stale_ms': int(READINESS_STALE_AFTER * 1000)}))[0]
+        self.refreshed_at = time.time()
+        self.admitted_items = 0
+
+    def estimate(self, num_items=1):
+        """
+        Returns the estimated seconds until a submission of num_items finishes, None without enough history.
+        """
+        if time.time() - self.refreshed_at > self.refresh_interval:
+            self.refresh()
+        stats = self.stats
+        estimate = {'estimated_seconds': None, 'queued_items': stats['queued_items'] + self.admitted_items,
+                    'ready_workers': stats['ready_workers'], 'bottleneck_stage': None}
+        item_seconds = percentile(stats['item_seconds'], 0.9)
+        if not stats['stages'] or item_seconds is None or not stats['ready_workers']:
+            return estimate
+        bottleneck = max(stats['stages'], key=lambda stage: stage['mean'])
+        estimate['bottleneck_stage'] = bottleneck['stage']
+        wait_seconds = (estimate['queued_items'] + num_items - 1) * bottleneck['mean'] / stats['ready_workers']
+        estimate['estimated_seconds'] = round(wait_seconds + item_seconds, 1)
+        return estimate
+
+    def admit(self, num_items=1):
+        """
+        Returns (admitted, estimate). An admitted submission counts as queued until the next refresh.
+        """
+        with self.lock:
+            try:
+                estimate = self.estimate(num_items)
+            except Exception as e:
+                # Submissions are never refused because the statistics couldn't be read.
+                print("Couldn't estimate the completion time: {}".format(e))
+                return True, {'estimated_seconds': None}
+            admitted = not self.slo or estimate['estimated_seconds'] is None or estimate['estimated_seconds'] <= self.slo
+            if admitted:
+                self.admitted_items += num_items
+        METRICS.inc('admission_decisions_total', result='admitted' if admitted else 'rejected')
+        if estimate['estimated_seconds'] is not None:
+            METRICS.set_gauge('admission_estimated_seconds', estimate['estimated_seconds'])
+        return admitted, estimate
+
+    def retry_after(self, estimate):
+        """
+        Seconds until the queue should have drained below the SLO, for the Retry-After header.
+        """
+        return max(1, int(math.ceil(estimate['estimated_seconds'] - self.slo)))
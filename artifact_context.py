@@ -0,0 +1,105 @@
+import queue
+import threading
+from pipeline_metrics import METRICS
+
+WRITE_BEHIND_QUEUE_SIZE = 1000
+
+class WriteBehindWriter(threading.Thread):
+    """
+    Runs database writes on a background thread, so the stages don't wait for them.
+    """
+    def __init__(self, maxsize=WRITE_BEHIND_QUEUE_SIZE):
+        super().__init__(daemon=True, name="write-behind")
+        self.writes = queue.Queue(maxsize=maxsize)
+
+    def submit(self, write_fn, args, kwargs, on_finished, pipeline_id=None):
+        self.writes.put((write_fn, args, kwargs, on_finished, pipeline_id))
+
+    def run(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            write_fn, args, kwargs, on_finished, pipeline_id = item
+            error = None
+            try:
+                # The round-trips are counted for the pipeline the write belongs to.
+                with METRICS.pipeline_scope(pipeline_id):
+                    write_fn(*args, **kwargs)
+            except Exception as e:
+                print("Error!!! write-behind failed: {}".format(e))
+                error = e
+            on_finished(error)
+
+    def stop(self):
+        self.writes.put(None)
+        self.join()
+
+
+class ArtifactContext:
+    """
+    Per-job outputs of the stages that run in the same process, so the next stage reads them
+    from memory instead of reading back what the previous stage just wrote to Arango.
+    Documents are keyed by (movie_id, frame_num) like in the database.
+    """
+    def __init__(self, pipeline_id, writer=None):
+        self.pipeline_id = pipeline_id
+        self.writer = writer
+        self.visual_clues = {}
+        self.reid = {}
+        self.fusion = {}
+        self.source_image = None
+        self.source_image_ready = threading.Event()
+        self.pending_writes = 0
+        self.write_errors = []
+        self.condition = threading.Condition()
+
+    def add_visual_clues(self, doc):
+        self.visual_clues[(doc['movie_id'], int(doc['frame_num']))] = doc
+
+    def get_visual_clues(self, movie_id, frame_num):
+        return self.visual_clues.get((movie_id, int(frame_num)))
+
+    def add_fusion(self, doc):
+        self.fusion[(doc['movie_id'], int(doc['frame_num']))] = doc
+
+    def set_source_image(self, data):
+        self.source_image = data
+        self.source_image_ready.set()
+
+    def get_source_image(self, timeout=None):
+        """
+        Returns the bytes of an image input as they were downloaded at submission,
+        None for movies or if the download failed.
+        """
+        if not self.source_image_ready.wait(timeout):
+            return None
+        return self.source_image
+
+    def persist(self, write_fn, *args, **kwargs):
+        """
+        Writes through the write-behind thread, or synchronously if there is none.
+        """
+        if not self.writer:
+            return write_fn(*args, **kwargs)
+        with self.condition:
+            self.pending_writes += 1
+        self.writer.submit(write_fn, args, kwargs, self._write_finished, self.pipeline_id)
+
+    def _write_finished(self, error):
+        with self.condition:
+            self.pending_writes -= 1
+            if error is not None:
+                self.write_errors.append(error)
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all the writes of this job reached the database, raises if any of them failed.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending_writes == 0, timeout=timeout):
+                raise TimeoutError("{} writes of pipeline id {} are still pending".format(self.pending_writes, self.pipeline_id))
+        if self.write_errors:
+            raise RuntimeError("{} writes of pipeline id {} failed, first error: {}".format(
+                                len(self.write_errors), self.pipeline_id, self.write_errors[0]))
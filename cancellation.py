@@ -0,0 +1,118 @@
+import threading
+import time
+from contextlib import contextmanager
+
+CHECK_INTERVAL = 0.5    # how often a cancellable sleep wakes up to check its token
+
+class JobCancelled(Exception):
+    """
+    Raised inside a stage when its job was cancelled or ran out of time.
+    timed_out tells a missed deadline apart from a cancel request.
+    """
+    def __init__(self, reason, timed_out=False):
+        super().__init__(reason)
+        self.timed_out = timed_out
+
+
+class CancelToken:
+    """
+    Cooperative cancellation with an optional deadline.
+    A stage token has the job token as parent, so cancelling the job cancels all of its stages.
+    """
+    def __init__(self, parent=None, timeout=None, name=''):
+        self.parent = parent
+        self.name = name
+        self.deadline = time.time() + timeout if timeout else None
+        self.event = threading.Event()
+        self.reason = None
+        self.cause = None
+
+    def cancel(self, reason="cancelled", cause=None):
+        """
+        cause is the (stage name, error) that made a stage cancel its job, None for a cancel request.
+        """
+        if not self.event.is_set():
+            self.reason = reason
+            self.cause = cause
+            self.event.set()
+
+    def error(self):
+        """
+        Returns the JobCancelled this token would raise, None if it's still running.
+        """
+        if self.event.is_set():
+            return JobCancelled(self.reason)
+        if self.deadline is not None and time.time() > self.deadline:
+            return JobCancelled("{} exceeded its deadline".format(self.name or "job"), timed_out=True)
+        if self.parent is not None:
+            return self.parent.error()
+        return None
+
+    def is_cancelled(self):
+        return self.error() is not None
+
+    def check(self):
+        error = self.error()
+        if error is not None:
+            raise error
+
+    def remaining(self):
+        """
+        Seconds until the nearest deadline of this token or its parents, None if there is none.
+        """
+        remaining = self.deadline - time.time() if self.deadline is not None else None
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if remaining is None or (parent_remaining is not None and parent_remaining < remaining):
+                remaining = parent_remaining
+        return None if remaining is None else max(0.0, remaining)
+
+    def wait(self, timeout):
+        """
+        Sleeps up to timeout seconds, raises as soon as the token is cancelled or its deadline passed.
+        """
+        end_time = time.time() + timeout
+        while True:
+            self.check()
+            left = end_time - time.time()
+            if left <= 0:
+                return
+            time.sleep(min(left, CHECK_INTERVAL))
+
+
+_local = threading.local()
+
+@contextmanager
+def cancel_scope(token):
+    """
+    Makes token the current token of this thread, so code deep inside a stage can check it.
+    """
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+def current_token():
+    return getattr(_local, 'token', None)
+
+def check_cancelled():
+    """
+    Raises JobCancelled if the job running on this thread was cancelled, does nothing outside a job.
+    """
+    token = current_token()
+    if token is not None:
+        token.check()
+
+def remaining_time(default=None):
+    token = current_token()
+    remaining = token.remaining() if token is not None else None
+    return default if remaining is None else remaining
+
+def cancellable_sleep(seconds):
+    token = current_token()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.wait(seconds)
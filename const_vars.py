@@ -1,3 +1,6 @@
+import os
+import json
+
 WF_TEMPLATE = {
     "movies": {},
     "tasks": {},
@@ -10,4 +13,79 @@ WF_TEMPLATE = {
             "save_movies": 'true'
         }
     }
-}
\ No newline at end of file
+}
+
+# Job queue, replaces the single "pipeline_url" document.
+JOBS_COLLECTION = "pipeline_jobs"
+LEGACY_PIPELINE_URL_KEY = "123456789"
+JOB_LEASE_TIMEOUT = 120         # seconds a claimed job stays invisible to other workers
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_MIN_INTERVAL = 0.05    # idle workers back off between these two intervals
+JOB_POLL_MAX_INTERVAL = 0.5
+JOB_CANCEL_CHECK_INTERVAL = 5   # seconds between two checks for a cancel request of a running job
+STAGE_QUEUE_SIZE = int(os.environ.get('STAGE_QUEUE_SIZE', 2))   # jobs waiting in front of each stage
+
+# Worker pool mode: forks this many worker processes after loading the models (CPU only).
+PIPELINE_WORKER_PROCESSES = int(os.environ.get('PIPELINE_WORKER_PROCESSES', 1))
+WORKER_MAX_IN_FLIGHT = int(os.environ.get('WORKER_MAX_IN_FLIGHT', STAGE_QUEUE_SIZE + 1))
+
+# Prometheus text on GET /metrics, JSON of one pipeline on GET /metrics/<pipeline_id>.
+# Pool workers serve their own registry on METRICS_PORT + 1 + worker index.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+METRICS_COLLECTION = "s4_pipeline_metrics"
+
+# Image inputs are downloaded once at submission and handed to the stages in memory.
+SOURCE_IMAGE_FETCH_TIMEOUT = 30
+SOURCE_IMAGE_FETCH_THREADS = 2
+SOURCE_IMAGE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36'}
+
+# Results of image inputs are reused when the same bytes are submitted again.
+# The key includes the model checkpoints, bump RESULT_CACHE_VERSION for any other change that alters the results.
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1') == '1'
+RESULT_CACHE_VERSION = os.environ.get('RESULT_CACHE_VERSION', '1')
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 10000))
+RESULT_CACHE_COLLECTION = "s4_result_cache"
+
+# Deadlines in seconds, a job or stage that runs longer is cancelled and its job fails without a retry.
+# STAGE_TIMEOUTS can be overridden with a JSON object, e.g. STAGE_TIMEOUTS='{"llm": 300}'.
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 1800))
+STAGE_TIMEOUTS = {
+    "videoprocessing": 600,
+    "reid": 600,
+    "visual_clues": 600,
+    "fusion": 300,
+    "llm": 900,
+    **json.loads(os.environ.get('STAGE_TIMEOUTS', '{}'))
+}
+
+# Every pipeline process publishes whether its models are loaded and warmed up, see readiness.py.
+READINESS_COLLECTION = "pipeline_readiness"
+READINESS_REFRESH_INTERVAL = 10
+READINESS_STALE_AFTER = 30
+
+# Connections of server_con_async to the database, and the threads that run its blocking driver calls.
+SERVER_DB_POOL_SIZE = int(os.environ.get('SERVER_DB_POOL_SIZE', 32))
+
+# The servers keep the results of polled pipelines in memory, see PipelineResultCache in server_common.py.
+# Results of a finished pipeline don't change, the ones read while it's still running expire quickly.
+SERVER_CACHE_MAX_ENTRIES = int(os.environ.get('SERVER_CACHE_MAX_ENTRIES', 1024))
+SERVER_CACHE_TTL = int(os.environ.get('SERVER_CACHE_TTL', 3600))
+SERVER_CACHE_PENDING_TTL = float(os.environ.get('SERVER_CACHE_PENDING_TTL', 2))
+TRIPLET_GRAPH_CACHE_SIZE = 256
+
+# server_con_async reads the status of the pipelines that have /status_stream subscribers every STATUS_PUSH_INTERVAL
+# seconds, and sends a keep-alive comment on a stream that was idle for STATUS_KEEPALIVE_INTERVAL seconds.
+STATUS_PUSH_INTERVAL = float(os.environ.get('STATUS_PUSH_INTERVAL', 0.5))
+STATUS_KEEPALIVE_INTERVAL = 15
+
+# The servers proxy the images of the storage node through a disk cache, see image_cache.py.
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '/tmp/fast_demo_image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+IMAGE_CACHE_MAX_AGE = 86400
+THUMBNAIL_SIZE = 320
+
+# The servers estimate when a submission would finish from the latencies of the last ADMISSION_WINDOW pipelines
+# and the queued jobs, and answer 429 when that's above ADMISSION_SLO_SECONDS (0 admits everything).
+ADMISSION_SLO_SECONDS = float(os.environ.get('ADMISSION_SLO_SECONDS', 0))
+ADMISSION_WINDOW = 50
+ADMISSION_REFRESH_INTERVAL = 5
@@ -0,0 +1,69 @@
+import threading
+from pipeline_metrics import METRICS
+
+# Collections (and their key indexes) this process already made sure exist, by database name.
+_ensured = set()
+_ensured_lock = threading.Lock()
+_upsert_queries = {}
+
+def ensure_collection(db, collection_name, key_list=()):
+    """
+    Creates the collection and a persistent index on key_list once per process, so an upsert never scans.
+    """
+    key = (db.name, collection_name, tuple(key_list))
+    if key in _ensured:
+        return
+    with _ensured_lock:
+        if key in _ensured:
+            return
+        if not db.has_collection(collection_name):
+            db.create_collection(collection_name)
+        if key_list:
+            db.collection(collection_name).add_persistent_index(fields=list(key_list))
+        _ensured.add(key)
+
+def upsert_query(key_list, overwrite=True):
+    """
+    UPSERT of every document in @docs, matched on key_list. An existing document gets the top-level fields of
+    the new one if overwrite is set, and is left as it is otherwise.
+    """
+    query_key = (tuple(key_list), overwrite)
+    query = _upsert_queries.get(query_key)
+    if query is None:
+        for field in key_list:
+            if not field.isidentifier():
+                raise ValueError("Invalid key field: {}".format(field))
+        if key_list:
+            search = ', '.join('{0}: doc.{0}'.format(field) for field in key_list)
+            update = 'doc' if overwrite else '{}'
+            query = '''
+FOR doc IN @docs
+    UPSERT { %s }
+    INSERT doc
+    UPDATE %s
+    IN @@collection OPTIONS { mergeObjects: false }
+    RETURN { _id: NEW._id, _key: NEW._key, _rev: NEW._rev, new: OLD == null }
+''' % (search, update)
+        else:
+            query = '''
+FOR doc IN @docs
+    INSERT doc INTO @@collection
+    RETURN { _id: NEW._id, _key: NEW._key, _rev: NEW._rev, new: true }
+'''
+        _upsert_queries[query_key] = query
+    return query
+
+def upsert_docs(db, docs, collection_name, key_list=(), overwrite=True):
+    """
+    Inserts or updates many documents, matched on key_list, in a single round-trip.
+    Returns the _id, _key, _rev of every document and whether it was new.
+    """
+    if not docs:
+        return []
+    ensure_collection(db, collection_name, key_list)
+    with METRICS.db_roundtrip('upsert'):
+        return list(db.aql.execute(upsert_query(key_list, overwrite),
+                                   bind_vars={'docs': list(docs), '@collection': collection_name}))
+
+def upsert_doc(db, doc, collection_name, key_list=(), overwrite=True):
+    return upsert_docs(db, [doc], collection_name, key_list, overwrite)[0]
@@ -0,0 +1,171 @@
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+import requests
+from PIL import Image
+
+from const_vars import (IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_MAX_AGE, THUMBNAIL_SIZE,
+                        SOURCE_IMAGE_FETCH_TIMEOUT, SOURCE_IMAGE_HEADERS)
+from pipeline_metrics import METRICS
+
+IMAGE_SIZES = ("full", "thumbnail")
+
+class ImageDiskCache:
+    """
+    Disk cache of the images the servers proxy from the storage node, bounded to max_bytes with LRU eviction.
+    An image is stored once under the hash of its content (blobs/), keys/ maps the hash of (url, size) to it.
+    The content hash doubles as the ETag.
+    """
+    def __init__(self, root=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES, thumbnail_size=THUMBNAIL_SIZE):
+        self.blob_dir = os.path.join(root, "blobs")
+        self.key_dir = os.path.join(root, "keys")
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
+        # Guards the index below and every rename or removal in blobs/ and keys/, never a download or a write.
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.session = requests.Session()
+        # Least recently used blob first, picked up from the files a previous run left behind.
+        self.blobs = OrderedDict()
+        for entry in os.scandir(self.blob_dir):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+        entries = [entry for entry in os.scandir(self.blob_dir) if entry.is_file()]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self.blobs[entry.name] = entry.stat().st_size
+        self.total_bytes = sum(self.blobs.values())
+        # The key files of every blob, removed together with it.
+        self.blob_keys = {}
+        for entry in os.scandir(self.key_dir):
+            with open(entry.path) as f:
+                content_hash = f.read().strip()
+            if content_hash in self.blobs:
+                self.blob_keys.setdefault(content_hash, set()).add(entry.path)
+            else:
+                os.remove(entry.path)
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash)
+
+    def key_path(self, url, size):
+        return os.path.join(self.key_dir, hashlib.sha256("{}|{}".format(url, size).encode()).hexdigest())
+
+    def _open_blob(self, content_hash):
+        """
+        Opens a blob while the lock is held, an eviction after that only unlinks the file under the open handle.
+        """
+        self.blobs.move_to_end(content_hash)
+        # Keeps the order of the blobs across restarts.
+        os.utime(self.blob_path(content_hash))
+        return open(self.blob_path(content_hash), "rb")
+
+    def _lookup(self, key_path):
+        try:
+            with open(key_path) as f:
+                content_hash = f.read().strip()
+        except FileNotFoundError:
+            return None, None
+        with self.lock:
+            if content_hash in self.blobs:
+                try:
+                    return self._open_blob(content_hash), content_hash
+                except FileNotFoundError:
+                    # Removed behind the cache's back.
+                    self._evict(content_hash)
+            elif os.path.isfile(key_path):
+                os.remove(key_path)
+        return None, None
+
+    def _evict(self, content_hash):
+        self.total_bytes -= self.blobs.pop(content_hash)
+        for key_path in self.blob_keys.pop(content_hash, ()):
+            try:
+                os.remove(key_path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(self.blob_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def _store(self, key_path, data):
+        content_hash = hashlib.sha256(data).hexdigest()
+        # The image is written outside the lock, so misses of different images don't wait on each other's disk I/O.
+        tmp_path = "{}.{}.tmp".format(self.blob_path(content_hash), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self.lock:
+            if content_hash in self.blobs:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, self.blob_path(content_hash))
+                self.blobs[content_hash] = len(data)
+                self.total_bytes += len(data)
+            with open(key_path, "w") as f:
+                f.write(content_hash)
+            self.blob_keys.setdefault(content_hash, set()).add(key_path)
+            blob = self._open_blob(content_hash)
+            while self.total_bytes > self.max_bytes and len(self.blobs) > 1:
+                self._evict(next(iter(self.blobs)))
+        return blob, content_hash
+
+    def _fetch(self, url, size):
+        with METRICS.timer('http_fetch_seconds', target='image_proxy'):
+            response = self.session.get(url, headers=SOURCE_IMAGE_HEADERS, timeout=SOURCE_IMAGE_FETCH_TIMEOUT)
+        response.raise_for_status()
+        if size == "full":
+            return response.content
+        image = Image.open(io.BytesIO(response.content)).convert('RGB')
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=85)
+        return output.getvalue()
+
+    def get(self, url, size="full"):
+        """
+        Returns an open binary file of the cached image and its ETag, downloads (and resizes) it on a miss.
+        The file stays readable if the image is evicted meanwhile, the caller closes it.
+        Concurrent misses of the same image download it once.
+        """
+        key_path = self.key_path(url, size)
+        blob, content_hash = self._lookup(key_path)
+        if blob is None:
+            with self.lock:
+                key_lock = self.key_locks.setdefault(key_path, threading.Lock())
+            with key_lock:
+                blob, content_hash = self._lookup(key_path)
+                if blob is None:
+                    METRICS.inc('image_cache_lookups_total', result='miss', size=size)
+                    blob, content_hash = self._store(key_path, self._fetch(url, size))
+                else:
+                    METRICS.inc('image_cache_lookups_total', result='hit', size=size)
+            with self.lock:
+                self.key_locks.pop(key_path, None)
+        else:
+            METRICS.inc('image_cache_lookups_total', result='hit', size=size)
+        return blob, content_hash
+
+
+def image_content_type(url, size):
+    if size == "thumbnail":
+        return "image/jpeg"
+    return mimetypes.guess_type(url)[0] or "application/octet-stream"
+
+def is_storage_url(url, prefix):
+    """
+    The proxy only fetches from the storage node, it's not an open proxy.
+    """
+    return isinstance(url, str) and url.startswith(prefix) and '..' not in url[len(prefix):]
+
+def cache_headers(etag, max_age=IMAGE_CACHE_MAX_AGE):
+    # The image behind a url never changes, so browsers may keep it without revalidating.
+    return {'Cache-Control': 'public, max-age={}, immutable'.format(max_age), 'ETag': '"{}"'.format(etag)}
+
+def etag_matches(if_none_match, etag):
+    return bool(if_none_match) and '"{}"'.format(etag) in [tag.strip() for tag in if_none_match.split(',')]
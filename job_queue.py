@@ -0,0 +1,228 @@
+import time
+import uuid
+import threading
+from arango.exceptions import AQLQueryExecuteError
+from const_vars import JOBS_COLLECTION, JOB_LEASE_TIMEOUT, JOB_MAX_ATTEMPTS, \
+                        JOB_POLL_MIN_INTERVAL, JOB_POLL_MAX_INTERVAL, JOB_CANCEL_CHECK_INTERVAL
+from pipeline_metrics import METRICS
+
+# ArangoDB "write-write conflict", raised when two workers race on the same job.
+ARANGO_CONFLICT = 1200
+
+ENQUEUE_QUERY = '''
+INSERT {
+    _key: @pipeline_id,
+    pipeline_id: @pipeline_id,
+    url_link: @url_link,
+    payload: @payload,
+    status: "queued",
+    current_task: "",
+    fetching: true,
+    attempts: 0,
+    enqueued_at: DATE_NOW()
+} INTO @@jobs OPTIONS { overwriteMode: "replace" }
+RETURN NEW
+'''
+
+# The _rev in the update key makes the claim a compare-and-swap, only one worker wins a job.
+CLAIM_QUERY = '''
+FOR job IN @@jobs
+    FILTER job.status == "queued" OR (job.status == "leased" AND job.lease_expires < DATE_NOW())
+    FILTER job.attempts < @max_attempts AND job.cancel_requested != true
+    SORT job.enqueued_at ASC
+    LIMIT 1
+    UPDATE { _key: job._key, _rev: job._rev } WITH {
+        status: "leased",
+        worker_id: @worker_id,
+        attempts: job.attempts + 1,
+        fetching: true,
+        claimed_at: DATE_NOW(),
+        lease_expires: DATE_NOW() + @lease_ms
+    } IN @@jobs OPTIONS { ignoreRevs: false }
+    RETURN NEW
+'''
+
+EXTEND_LEASE_QUERY = '''
+FOR job IN @@jobs
+    FILTER job._key == @key AND job.status == "leased" AND job.worker_id == @worker_id
+    UPDATE job WITH { lease_expires: DATE_NOW() + @lease_ms } IN @@jobs
+    RETURN { _key: NEW._key, cancel_requested: NEW.cancel_requested == true }
+'''
+
+# A queued job is cancelled right away, a leased one is flagged for the worker that runs it.
+CANCEL_QUERY = '''
+FOR job IN @@jobs
+    FILTER job._key == @key AND (job.status == "queued" OR job.status == "leased")
+    UPDATE job WITH {
+        status: job.status == "queued" ? "cancelled" : job.status,
+        fetching: job.status == "queued" ? false : job.fetching,
+        cancel_requested: true
+    } IN @@jobs
+    RETURN NEW.status
+'''
+
+REAP_QUERY = '''
+FOR job IN @@jobs
+    FILTER job.status == "leased" AND job.lease_expires < DATE_NOW()
+    FILTER job.attempts >= @max_attempts OR job.cancel_requested == true
+    UPDATE job WITH {
+        status: job.cancel_requested == true ? "cancelled" : "failed",
+        fetching: false,
+        error: job.cancel_requested == true ? "cancelled" : "lease expired too many times"
+    } IN @@jobs
+    RETURN NEW._key
+'''
+
+class JobQueue:
+    """
+    FIFO job queue on top of an Arango collection.
+    A claimed job is leased to one worker, if the worker doesn't renew the lease
+    in time the job becomes visible again and another worker picks it up.
+    """
+    def __init__(self, db, collection_name=JOBS_COLLECTION, lease_timeout=JOB_LEASE_TIMEOUT,
+                    max_attempts=JOB_MAX_ATTEMPTS):
+        self.db = db
+        self.collection_name = collection_name
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        if not self.db.has_collection(self.collection_name):
+            self.db.create_collection(self.collection_name)
+        self.collection = self.db.collection(self.collection_name)
+        self.collection.add_persistent_index(fields=['status', 'enqueued_at'])
+
+    @METRICS.db_call('job_queue')
+    def _execute(self, query, **bind_vars):
+        bind_vars['@jobs'] = self.collection_name
+        return list(self.db.aql.execute(query, bind_vars=bind_vars))
+
+    def enqueue(self, url_link, pipeline_id='', payload=None):
+        """
+        Adds a new job to the tail of the queue and returns its pipeline_id.
+        """
+        if not pipeline_id:
+            pipeline_id = str(uuid.uuid4())
+        self._execute(ENQUEUE_QUERY, pipeline_id=pipeline_id, url_link=url_link, payload=payload or {})
+        print("Enqueued pipeline id: {}, url: {}".format(pipeline_id, url_link))
+        return pipeline_id
+
+    def enqueue_dataset(self, url_links, pipeline_id=''):
+        """
+        Adds a single job that processes all of url_links in one pipeline, so the models batch across them.
+        """
+        return self.enqueue(url_links[0], pipeline_id, payload={'urls': list(url_links)})
+
+    def try_claim(self, worker_id):
+        """
+        Atomically leases the oldest visible job, returns None if the queue is empty.
+        """
+        try:
+            jobs = self._execute(CLAIM_QUERY, worker_id=worker_id, max_attempts=self.max_attempts,
+                                    lease_ms=int(self.lease_timeout * 1000))
+        except AQLQueryExecuteError as e:
+            if e.error_code == ARANGO_CONFLICT:
+                # Another worker claimed the same job first.
+                return None
+            raise
+        return jobs[0] if jobs else None
+
+    def claim(self, worker_id, stop_event=None):
+        """
+        Blocks until a job is claimed or stop_event is set.
+        """
+        interval = JOB_POLL_MIN_INTERVAL
+        while not (stop_event and stop_event.is_set()):
+            job = self.try_claim(worker_id)
+            if job:
+                return job
+            time.sleep(interval)
+            interval = min(interval * 2, JOB_POLL_MAX_INTERVAL)
+        return None
+
+    def extend_lease(self, job):
+        """
+        Returns {_key, cancel_requested} of the job, None if this worker doesn't hold its lease anymore.
+        """
+        rc = self._execute(EXTEND_LEASE_QUERY, key=job['_key'], worker_id=job['worker_id'],
+                            lease_ms=int(self.lease_timeout * 1000))
+        return rc[0] if rc else None
+
+    def complete(self, job):
+        self.collection.update({'_key': job['_key'], 'status': 'done', 'fetching': False,
+                                'current_task': 'done', 'finished_at': int(time.time() * 1000)})
+
+    def release(self, job, error='', retry=True):
+        """
+        Puts a failed job back in the queue, or marks it as failed once it ran out of attempts (or if retry is False).
+        Returns the new status, a queued job is still fetching.
+        """
+        status = 'queued' if retry and job['attempts'] < self.max_attempts else 'failed'
+        self.collection.update({'_key': job['_key'], 'status': status, 'fetching': status == 'queued', 'error': error})
+        print("Released pipeline id: {} with status: {}".format(job['_key'], status))
+        return status
+
+    def cancel(self, pipeline_id):
+        """
+        Requests the cancellation of a job, returns False if it already finished or doesn't exist.
+        """
+        rc = self._execute(CANCEL_QUERY, key=pipeline_id)
+        if rc:
+            print("Cancellation requested for pipeline id: {}".format(pipeline_id))
+        return bool(rc)
+
+    def mark_cancelled(self, job, reason=''):
+        self.collection.update({'_key': job['_key'], 'status': 'cancelled', 'fetching': False,
+                                'current_task': 'cancelled', 'error': reason})
+        print("Cancelled pipeline id: {}".format(job['_key']))
+
+    def reap_expired(self):
+        return self._execute(REAP_QUERY, max_attempts=self.max_attempts)
+
+    def update_status(self, pipeline_id, current_task, fetching=True):
+        self.collection.update({'_key': pipeline_id, 'current_task': current_task, 'fetching': fetching})
+
+    def get_job(self, pipeline_id):
+        return self.collection.get(pipeline_id)
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Renews the leases of the jobs that are currently being processed in this process,
+    and calls on_cancel(pipeline_id) for the jobs whose cancellation was requested.
+    """
+    def __init__(self, job_queue, interval=None, on_cancel=None):
+        super().__init__(daemon=True)
+        self.job_queue = job_queue
+        self.interval = interval or min(job_queue.lease_timeout / 3, JOB_CANCEL_CHECK_INTERVAL)
+        self.on_cancel = on_cancel
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs[job['_key']] = job
+
+    def remove(self, job):
+        with self.lock:
+            self.jobs.pop(job['_key'], None)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                try:
+                    lease = self.job_queue.extend_lease(job)
+                    if not lease:
+                        print("Lost the lease of pipeline id: {}".format(job['_key']))
+                    elif lease['cancel_requested'] and self.on_cancel:
+                        self.on_cancel(job['_key'])
+                except Exception as e:
+                    print("Couldn't extend the lease of pipeline id: {}, {}".format(job['_key'], e))
+            try:
+                self.job_queue.reap_expired()
+            except Exception as e:
+                print("Couldn't reap expired jobs: {}".format(e))
+
+    def stop(self):
+        self.stop_event.set()
@@ -14,6 +14,9 @@ from utils.image_utils import bb_intersection_over_union, bb_intersection, \
                                 bb_smallest_area, plot_one_box, save_img_with_bboxes, \
                                     bb_hueristic_face_coordinate, bb_center_coordinate, \
                                         distance_between_two_points
+from pipeline_metrics import METRICS
+from cancellation import check_cancelled
+from doc_store import upsert_doc
 
 # from visual_clues.bboxes_implementation import DetectronBBInitter
 
@@ -31,13 +34,13 @@ class FusionPipeline:
         self.collection_name = "s4_fusion"
         self.celebrity_data = self.get_celebrity_data()
 
-    def run_fusion_pipeline(self, movie_id):
+    def run_fusion_pipeline(self, movie_id, context=None):
         print("Starting to record time of fusion task!")
         start_time = time.time()
 
         print("Working on Movie ID: {}".format(movie_id))
 
-        reid_detections = self.get_reid_detections(movie_id = movie_id, collection=REID_COLLECTION_NAME)
+        reid_detections = self.get_reid_detections(movie_id = movie_id, collection=REID_COLLECTION_NAME, context=context)
         if not reid_detections:
             print("ERROR!!! REID data was not found!")
             return False, None
@@ -51,9 +54,10 @@ class FusionPipeline:
 
         # Iterate over all the RE-ID frames.
         for reid_detection in reid_detections:
-
+            check_cancelled()
             reid_frame = reid_detection['frame_num']
-            vc_data = self.get_visual_clues_data(movie_id = movie_id, collection=VISUAL_CLUES_COLLECTION_NAME, frame_num=reid_frame)
+            vc_data = self.get_visual_clues_data(movie_id = movie_id, collection=VISUAL_CLUES_COLLECTION_NAME, frame_num=reid_frame,
+                                                    context=context)
             if not vc_data:
                 print("ERROR!!! VISUAL CLUES DATA was not found!")
                 return False, None
@@ -107,8 +111,10 @@ class FusionPipeline:
         movie_id = fusion_output['movie_id']
         frames = fusion_output['frame_numbers']
         for frame_num, _ in frames.items():
-            
-            image_url = self.get_image_url(movie_id, frame_num=int(frame_num), collection=VISUAL_CLUES_COLLECTION_NAME)
+            check_cancelled()
+            frame_start_time = time.time()
+            image_url = self.get_image_url(movie_id, frame_num=int(frame_num), collection=VISUAL_CLUES_COLLECTION_NAME,
+                                            context=context)
             movie_name = image_url.split("/")[-2]
             print("Working on movie: {}, frame: {}".format(movie_name, frame_num))
 
@@ -126,8 +132,8 @@ class FusionPipeline:
             
             post_processed_matches = self.correct_matches(matches)
 
-            vc_ids = self.get_visual_clues_person_ids(movie_id, int(frame_num), collection="s4_visual_clues")
-            face_ids = self.get_reid_face_ids(movie_id, frame_num, collection="s4_re_id")
+            vc_ids = self.get_visual_clues_person_ids(movie_id, int(frame_num), collection="s4_visual_clues", context=context)
+            face_ids = self.get_reid_face_ids(movie_id, frame_num, collection="s4_re_id", context=context)
             matched_ids = []
             for idx, post_processed_match in enumerate(post_processed_matches):
                     face_id = str(post_processed_match['face_id'])
@@ -159,7 +165,12 @@ class FusionPipeline:
                         'vc_id': vc_id
                     }
                 )  
-            self.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
+            if context is None:
+                self.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
+            else:
+                context.add_fusion(data_for_db)
+                context.persist(self.insert_json_to_db, data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
+            METRICS.observe('frame_seconds', time.time() - frame_start_time, stage='fusion')
 
         end_time = time.time() - start_time
         print("Total time it took for fusion task: {}".format(end_time))
@@ -178,11 +189,12 @@ class FusionPipeline:
         Inserts a JSON with global & local tokens to the database.
         """
 
-        res = self.nre.write_doc_by_key(json_obj, collection_name, overwrite=True, key_list=key_list)
+        res = upsert_doc(self.nre.db, json_obj, collection_name, key_list=key_list)
 
         print("Successfully inserted to database. Collection name: {}".format(collection_name))
         return res
 
+    @METRICS.db_call('get_mdf_urls')
     def get_mdf_urls_from_db(self, movie_id, collection):
 
         data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
@@ -198,6 +210,7 @@ class FusionPipeline:
             urls.append(url)
         return urls
     
+    @METRICS.db_call('get_pipeline_id')
     def get_pipelineid_from_db(self, movie_id, collection):
 
         data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
@@ -211,6 +224,7 @@ class FusionPipeline:
 
         return pipeline_id
 
+    @METRICS.db_call('get_input_type')
     def get_input_type_from_db(self, pipeline_id, collection):
 
         pipeline_data = self.nre.get_doc_by_key({'_key': pipeline_id}, collection)
@@ -221,21 +235,29 @@ class FusionPipeline:
                 input_type = pipeline_data["inputs"]["videoprocessing"]["movies"][0]["type"]
         return input_type
 
-    def get_reid_detections(self, movie_id, collection):
-        try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id}, collection)
-        except KeyError:
-            print("Movie ID {} not found.".format(movie_id))
+    def get_reid_detections(self, movie_id, collection, context=None):
+        """
+        With a context the REID document is read from the database only once per job.
+        """
+        data = context.reid.get(movie_id) if context is not None else None
+        if not data:
+            try:
+                with METRICS.db_roundtrip('get_reid'):
+                    data = self.nre.get_doc_by_key({'movie_id': movie_id}, collection)
+            except KeyError:
+                print("Movie ID {} not found.".format(movie_id))
+            if data and context is not None:
+                context.reid[movie_id] = data
         if not data:
             return None
         reid_detections = data['frames'] if 'frames' in data else []
         return reid_detections
 
-    def get_reid_face_ids(self, movie_id, frame_num, collection):
+    def get_reid_face_ids(self, movie_id, frame_num, collection, context=None):
         """
         Get the bboxes that have 'person' detected in them.
         """
-        reid_data = self.get_reid_detections(movie_id, collection)
+        reid_data = self.get_reid_detections(movie_id, collection, context)
         face_ids = []
         for reid_det in reid_data:
             if str(reid_det['frame_num']) == str(frame_num):
@@ -244,9 +266,14 @@ class FusionPipeline:
                     face_ids.append(str(reid_bbox['id']))
         return face_ids
     
-    def get_visual_clues_data(self, movie_id, collection, frame_num):
+    def get_visual_clues_data(self, movie_id, collection, frame_num, context=None):
+        if context is not None:
+            data = context.get_visual_clues(movie_id, frame_num)
+            if data:
+                return data
         try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
+            with METRICS.db_roundtrip('get_visual_clues'):
+                data = self.nre.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
         except KeyError:
             print("Movie ID {} and Frame not found.".format(movie_id))
         return data
@@ -263,11 +290,11 @@ class FusionPipeline:
                 vc_rois.append(vc_roi)
         return vc_rois
     
-    def get_visual_clues_person_ids(self, movie_id, frame_num, collection):
+    def get_visual_clues_person_ids(self, movie_id, frame_num, collection, context=None):
         """
         Get the bboxes that have 'person' detected in them.
         """
-        visual_clue_data = self.get_visual_clues_data(movie_id, collection, frame_num)
+        visual_clue_data = self.get_visual_clues_data(movie_id, collection, frame_num, context)
         vc_ids = []
         vc_ids_data = visual_clue_data['roi']
         for vc_roi in vc_ids_data:
@@ -276,9 +303,9 @@ class FusionPipeline:
         return vc_ids
     
     
-    def get_image_url(self, movie_id, frame_num, collection):
+    def get_image_url(self, movie_id, frame_num, collection, context=None):
         try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
+            data = self.get_visual_clues_data(movie_id, collection, frame_num, context)
         except KeyError:
             print("Movie ID {} and Frame num {} not found.".format(movie_id, frame_num))
         return data['url']
@@ -3,16 +3,16 @@ from fusion_task import FusionPipeline
 import os
 from typing import Tuple
 
-def test_pipeline_task(pipeline_id):
+def test_pipeline_task(pipeline_id, fusion_pipeline=None, context=None):
     class MyTask(PipelineTask):
         def __init__(self):
-            self.fusion_pipeline = FusionPipeline()
+            self.fusion_pipeline = fusion_pipeline if fusion_pipeline else FusionPipeline()
             print("Initialized successfully.")
 
         def process_movie(self, movie_id: str) -> Tuple[bool, str]:
             print (f'handling movie: {movie_id}')
 
-            output = self.fusion_pipeline.run_fusion_pipeline(movie_id)
+            output = self.fusion_pipeline.run_fusion_pipeline(movie_id, context)
 
             print("Finished handling movie.")
             print(output)
@@ -24,12 +24,12 @@ def test_pipeline_task(pipeline_id):
     task = MyTask()
     pipeline.handle_pipeline_task(task, pipeline_id, stop_on_failure=True)
 
-def test():
+def test(fusion_pipeline=None):
     pipeline_id = os.environ.get('PIPELINE_ID')
     # pipeline_id = "a55117e0-247c-4e1d-ba5f-80efe69746c1" 
     # print(pipeline_id)
     # pipeline_id='12345678'
-    test_pipeline_task(pipeline_id)
+    test_pipeline_task(pipeline_id, fusion_pipeline)
 
 if __name__ == '__main__':
     test()
@@ -7,19 +7,25 @@ from enum import Enum
 import requests
 # import visual_genome.local as vg
 import json
+import io
 import copy
 import operator
 import itertools
 import subprocess
+import tempfile
 import time
 import typing
 import os
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import spacy
 import nltk
 import openai
+from PIL import Image
 
 from typing import NamedTuple
 from database.arangodb import DatabaseConnector, DBBase, NEBULA_DB
@@ -28,6 +34,8 @@ from config.config import NEBULA_CONF
 from visual_clues.vlm_factory import VlmFactory
 from visual_clues.vlm_interface import VlmInterface
 from visual_clues.vlm_implementation import VlmChunker, BlipItcVlmImplementation
+from pipeline_metrics import METRICS
+from cancellation import JobCancelled, check_cancelled, remaining_time, cancellable_sleep
 
 
 IPC_PATH = '/storage/ipc_data/paragraphs_v1.json'
@@ -60,26 +68,44 @@ def image_id_as_dict(id: ImageId):
 
 def flatten(lst): return [x for l in lst for x in l]
 
+SPICE_TIMEOUT = 300
+SPICE_TMP_DIR = '/notebooks/tmp'
+
+@METRICS.timed('spice_seconds')
 def spice_get_triplets(text):
     SPICE_FNAME = '/notebooks/app_data/SPICE-1.0/spice-1.0.jar'
-    INP_FNAME = '/notebooks/tmp/example.json'
-    OUT_FNAME = '/notebooks/tmp/example_output.json'
+    # Every call gets its own files, the pipeline workers run SPICE concurrently.
+    inp_fd, INP_FNAME = tempfile.mkstemp(prefix='spice_', suffix='.json', dir=SPICE_TMP_DIR)
+    out_fd, OUT_FNAME = tempfile.mkstemp(prefix='spice_', suffix='_output.json', dir=SPICE_TMP_DIR)
+    os.close(out_fd)
 
     inp = {
         'image_id': 1,
         'test': "",
         'refs': [text],        
     }
-    json.dump([inp],open(INP_FNAME,'w'))
-
-    p = subprocess.Popen('java -Xmx8G -jar {} {} -detailed -silent -subset -out {}'.format(SPICE_FNAME,INP_FNAME,OUT_FNAME),shell=True,
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-    p.communicate()
-    outp = json.load(open(OUT_FNAME,'r'))
-    if os.path.isfile(OUT_FNAME):
-        os.remove(OUT_FNAME)
+    try:
+        with os.fdopen(inp_fd, 'w') as f:
+            json.dump([inp], f)
+
+        # Without a shell, so killing p kills the JVM itself.
+        p = subprocess.Popen(['java', '-Xmx8G', '-jar', SPICE_FNAME, INP_FNAME, '-detailed', '-silent', '-subset', '-out', OUT_FNAME],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+        try:
+            p.communicate(timeout=min(SPICE_TIMEOUT, remaining_time(default=SPICE_TIMEOUT)))
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            check_cancelled()
+            raise JobCancelled("SPICE didn't finish in {} seconds".format(SPICE_TIMEOUT), timed_out=True)
+        with open(OUT_FNAME, 'r') as f:
+            outp = json.load(f)
+    finally:
+        for fname in (INP_FNAME, OUT_FNAME):
+            if os.path.isfile(fname):
+                os.remove(fname)
 
     return [x['tuple'] for x in outp[0]['ref_tuples']]
     
@@ -122,18 +148,24 @@ def spice_get_triplets(text):
 #             results.update(doc)
 #         return results['keyval']
 
+GPT_REQUEST_TIMEOUT = 60
+
+@METRICS.timed('http_fetch_seconds', target='openai')
 def gpt_execute(prompt_template, *args, **kwargs):            
     prompt = prompt_template.format(*args)   
     done = 10
     while done>0:
+        # Stops retrying as soon as the job was cancelled or ran out of time.
+        check_cancelled()
         try:
-            response = openai.Completion.create(prompt=prompt, max_tokens=256, **kwargs)   
+            response = openai.Completion.create(prompt=prompt, max_tokens=256,
+                                                request_timeout=min(GPT_REQUEST_TIMEOUT, remaining_time(default=GPT_REQUEST_TIMEOUT)), **kwargs)
             # return response
             return [x['text'].strip() for x in response['choices']]
         except Exception as e:
             print('Error, re-trying {} times'.format(done))
             print(e)
-            time.sleep(10)
+            cancellable_sleep(10)
             done -= 1
     
 def get_size_text(rect: [int, int, int, int], size: [int, int]):
@@ -209,20 +241,41 @@ def get_likey_obj_attr_combinations(objects, attributes, n=1, **kwargs):
     # rc = rc[0].split(', ')
     # return tuple(zip(*[x.split() for x in rc]))
 
+SPACY_LOCK = threading.Lock()
+
+@lru_cache()
+def _load_spacy_model(name):
+    return spacy.load(name)
+
+def load_spacy_model(name='en_core_web_lg'):
+    """
+    Loads a spaCy model once per process, the candidate filters share it.
+    """
+    with SPACY_LOCK:
+        return _load_spacy_model(name)
+
 class ICandidatesFilter(ABC):
     def __init__(self):
         super().__init__() 
 
     @abstractmethod
-    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str) -> list[str]:
+    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str, image=None) -> list[str]:
+        """
+        image is the already loaded image of image_url, if there is one.
+        """
         pass
 
+    def compute_similarity(self, vlm: VlmInterface, image_url: str, image, text: list[str]):
+        if image is None:
+            return vlm.compute_similarity_url(image_url, text)
+        return vlm.compute_similarity(image, text)
+
 class SubsetCandidatesFilter(ICandidatesFilter):
     def __init__(self):
         super().__init__()
-        self.nlp = spacy.load('en_core_web_lg')
+        self.nlp = load_spacy_model('en_core_web_lg')
 
-    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str) -> list[str]:
+    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str, image=None) -> list[str]:
         senter = self.nlp.get_pipe("senter")
         sentences = [str(x) for x in senter(self.nlp(paragraph)).sents]
         n = len(sentences)
@@ -231,19 +284,19 @@ class SubsetCandidatesFilter(ICandidatesFilter):
         for i in range(min_sentences,n+1):
             for comb in itertools.combinations(range(n),i):
                 cands.append(' '.join(operator.itemgetter(*comb)(sentences)))        
-        scores = vlm.compute_similarity_url(image_url,cands)
+        scores = self.compute_similarity(vlm, image_url, image, cands)
         cand = cands[np.argmax(scores)]
         return cand    
 
 class FixedThresholdCandidatesFilter(ICandidatesFilter):
     def __init__(self, threshold):
         self.threshold = threshold
-        self.nlp = spacy.load('en_core_web_lg')
+        self.nlp = load_spacy_model('en_core_web_lg')
 
-    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str) -> list[str]:
+    def candidates_from_paragraph(self, paragraph: str, vlm: VlmInterface, image_url: str, image=None) -> list[str]:
         senter = self.nlp.get_pipe("senter")
         sentences = [str(x) for x in senter(self.nlp(paragraph)).sents]
-        scores = vlm.compute_similarity_url(image_url,sentences)        
+        scores = self.compute_similarity(vlm, image_url, image, sentences)        
         return ' '.join([x for (x,y) in zip(sentences,scores) if y>self.threshold])
 
 
@@ -348,8 +401,9 @@ Describe this image in detail:'''
 
     # Ilan changed the format in the database, so this is the respective change in the code parsing the object. This is for YOLO
 
-    def get_movie_frame_prompt(self, mid: MovieImageId, include_local=False, include_attributes=False, local_captions=False, local_spatial_text = False, reduce_uncertainty = False, **kwargs):
-        base_doc = self.pipeline.get_movie_frame_from_collection(mid)
+    def get_movie_frame_prompt(self, mid: MovieImageId, include_local=False, include_attributes=False, local_captions=False, local_spatial_text = False, reduce_uncertainty = False, base_doc=None, **kwargs):
+        if base_doc is None:
+            base_doc = self.pipeline.get_movie_frame_from_collection(mid)
         caption = base_doc['global_caption'][self.global_captioner]
         all_objects = base_doc['global_objects'][self.global_tagger]
         # all_persons = base_doc['global_persons'][self.global_tagger]
@@ -374,20 +428,20 @@ Describe this image in detail:'''
         final_prompt = prompt_before_answer
         return local_prompt+final_prompt
 
-    def generate_prompt(self, ids: list[IPCImageId], target_id: ImageId = None, **kwargs):
+    def generate_prompt(self, ids: list[IPCImageId], target_id: ImageId = None, target_doc=None, **kwargs):
         rc = []
         for id in ids:  
             print(f'Get prompt of id: {id}')
             rc.append(self.get_prompt(id,include_answer=True, **kwargs))
         if target_id:  
             if type(target_id) == MovieImageId:
-                rc.append(self.get_movie_frame_prompt(target_id,include_answer=False, **kwargs))
+                rc.append(self.get_movie_frame_prompt(target_id,include_answer=False, base_doc=target_doc, **kwargs))
             else:
                 rc.append(self.get_prompt(target_id,include_answer=False, **kwargs))
         return '\n###\n'.join(rc)
 
-    def few_shot_process_target_id(self, fs_ids: list[IPCImageId],target_id: ImageId, n=5, debug_print_prompt=False, **kwargs):
-        fs_prompt = self.generate_prompt(fs_ids, target_id=target_id, **kwargs)
+    def few_shot_process_target_id(self, fs_ids: list[IPCImageId],target_id: ImageId, n=5, debug_print_prompt=False, target_doc=None, **kwargs):
+        fs_prompt = self.generate_prompt(fs_ids, target_id=target_id, target_doc=target_doc, **kwargs)
         if debug_print_prompt:
             print("Prompt:\n---------------------------------\n")
             print(fs_prompt)
@@ -400,10 +454,14 @@ class LlmTaskInternal:
     def __init__(self):
         self.config = NEBULA_CONF
         self.nebula_db = NEBULA_DB()
-        self.prompt_obj = GTBaseGenerator()
-        self.vlm = VlmChunker(VlmFactory().get_vlm("blip_itc"), chunk_size=50)
+        # BLIP ITC (shared with visual clues) and spaCy are loaded concurrently.
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="load-llm") as executor:
+            blip_itc = executor.submit(VlmFactory().get_vlm, "blip_itc")
+            cand_filter = executor.submit(FixedThresholdCandidatesFilter, 0.27)
+            self.prompt_obj = GTBaseGenerator()
+        self.vlm = VlmChunker(blip_itc.result(), chunk_size=50)
         # self.cand_filter =  SubsetCandidatesFilter()
-        self.cand_filter = FixedThresholdCandidatesFilter(0.27)
+        self.cand_filter = cand_filter.result()
 
         try:
             with open('/storage/keys/openai.key','r') as f:
@@ -416,21 +474,41 @@ class LlmTaskInternal:
         with open(os.path.join(current_path,'s3_ids.json'),'r') as f:
             self.s3_ids = json.load(f)
 
+    def warmup(self):
+        """
+        Runs spaCy and the VLM once on a synthetic input.
+        """
+        start_time = time.time()
+        image = Image.fromarray(np.full((384, 384, 3), 127, dtype=np.uint8))
+        self.cand_filter.candidates_from_paragraph("A gray image. Nothing is in it.", self.vlm, None, image=image)
+        print("LLM task warm-up time: {}".format(time.time() - start_time))
+
     def get_all_s3_ids(self):
         query = 'FOR doc IN {} RETURN doc.image_id'.format(GLOBAL_TOKENS_COLLECTION)
         cursor = self.nebula_db.db.aql.execute(query)
         return [doc for doc in cursor]
 
-    def process_target_id(self, target_id: ImageId, image_url=None, fs_samples=FS_SAMPLES, cand_filter=SubsetCandidatesFilter(),  **kwargs):
+    def process_target_id(self, target_id: ImageId, image_url=None, fs_samples=FS_SAMPLES, cand_filter=None, target_doc=None, image=None, **kwargs):
+        """
+        target_doc is the visual clues document of target_id when it's already in memory,
+        image is its already downloaded image. Otherwise the image is downloaded once for all the candidates.
+        """
         if image_url == None:
-            rc = self.nebula_db.get_movie_frame_from_collection(target_id)
+            if target_doc:
+                rc = target_doc
+            else:
+                with METRICS.db_roundtrip('get_visual_clues'):
+                    rc = self.nebula_db.get_movie_frame_from_collection(target_id)
             assert(rc)
             image_url = rc['url']
         print("Processing target_id {}, url: {}".format(target_id,image_url))
         train_ids = np.random.choice(self.s3_ids,fs_samples)
-        rc = self.prompt_obj.few_shot_process_target_id(train_ids, target_id, **kwargs)
-        candidates = [self.cand_filter.candidates_from_paragraph(x,self.vlm,image_url) for x in rc]
-        scores = self.vlm.compute_similarity_url(image_url,candidates)
+        rc = self.prompt_obj.few_shot_process_target_id(train_ids, target_id, target_doc=target_doc, **kwargs)
+        if image is None:
+            with METRICS.timer('http_fetch_seconds', target='image'):
+                image = self.vlm.load_image_url(image_url)
+        candidates = [self.cand_filter.candidates_from_paragraph(x,self.vlm,image_url,image=image) for x in rc]
+        scores = self.vlm.compute_similarity(image,candidates)
         cand = candidates[np.argmax(scores)]
         sg = spice_get_triplets(cand)
         rc = {
@@ -441,16 +519,36 @@ class LlmTaskInternal:
         }
         return {**image_id_as_dict(target_id), **rc}
 
-    def process_movie(self, movie_id: str, **kwargs):
-        mdfs = self.nebula_db.get_movie_structure(movie_id)
+    def process_movie(self, movie_id: str, context=None, **kwargs):
+        """
+        With a context the visual clues are taken from memory and the output is written in the background.
+        """
+        with METRICS.db_roundtrip('get_movie_structure'):
+            mdfs = self.nebula_db.get_movie_structure(movie_id)
+        # An image input was already downloaded at submission, its only MDF is the same image.
+        image = None
+        source_image = context.get_source_image() if context is not None and len(mdfs) == 1 else None
+        if source_image is not None:
+            try:
+                image = Image.open(io.BytesIO(source_image)).convert('RGB')
+            except Exception as e:
+                # process_target_id then loads the stored copy at the image url.
+                print("Couldn't decode the source image of movie {}: {}".format(movie_id, e))
         for frame in mdfs.keys():
+            check_cancelled()
+            frame_start_time = time.time()
             mid = MovieImageId(movie_id,frame)
             print('Processing movie {}, frame #{}'.format(movie_id,frame))
-            rc = self.process_target_id(mid, **kwargs)
+            target_doc = context.get_visual_clues(movie_id, frame) if context is not None else None
+            rc = self.process_target_id(mid, target_doc=target_doc, image=image, **kwargs)
             if rc:
-                self.nebula_db.write_movie_frame_doc_to_collection(mid,rc,LLM_OUTPUT_COLLECTION)
+                if context is None:
+                    self.nebula_db.write_movie_frame_doc_to_collection(mid,rc,LLM_OUTPUT_COLLECTION)
+                else:
+                    context.persist(self.nebula_db.write_movie_frame_doc_to_collection, mid, rc, LLM_OUTPUT_COLLECTION)
             else:
                 return False,1
+            METRICS.observe('frame_seconds', time.time() - frame_start_time, stage='llm')
         return True, None
 
 
@@ -8,16 +8,16 @@ from movie.movie_db import MOVIE_DB
 from experts.pipeline.api import PipelineApi, PipelineTask
 import time
 
-def test_pipeline_task(pipeline_id):
+def test_pipeline_task(pipeline_id, llm_task=None, context=None):
     class LlmTask(PipelineTask):
         def __init__(self):
-            self.llm_task = LlmTaskInternal()
+            self.llm_task = llm_task if llm_task else LlmTaskInternal()
             print("LlmTask Initialized successfully.")
 
         def process_movie(self, movie_id: str) -> Tuple[bool, str]:
             print (f'LlmTask: handling movie: {movie_id}')
             start_time = time.time()
-            output = self.llm_task.process_movie(movie_id)
+            output = self.llm_task.process_movie(movie_id, context=context)
             end_time = time.time() - start_time
             print("Total time it took for llm task: {}".format(end_time))
             print("LlmTask: Finished handling movie.")
@@ -31,14 +31,14 @@ def test_pipeline_task(pipeline_id):
     pipeline.handle_pipeline_task(task, pipeline_id, stop_on_failure=True)
 
 
-def test():
+def test(llm_task=None):
     pipeline_id = os.environ.get('PIPELINE_ID')
     # print(pipeline_id)
     if pipeline_id == None:
         print("Error: Pipeline id is None!")
         pipeline_id = 'b780544f-78d0-43f6-9407-6545dc6ea1d6'
         print("Using default pipeline id: {}".format(pipeline_id))
-    test_pipeline_task(pipeline_id)
+    test_pipeline_task(pipeline_id, llm_task)
 
 if __name__ == '__main__':
     test()
\ No newline at end of file
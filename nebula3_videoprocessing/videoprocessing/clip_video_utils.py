@@ -8,6 +8,8 @@ from PIL import Image
 from copy import deepcopy
 from sklearn.cluster import MeanShift
 from scipy.spatial.distance import cdist, euclidean
+import time
+from pipeline_metrics import METRICS
 
 
 def geometric_median(X, eps=1e-5):
@@ -105,6 +107,17 @@ class ClipVideoUtils:
 
         return ret_boundaries, good_frame_len
 
+    def encode_image(self, images):
+        """
+        CLIP image encoder forward, measured in the metrics registry
+        :param images: batch of preprocessed frames
+        :return:
+        """
+        start_time = time.time()
+        embeddings = self.model.encode_image(images)
+        METRICS.observe_model('clip_video', time.time() - start_time, images.shape[0])
+        return embeddings
+
     def preprocess_movies(self, movie_name):
         cap = cv.VideoCapture(movie_name)
         ret, frame = cap.read()
@@ -121,10 +134,10 @@ class ClipVideoUtils:
                     batch_array[ind, :] = img
                     if ind == self.batch_size - 1:
                         batch_array = batch_array.to(self.device)
-                        embeddings = self.model.encode_image(batch_array)
+                        embeddings = self.encode_image(batch_array)
                 else:
                     img = self.preprocess(Image.fromarray(frame)).unsqueeze(0).to(self.device)
-                    embeddings = self.model.encode_image(img)
+                    embeddings = self.encode_image(img)
                 pass
             ret, frame = cap.read()
             frame_num = frame_num + 1
@@ -165,12 +178,12 @@ class ClipVideoUtils:
                         batch_array[ind, :] = img
                         if ind == self.batch_size - 1:
                             batch_array = batch_array.to(self.device)
-                            embeddings = self.model.encode_image(batch_array).cpu()
+                            embeddings = self.encode_image(batch_array).cpu()
                             embeddings = embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
                             embedding_array = np.append(embedding_array, embeddings, axis=0)
                     else:
                         img = self.preprocess(Image.fromarray(frame)).unsqueeze(0).to(self.device)
-                        embeddings = self.model.encode_image(img).cpu()
+                        embeddings = self.encode_image(img).cpu()
                         embeddings = embeddings / np.linalg.norm(embeddings)
                         embedding_array = np.append(embedding_array, embeddings, axis=0)
                     # The code below computes embedding differences
@@ -191,7 +204,7 @@ class ClipVideoUtils:
                 ind = (batch_cnt) % self.batch_size
                 if ind != self.batch_size and (ind !=0): # ind == 0 tells 
                     batch_array = batch_array[:ind, :, :, :].to(self.device)
-                    embeddings = self.model.encode_image(batch_array).cpu()
+                    embeddings = self.encode_image(batch_array).cpu()
                     embeddings = embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
                     embedding_array = np.append(embedding_array, embeddings, axis=0)
                 else:
@@ -391,7 +404,6 @@ class ClipVideoUtils:
 
         return np.array(ret_list)
 
-import time
 def clip_performance_test():
     folder = '/home/paperspace/data/videos'
     movies = ['video1077.mp4', 'video3773.mp4', 'video9902.mp4']
@@ -9,6 +9,8 @@ from PIL import Image
 import clip
 import cv2 as cv
 import os
+import time
+from pipeline_metrics import METRICS
 
 N = type(None)
 V = np.array
@@ -230,12 +232,14 @@ class ClipCap:
         :param emb: - clip embedding
         :return:
         """
+        start_time = time.time()
         prefix_embed = self.model.clip_project(torch.tensor(emb, dtype=torch.float32)).reshape(1, self.prefix_length,-1)
          
         if use_beam_search:
             generated_text_prefix = generate_beam(self.model, self.tokenizer, embed=prefix_embed, beam_size=5)
         else:                                                                                       
             generated_text_prefix = generate2(self.model, self.tokenizer, embed=prefix_embed)
+        METRICS.observe_model('clipcap', time.time() - start_time, 1)
         return generated_text_prefix
 
 
@@ -0,0 +1,225 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+MAX_TRACKED_PIPELINES = 1000
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class MetricsRegistry:
+    """
+    Process wide histograms, counters and gauges.
+    Every observation made inside pipeline_scope(pipeline_id) is also summarized per pipeline_id.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        self.pipelines = OrderedDict()
+        self.local = threading.local()
+
+    @contextmanager
+    def pipeline_scope(self, pipeline_id):
+        previous = getattr(self.local, 'pipeline_id', None)
+        self.local.pipeline_id = pipeline_id
+        try:
+            yield
+        finally:
+            self.local.pipeline_id = previous
+
+    def current_pipeline_id(self):
+        return getattr(self.local, 'pipeline_id', None)
+
+    def _record_pipeline(self, pipeline_id, name, label_key, value):
+        pipeline_id = pipeline_id or self.current_pipeline_id()
+        if not pipeline_id:
+            return
+        if pipeline_id not in self.pipelines:
+            self.pipelines[pipeline_id] = {}
+            while len(self.pipelines) > MAX_TRACKED_PIPELINES:
+                self.pipelines.popitem(last=False)
+        series = self.pipelines[pipeline_id].setdefault(name, {})
+        series.setdefault(label_key, Summary()).observe(value)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, pipeline_id=None, **labels):
+        label_key = _label_key(labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).get(label_key)
+            if histogram is None:
+                histogram = self.histograms[name][label_key] = Histogram(buckets)
+            histogram.observe(value)
+            self._record_pipeline(pipeline_id, name, label_key, value)
+
+    def inc(self, name, value=1, pipeline_id=None, **labels):
+        label_key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[label_key] = series.get(label_key, 0) + value
+            self._record_pipeline(pipeline_id, name, label_key, value)
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start_time, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator version of timer.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def db_roundtrip(self, op):
+        """
+        Counts a database round-trip and measures its latency.
+        """
+        self.inc('db_roundtrips_total', op=op)
+        with self.timer('db_roundtrip_seconds', op=op):
+            yield
+
+    def db_call(self, op):
+        """
+        Decorator version of db_roundtrip.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.db_roundtrip(op):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe_model(self, model, elapsed, batch_size):
+        self.observe('model_forward_seconds', elapsed, model=model)
+        self.observe('model_batch_size', batch_size, buckets=BATCH_SIZE_BUCKETS, model=model)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append('# TYPE {} counter'.format(name))
+                for label_key, value in series.items():
+                    lines.append('{}{} {}'.format(name, _format_labels(label_key), value))
+            for name, series in sorted(self.gauges.items()):
+                lines.append('# TYPE {} gauge'.format(name))
+                for label_key, value in series.items():
+                    lines.append('{}{} {}'.format(name, _format_labels(label_key), value))
+            for name, series in sorted(self.histograms.items()):
+                lines.append('# TYPE {} histogram'.format(name))
+                for label_key, histogram in series.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(label_key, [('le', str(bound))]), count))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(label_key, [('le', '+Inf')]), histogram.count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(label_key), histogram.sum))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(label_key), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def pipeline_report(self, pipeline_id):
+        """
+        Returns a JSON serializable summary of everything that was measured for pipeline_id.
+        """
+        with self.lock:
+            metrics = self.pipelines.get(pipeline_id, {})
+            report = {name: [dict(labels=dict(label_key), **summary.as_dict()) for label_key, summary in series.items()]
+                        for name, series in metrics.items()}
+        return {'pipeline_id': pipeline_id, 'metrics': report}
+
+    def dump_json(self, pipeline_id):
+        return json.dumps(self.pipeline_report(pipeline_id))
+
+
+METRICS = MetricsRegistry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics returns Prometheus text, GET /metrics/<pipeline_id> the JSON report of one pipeline.
+    """
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/metrics':
+            body, content_type = METRICS.render_prometheus(), 'text/plain; version=0.0.4'
+        elif path.startswith('/metrics/'):
+            body, content_type = METRICS.dump_json(path[len('/metrics/'):]), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    print("Serving metrics on port {}".format(port))
+    return server
@@ -0,0 +1,108 @@
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from const_vars import READINESS_COLLECTION, READINESS_STALE_AFTER, READINESS_REFRESH_INTERVAL
+from pipeline_metrics import METRICS
+
+TOUCH_QUERY = '''
+INSERT MERGE(@doc, { updated_at: DATE_NOW() }) INTO @@readiness OPTIONS { overwriteMode: "replace" }
+'''
+
+# A process that stopped refreshing its document is considered gone.
+LIVE_QUERY = '''
+FOR process IN @@readiness
+    FILTER process.updated_at > DATE_NOW() - @stale_ms
+    RETURN UNSET(process, "_id", "_rev")
+'''
+
+class Readiness:
+    """
+    Publishes the startup phase of a pipeline process ("loading", "warming_up", "ready") to Arango,
+    so the server can tell whether a submitted job will be picked up right away.
+    """
+    def __init__(self, db, collection_name=READINESS_COLLECTION):
+        self.db = db
+        self.collection_name = collection_name
+        if not self.db.has_collection(self.collection_name):
+            self.db.create_collection(self.collection_name)
+        self.collection = self.db.collection(self.collection_name)
+        self.key = "{}-{}".format(socket.gethostname(), os.getpid())
+        self.phase = None
+        self.details = {}
+        self.stop_event = threading.Event()
+        self.heartbeat = None
+        # Held while the document is touched, so a fork never happens in the middle of a DB call.
+        self.lock = threading.Lock()
+        self.touched_at = 0
+
+    def set_phase(self, phase, **details):
+        self.phase = phase
+        self.details.update(details)
+        METRICS.set_gauge('pipeline_ready', 1 if phase == "ready" else 0)
+        print("Pipeline process {} is {}".format(self.key, phase))
+        self.touch()
+
+    def touch(self):
+        """
+        Refreshes the document, has to be called more often than READINESS_STALE_AFTER.
+        """
+        doc = dict(self.details, _key=self.key, host=socket.gethostname(), pid=os.getpid(),
+                    phase=self.phase, ready=self.phase == "ready")
+        with self.lock:
+            self.db.aql.execute(TOUCH_QUERY, bind_vars={'doc': doc, '@readiness': self.collection_name})
+            self.touched_at = time.time()
+
+    def touch_if_due(self, interval=READINESS_REFRESH_INTERVAL):
+        """
+        Touches the document from the calling thread if the last touch is older than interval.
+        """
+        if time.time() - self.touched_at >= interval:
+            self.touch()
+
+    @contextmanager
+    def paused(self):
+        """
+        Keeps the heartbeat from touching the document, e.g. while the process forks.
+        """
+        with self.lock:
+            yield
+
+    def start_heartbeat(self, interval=READINESS_REFRESH_INTERVAL):
+        """
+        Touches the document every interval seconds from a background thread,
+        so the process stays live while it spends minutes loading the models.
+        A process that forks has to stop it first, or pause it around every fork.
+        """
+        self.stop_event = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, args=(interval,), name="readiness-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+    def _heartbeat(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.touch()
+            except Exception as e:
+                print("Couldn't refresh the readiness of {}: {}".format(self.key, e))
+
+    def stop_heartbeat(self):
+        self.stop_event.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+            self.heartbeat = None
+
+    def stop(self):
+        self.stop_heartbeat()
+        self.collection.delete(self.key, ignore_missing=True)
+
+
+def get_readiness(db, collection_name=READINESS_COLLECTION, stale_after=READINESS_STALE_AFTER):
+    """
+    Returns whether at least one live pipeline process finished its warm-up, and the state of every live process.
+    """
+    if not db.has_collection(collection_name):
+        return {'ready': False, 'processes': []}
+    processes = list(db.aql.execute(LIVE_QUERY, bind_vars={'@readiness': collection_name,
+                                                            'stale_ms': int(stale_after * 1000)}))
+    return {'ready': any(process['ready'] for process in processes), 'processes': processes}
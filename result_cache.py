@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+from arango import ArangoClient
+from const_vars import RESULT_CACHE_COLLECTION, RESULT_CACHE_VERSION, RESULT_CACHE_MAX_ENTRIES
+from pipeline_metrics import METRICS
+from visual_clues.visual_clues.text_feat_bank import checkpoint_id
+from nebula3_llm_task.llm_orchestration import FS_GPT_MODEL
+
+# A hit only counts if every movie it points to still exists, a stale entry is never returned.
+LOOKUP_QUERY = '''
+FOR entry IN @@cache
+    FILTER entry._key == @key AND entry.version == @version
+    FILTER LENGTH(entry.movie_ids) > 0
+    FILTER LENGTH(FOR movie_id IN entry.movie_ids FILTER DOCUMENT(movie_id) == null RETURN 1) == 0
+    UPDATE entry WITH { last_used: DATE_NOW(), hits: entry.hits + 1 } IN @@cache
+    RETURN NEW
+'''
+
+STORE_QUERY = '''
+UPSERT { _key: @key }
+INSERT { _key: @key, version: @version, pipeline_id: @pipeline_id, movie_ids: @movie_ids,
+         movies: @movies, tasks: @tasks, created_at: DATE_NOW(), last_used: DATE_NOW(), hits: 0 }
+REPLACE { _key: @key, version: @version, pipeline_id: @pipeline_id, movie_ids: @movie_ids,
+          movies: @movies, tasks: @tasks, created_at: DATE_NOW(), last_used: DATE_NOW(), hits: 0 }
+IN @@cache
+'''
+
+# Least recently used entries go first.
+EVICT_QUERY = '''
+FOR entry IN @@cache
+    SORT entry.last_used ASC
+    LIMIT @excess
+    REMOVE entry IN @@cache
+    RETURN OLD._key
+'''
+
+INVALIDATE_QUERY = '''
+FOR entry IN @@cache
+    FILTER @all OR entry.version != @version
+    REMOVE entry IN @@cache
+    RETURN OLD._key
+'''
+
+CLONE_QUERY = '''
+UPDATE { _key: @pipeline_id } WITH { movies: @movies, tasks: @tasks, cached_from: @source_pipeline_id } IN pipelines
+'''
+
+def models_version():
+    """
+    The BLIP checkpoint and the LLM that process an input, and RESULT_CACHE_VERSION,
+    which is bumped by hand for a change they don't capture.
+    """
+    return "|".join([RESULT_CACHE_VERSION, checkpoint_id(), FS_GPT_MODEL])
+
+def content_key(data, version=None):
+    """
+    Cache key of an input: the hash of its bytes and of the version of the models that process it.
+    """
+    version = models_version() if version is None else version
+    digest = hashlib.sha256(data)
+    digest.update(version.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Maps the content of an input to the pipeline that already processed it.
+    A hit points the new pipeline document at the movies of the cached pipeline, so the
+    Movies, s4_visual_clues, s4_fusion and s4_llm_output documents (all keyed by movie id) are reused as they are.
+    Entries of another models_version() are never hit, invalidate() removes them.
+    """
+    def __init__(self, db, collection_name=RESULT_CACHE_COLLECTION, version=None,
+                    max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.db = db
+        self.collection_name = collection_name
+        self.version = models_version() if version is None else version
+        self.max_entries = max_entries
+        if not self.db.has_collection(self.collection_name):
+            self.db.create_collection(self.collection_name)
+        self.collection = self.db.collection(self.collection_name)
+        self.collection.add_persistent_index(fields=['last_used'])
+
+    @METRICS.db_call('result_cache')
+    def _execute(self, query, **bind_vars):
+        bind_vars['@cache'] = self.collection_name
+        return list(self.db.aql.execute(query, bind_vars=bind_vars))
+
+    def key(self, data):
+        return content_key(data, self.version)
+
+    def lookup(self, key):
+        entries = self._execute(LOOKUP_QUERY, key=key, version=self.version)
+        METRICS.inc('result_cache_lookups_total', result='hit' if entries else 'miss')
+        return entries[0] if entries else None
+
+    @METRICS.db_call('result_cache_clone')
+    def clone(self, entry, pipeline_id):
+        """
+        Makes pipeline_id show the results of the cached entry.
+        """
+        self.db.aql.execute(CLONE_QUERY, bind_vars={'pipeline_id': pipeline_id, 'movies': entry['movies'],
+                                                    'tasks': entry.get('tasks', {}), 'source_pipeline_id': entry['pipeline_id']})
+        print("Pipeline id: {} reuses the results of pipeline id: {}".format(pipeline_id, entry['pipeline_id']))
+
+    def store(self, key, pipeline_id):
+        """
+        Records the results of a finished pipeline under key, then evicts the least recently used entries.
+        """
+        pipeline_doc = self.db.collection("pipelines").get(pipeline_id)
+        if not pipeline_doc or not pipeline_doc.get('movies'):
+            return
+        self._execute(STORE_QUERY, key=key, version=self.version, pipeline_id=pipeline_id,
+                        movie_ids=list(pipeline_doc['movies'].keys()), movies=pipeline_doc['movies'],
+                        tasks=pipeline_doc.get('tasks', {}))
+        excess = self.collection.count() - self.max_entries
+        if excess > 0:
+            self._execute(EVICT_QUERY, excess=excess)
+
+    def invalidate(self, all_versions=False):
+        """
+        Removes the entries of other versions, or every entry.
+        """
+        removed = self._execute(INVALIDATE_QUERY, version=self.version, all=all_versions)
+        print("Removed {} result cache entries.".format(len(removed)))
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invalidates the pipeline result cache, run it after the model checkpoints change.")
+    parser.add_argument('--all', action='store_true', help="remove the entries of the current version too")
+    args = parser.parse_args()
+    client = ArangoClient(hosts="http://172.83.9.249:8529")
+    db = client.db("ipc_200", username='nebula', password='nebula')
+    ResultCache(db).invalidate(all_versions=args.all)
+
+if __name__ == '__main__':
+    main()
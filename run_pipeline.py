@@ -1,17 +1,75 @@
-from const_vars import WF_TEMPLATE
+from const_vars import WF_TEMPLATE, LEGACY_PIPELINE_URL_KEY, STAGE_QUEUE_SIZE, \
+                        PIPELINE_WORKER_PROCESSES, WORKER_MAX_IN_FLIGHT, METRICS_COLLECTION, METRICS_PORT, \
+                        SOURCE_IMAGE_FETCH_TIMEOUT, SOURCE_IMAGE_FETCH_THREADS, SOURCE_IMAGE_HEADERS, \
+                        RESULT_CACHE_ENABLED, JOB_TIMEOUT, STAGE_TIMEOUTS
 from arango import ArangoClient
 from database.arangodb import NEBULA_DB
 import uuid
+import copy
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from nebula3_videoprocessing.videoprocessing.expert.videoprocessing_expert import VideoProcessingExpert
 from visual_clues.visual_clues.run_visual_clues import TokensPipeline
-from nebula3_fusion.run_fusion_task import test as fusion_test
-from nebula3_llm_task.run_llm_task import test as llm_test
-from visual_clues.visual_clues.run_sprint4 import test as visual_clues_test
-import os 
+from nebula3_fusion.run_fusion_task import test_pipeline_task as fusion_pipeline_task, FusionPipeline
+from nebula3_llm_task.run_llm_task import test_pipeline_task as llm_pipeline_task
+from visual_clues.visual_clues.run_sprint4 import test_pipeline_task as visual_clues_pipeline_task
+import os
 import time
 from nebula3_reid.facenet_pytorch.pipeline_task.reid_task import test_pipeline_task
 from nebula3_reid.facenet_pytorch.examples.reid_inference_mdf import FaceReId
 from nebula3_llm_task.llm_orchestration import LlmTaskInternal
+from job_queue import JobQueue, LeaseHeartbeat
+from stage_executor import Stage, StagedExecutor
+from worker_pool import WorkerPool, limit_supervisor_threads
+from artifact_context import ArtifactContext, WriteBehindWriter
+from pipeline_metrics import METRICS, start_metrics_server
+from result_cache import ResultCache
+from cancellation import CancelToken, JobCancelled, cancel_scope
+from readiness import Readiness
+from doc_store import upsert_doc
+
+# The videoprocessing expert reads its pipeline id from the environment,
+# so only one job at a time can be inside it.
+VIDEOPROCESSING_LOCK = threading.Lock()
+
+def videoprocessing_pipeline_task(pipeline_id, videoprocessing_instance, context=None):
+    with VIDEOPROCESSING_LOCK:
+        # Necessary for videoprocessing task
+        os.environ['ARANGO_HOST'] = "172.83.9.249"
+        os.environ['EXPERT_RUN_MODE'] = 'task'
+        os.environ['PIPELINE_ID'] = pipeline_id
+        videoprocessing_instance.run_pipeline_task()
+
+def reid_pipeline_task(pipeline_id, reid_instance, context=None):
+    # REID writes its detections to the database, fusion reads them once into the context.
+    test_pipeline_task(pipeline_id, reid_instance)
+
+# Stage DAG: (name, task, stages it depends on). Each task is called as task(pipeline_id, expert_instance, context)
+# by the stage's own worker thread, as soon as all of its dependencies finished for that pipeline.
+# Reid and visual clues only need the MDFs of videoprocessing, fusion joins both and llm only needs visual clues.
+STAGE_DAG = [
+    ("videoprocessing", videoprocessing_pipeline_task, []),
+    ("reid", reid_pipeline_task, ["videoprocessing"]),
+    ("visual_clues", visual_clues_pipeline_task, ["videoprocessing"]),
+    ("fusion", fusion_pipeline_task, ["reid", "visual_clues"]),
+    ("llm", llm_pipeline_task, ["visual_clues"])
+]
+
+def fetch_source_image(url_link, context):
+    """
+    Downloads an image input while videoprocessing stores it, so visual clues and llm
+    don't have to download the stored copy again. On failure they fall back to the stored copy.
+    """
+    data = None
+    try:
+        with METRICS.timer('http_fetch_seconds', target='source_image'):
+            resp = requests.get(url_link, headers=SOURCE_IMAGE_HEADERS, timeout=SOURCE_IMAGE_FETCH_TIMEOUT)
+        resp.raise_for_status()
+        data = resp.content
+    except Exception as e:
+        print("Couldn't prefetch image {}: {}".format(url_link, e))
+    context.set_source_image(data)
 
 class InitialPipeline:
     def __init__(self):
@@ -21,164 +79,413 @@ class InitialPipeline:
         self.db = self.client.db(self.dbname, username='nebula', password='nebula')
         self.wf_template = WF_TEMPLATE
         self.nre = NEBULA_DB()
+        self.job_queue = JobQueue(self.db)
+        if not self.db.has_collection(METRICS_COLLECTION):
+            self.db.create_collection(METRICS_COLLECTION)
+        # The server's admission control reads the latest reports.
+        self.db.collection(METRICS_COLLECTION).add_persistent_index(fields=['finished_at'])
 
     def validate_url(self, url_link):
         return url_link
 
-    def init_pipeline(self, url_link, pipeline_id = ''):
+    def get_input_type(self, url_link):
+        if url_link.split('.')[-1] == 'mp4' or url_link.split('.')[-1] == 'avi' or "youtube" in url_link:
+            return "movie"
+        return "image"
+
+    def init_pipeline(self, url_link, pipeline_id = '', url_links=None):
         """
         Inserts Initial data to our pipelines document and returns pipeline_id
+        url_links makes a dataset pipeline with one movie per url.
         """
         if url_link != '':
-            movie_url = url_link
-            if movie_url.split('.')[-1] == 'mp4' or movie_url.split('.')[-1] == 'avi' or "youtube" in movie_url:
-                _movie = {"movie_id": "", "url": movie_url, "type": "movie"}
-            else:
-                _movie = {"movie_id": "", "url": movie_url, "type": "image"}
-            pipeline_entry = self.wf_template.copy()
-            pipeline_entry['inputs']['videoprocessing']['movies'] = [_movie]
+            movie_urls = url_links or [url_link]
+            movies = [{"movie_id": "", "url": movie_url, "type": self.get_input_type(movie_url)} for movie_url in movie_urls]
+            pipeline_entry = copy.deepcopy(self.wf_template)
+            pipeline_entry['inputs']['videoprocessing']['movies'] = movies
             if not pipeline_id:
                 pipeline_entry['id'] = str(uuid.uuid4())
             else:
                 pipeline_entry['id'] = pipeline_id
             pipeline_entry['_key'] = pipeline_entry['id']
-            self.db.collection("pipelines").insert(pipeline_entry)
+            # A job whose lease expired is re-run with the same pipeline id.
+            with METRICS.db_roundtrip('init_pipeline'):
+                self.db.collection("pipelines").insert(pipeline_entry, overwrite=True)
             pipeline_id = pipeline_entry['id']
             return pipeline_id
         else:
             return ''
-    
-    def update_pipeline_status(self, current_task):
+
+    def update_pipeline_status(self, current_task, pipeline_id='', fetching=True):
+        if pipeline_id:
+            self.job_queue.update_status(pipeline_id, current_task, fetching=fetching)
+        # Keep the legacy document up to date for clients that still poll it.
         pipeline_dict = dict()
-        pipeline_dict["unique_key"] = "123456789"
+        pipeline_dict["unique_key"] = LEGACY_PIPELINE_URL_KEY
+        pipeline_dict["fetching"] = fetching
+        pipeline_dict["current_task"] = current_task
+        upsert_doc(self.db, pipeline_dict, "pipeline_url", key_list=['unique_key'])
+
+    def save_metrics(self, pipeline_id, num_items=1):
+        """
+        Stores the metrics summary of a finished pipeline next to its results.
+        """
+        report = METRICS.pipeline_report(pipeline_id)
+        report['_key'] = pipeline_id
+        report['num_items'] = num_items
+        report['finished_at'] = time.time()
+        self.db.collection(METRICS_COLLECTION).insert(report, overwrite=True)
+
+    def drain_legacy_submission(self):
+        """
+        Moves a URL written directly to the legacy "pipeline_url" document into the job queue.
+        """
+        rc = self.nre.get_doc_by_key({'_key': LEGACY_PIPELINE_URL_KEY}, "pipeline_url")
+        if not rc or not rc["url_link"]:
+            return ''
+        # This is for 8032 - it doesnt append pipeline id to the pipeline_url document..
+        pipeline_id = self.job_queue.enqueue(rc["url_link"], rc["pipeline_id"])
+        pipeline_dict = dict()
+        pipeline_dict["unique_key"] = LEGACY_PIPELINE_URL_KEY
         pipeline_dict["url_link"] = ""
         pipeline_dict["pipeline_id"] = ""
-        pipeline_dict["fetching"] = True
-        pipeline_dict["current_task"] = current_task
-        self.nre.write_doc_by_key(doc=pipeline_dict, collection_name="pipeline_url", key_list=['unique_key'])
-    
+        upsert_doc(self.db, pipeline_dict, "pipeline_url", key_list=['unique_key'])
+        return pipeline_id
 
 
+def load_expert(name, expert_class):
+    start_time = time.time()
+    expert = expert_class()
+    print("Loading {} took: {}".format(name, time.time() - start_time))
+    return expert
 
-def main():
-    
-    videoprocessing_instance = VideoProcessingExpert()
-    pipeline_instance = InitialPipeline()
-    pipeline_id = pipeline_instance.init_pipeline('https://d1nslcd7m2225b.cloudfront.net/Pictures/480xany/8/6/3/1388863_fullriverred_499613.jpeg') #"5b0c75bf-5fd6-4c1e-9f7e-5f51a9a96bd8"
-    # Necessary for videoprocessing task
-    os.environ['ARANGO_HOST'] = "172.83.9.249"
-    os.environ['EXPERT_RUN_MODE'] = 'task'
-    os.environ['PIPELINE_ID'] = pipeline_id
-    
+def load_experts():
+    """
+    Loads every expert once, each one is used only by the worker of its own stage.
+    The checkpoints are read concurrently, videoprocessing is constructed on the main thread.
+    """
     start_time = time.time()
-    videoprocessing_instance.run_pipeline_task()
-    end_time = time.time() - start_time
-    # print("Video #{} took: {}".format(idx, end_time))
+    expert_classes = {"reid": FaceReId, "visual_clues": TokensPipeline, "fusion": FusionPipeline, "llm": LlmTaskInternal}
+    with ThreadPoolExecutor(max_workers=len(expert_classes), thread_name_prefix="load-expert") as executor:
+        futures = {name: executor.submit(load_expert, name, expert_class) for name, expert_class in expert_classes.items()}
+        experts = {"videoprocessing": load_expert("videoprocessing", VideoProcessingExpert)}
+        experts.update({name: future.result() for name, future in futures.items()})
+    print("Loading all the experts took: {}".format(time.time() - start_time))
+    return experts
 
-    # run reid
-    reid_instance = FaceReId()
-    test_pipeline_task(pipeline_id, reid_instance)
-    # end_time2 = time.time() - start_time
-    # print("Total time it took for videprocessing: {}".format(end_time2))
-    # Get movie id for visual clues, reid and llm.
-    pipeline_structure = pipeline_instance.nre.get_pipeline_structure(pipeline_id)
-    movie_id = list(pipeline_structure['movies'].keys())[0]
-    # run visual_clues test
-    visual_clues_instance = TokensPipeline()
-    visual_clues_test(visual_clues_instance)
-    # run fusion
-    fusion_test()
-    # run llm
-    llm_instance = LlmTaskInternal()
-    llm_test(llm_instance)
-    end_time = time.time() - start_time
-    print("Total time it took for whole pipeline: {}".format(end_time))
+def warmup_experts(experts):
+    """
+    Runs the models of every expert that has a warmup() once on a synthetic input,
+    so the first job doesn't pay for the lazy initialization.
+    """
+    for name, expert in experts.items():
+        warmup = getattr(expert, 'warmup', None)
+        if not warmup:
+            continue
+        try:
+            warmup()
+        except Exception as e:
+            print("Warm-up of {} failed: {}".format(name, e))
+
+
+class PipelineJob:
+    """
+    A single pipeline run travelling through the stages.
+    queue_job is the leased job document, None for jobs that didn't come from the job queue.
+    """
+    def __init__(self, pipeline_id, url_link, queue_job=None, writer=None, url_links=None):
+        self.pipeline_id = pipeline_id
+        self.url_link = url_link
+        self.url_links = url_links or [url_link]
+        self.num_items = len(self.url_links)
+        self.queue_job = queue_job
+        self.context = ArtifactContext(pipeline_id, writer)
+        self.cache_key = None
+        self.cached = False
+        # A dataset job gets the deadlines of all of its items.
+        self.cancel_token = CancelToken(timeout=JOB_TIMEOUT * self.num_items, name="pipeline id {}".format(pipeline_id))
+        self.start_time = time.time()
+        self.finished = threading.Event()
+
+
+class PipelineRunner:
+    """
+    Feeds claimed jobs into a StagedExecutor running STAGE_DAG, one worker per stage.
+    """
+    def __init__(self, pipeline_instance, experts, on_finished=None):
+        self.pipeline_instance = pipeline_instance
+        self.on_finished = on_finished
+        self.job_queue = pipeline_instance.job_queue
+        self.heartbeat = LeaseHeartbeat(self.job_queue, on_cancel=self.cancel)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.writer = WriteBehindWriter()
+        self.image_fetcher = ThreadPoolExecutor(max_workers=SOURCE_IMAGE_FETCH_THREADS, thread_name_prefix="image-fetch")
+        self.result_cache = ResultCache(pipeline_instance.db) if RESULT_CACHE_ENABLED else None
+        stages = [Stage(stage_name, self.make_stage_task(stage_name, stage_task, experts[stage_name]),
+                        depends_on=depends_on, queue_size=STAGE_QUEUE_SIZE)
+                    for stage_name, stage_task, depends_on in STAGE_DAG]
+        self.executor = StagedExecutor(stages, on_stage_done=self.on_stage_done,
+                                        on_done=self.on_done, on_error=self.on_error)
 
+    def make_stage_task(self, stage_name, stage_task, expert):
+        def task(job):
+            stage_timeout = STAGE_TIMEOUTS.get(stage_name)
+            token = CancelToken(job.cancel_token, stage_timeout * job.num_items if stage_timeout else None,
+                                name="stage {}".format(stage_name))
+            # Everything measured by this stage is also summarized under the job's pipeline id,
+            # the frame loops check the token to stop once the job was cancelled or a deadline passed.
+            with METRICS.pipeline_scope(job.pipeline_id), cancel_scope(token):
+                try:
+                    token.check()
+                    if stage_name == "videoprocessing" and self.use_cached_results(job):
+                        return False
+                    stage_task(job.pipeline_id, expert, job.context)
+                    # Videoprocessing and reid can't be interrupted, a late result still fails the job.
+                    token.check()
+                except Exception as e:
+                    # Stops the other running branches of the job as well.
+                    job.cancel_token.cancel("stage {} failed: {}".format(stage_name, e), cause=(stage_name, e))
+                    raise
+                if stage_name == "videoprocessing":
+                    # Get movie id for visual clues, reid and llm.
+                    pipeline_structure = self.pipeline_instance.nre.get_pipeline_structure(job.pipeline_id)
+                    if not pipeline_structure['movies']:
+                        print("No movies were created for pipeline id: {}".format(job.pipeline_id))
+                        return False
+            return True
+        return task
+
+    def use_cached_results(self, job):
+        """
+        Returns True if the results of the job were taken from the result cache.
+        Only image inputs that came from the job queue are cached.
+        """
+        if not self.result_cache or not job.queue_job:
+            return False
+        data = job.context.get_source_image()
+        if data is None:
+            return False
+        job.cache_key = self.result_cache.key(data)
+        entry = self.result_cache.lookup(job.cache_key)
+        if not entry:
+            return False
+        self.result_cache.clone(entry, job.pipeline_id)
+        job.cached = True
+        return True
+
+    def start(self):
+        self.heartbeat.start()
+        self.writer.start()
+        self.executor.start()
+
+    def stop(self):
+        self.executor.stop()
+        self.writer.stop()
+        self.image_fetcher.shutdown(wait=False)
+        self.heartbeat.stop()
+
+    def submit(self, url_link, pipeline_id='', queue_job=None):
+        url_links = (queue_job or {}).get('payload', {}).get('urls')
+        pipeline_id = self.pipeline_instance.init_pipeline(url_link, pipeline_id, url_links)
+        job = PipelineJob(pipeline_id, url_link, queue_job, self.writer, url_links)
+        with self.jobs_lock:
+            self.jobs[pipeline_id] = job
+        # The in memory source image and the result cache only apply to single image jobs.
+        if job.num_items == 1 and self.pipeline_instance.get_input_type(url_link) == "image":
+            self.image_fetcher.submit(fetch_source_image, url_link, job.context)
+        else:
+            job.context.set_source_image(None)
+        if queue_job:
+            self.heartbeat.add(queue_job)
+        self.executor.submit(job)
+        return job
+
+    def cancel(self, pipeline_id, reason="cancelled by request"):
+        """
+        Cancels a job of this runner, its running stages stop at their next check.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(pipeline_id)
+        if job:
+            job.cancel_token.cancel(reason)
+        return job is not None
+
+    def forget(self, job):
+        with self.jobs_lock:
+            self.jobs.pop(job.pipeline_id, None)
+
+    def on_stage_done(self, job, stage_name, elapsed):
+        print("Total time it took for {}: {}".format(stage_name, elapsed))
+        METRICS.observe('pipeline_stage_seconds', elapsed, pipeline_id=job.pipeline_id, stage=stage_name)
+        for name, depth in self.executor.queue_depths().items():
+            METRICS.set_gauge('pipeline_stage_queue_depth', depth, stage=name)
+        METRICS.set_gauge('pipeline_jobs_in_flight', self.executor.in_flight)
+        try:
+            self.pipeline_instance.update_pipeline_status(stage_name, job.pipeline_id if job.queue_job else '')
+        except Exception as e:
+            print("Couldn't update the status of pipeline id: {}, {}".format(job.pipeline_id, e))
+
+    def on_done(self, job):
+        end_time = time.time() - job.start_time
+        METRICS.observe('pipeline_job_seconds', end_time, pipeline_id=job.pipeline_id)
+        METRICS.inc('pipeline_jobs_total', status='done')
+        job.context.persist(self.pipeline_instance.save_metrics, job.pipeline_id, job.num_items)
+        try:
+            # The results are visible to the clients only once all of them are in the database.
+            job.context.flush()
+        except Exception as e:
+            self.on_error(job, "write-behind", e)
+            return
+        if job.cache_key and not job.cached:
+            try:
+                self.result_cache.store(job.cache_key, job.pipeline_id)
+            except Exception as e:
+                print("Couldn't cache the results of pipeline id: {}, {}".format(job.pipeline_id, e))
+        print("Total time it took for whole pipeline: {}".format(end_time))
+        if job.num_items > 1:
+            throughput = job.num_items / end_time if end_time > 0 else 0.0
+            print("Pipeline id: {} processed {} items, {:.2f} items/sec".format(job.pipeline_id, job.num_items, throughput))
+            METRICS.set_gauge('pipeline_throughput_items_per_second', throughput)
+        self.forget(job)
+        if job.queue_job:
+            self.heartbeat.remove(job.queue_job)
+            self.job_queue.complete(job.queue_job)
+            self.pipeline_instance.update_pipeline_status("done", fetching=False)
+        job.finished.set()
+        if self.on_finished:
+            self.on_finished(job)
+
+    def on_error(self, job, stage_name, error):
+        cause = job.cancel_token.cause
+        if isinstance(error, JobCancelled) and cause is not None:
+            # A sibling stage may have recorded the cancellation its failure caused first,
+            # the original failure or timeout decides whether the job is retried.
+            stage_name, error = cause
+        print("Error!!! pipeline id: {} failed in stage {}: {}".format(job.pipeline_id, stage_name, error))
+        METRICS.inc('pipeline_jobs_total', status='failed', stage=stage_name)
+        try:
+            # Don't let writes of this attempt land after a retry of the job started.
+            job.context.flush()
+        except Exception:
+            pass
+        self.forget(job)
+        if job.queue_job:
+            self.heartbeat.remove(job.queue_job)
+            if isinstance(error, JobCancelled) and not error.timed_out:
+                self.job_queue.mark_cancelled(job.queue_job, reason=str(error))
+                status = "cancelled"
+            else:
+                # A job that missed its deadline would most likely miss it again.
+                status = self.job_queue.release(job.queue_job, error="{}: {}".format(stage_name, error),
+                                                retry=not isinstance(error, JobCancelled))
+            try:
+                # A retried job is still fetching, otherwise the legacy document would keep the last stage forever.
+                self.pipeline_instance.update_pipeline_status(status, fetching=status == "queued")
+            except Exception as e:
+                print("Couldn't update the status of pipeline id: {}, {}".format(job.pipeline_id, e))
+        job.finished.set()
+        if self.on_finished:
+            self.on_finished(job)
+
+    def dispatch_loop(self, worker_id, stop_event):
+        """
+        Claims a job only when the first stage has room for it, so a leased job never waits in memory.
+        """
+        while not stop_event.is_set():
+            if not self.executor.wait_for_capacity(stop_event):
+                break
+            queue_job = self.job_queue.claim(worker_id, stop_event)
+            if not queue_job:
+                continue
+            print("Worker {} claimed pipeline id: {}".format(worker_id, queue_job['pipeline_id']))
+            self.submit(queue_job['url_link'], queue_job['pipeline_id'], queue_job)
+
+
+def make_pool_worker(experts):
+    """
+    Returns the main function of a forked worker process, experts were loaded by the supervisor.
+    """
+    def pool_worker_main(worker_idx, job_pipe, done_queue):
+        # The models first run here, after the fork.
+        warmup_experts(experts)
+        # Database connections are never shared with the supervisor.
+        pipeline_instance = InitialPipeline()
+        # Every worker process has its own registry, so each one serves it on its own port.
+        start_metrics_server(METRICS_PORT + 1 + worker_idx)
+        runner = PipelineRunner(pipeline_instance, experts,
+                                on_finished=lambda job: done_queue.put((worker_idx, job.pipeline_id)))
+        runner.start()
+        done_queue.put((worker_idx, None))
+        while True:
+            queue_job = job_pipe.get()
+            if queue_job is None:
+                break
+            runner.submit(queue_job['url_link'], queue_job['pipeline_id'], queue_job)
+        runner.stop()
+    return pool_worker_main
+
+
+def main():
+
+    pipeline_instance = InitialPipeline()
+    readiness = Readiness(pipeline_instance.db)
+    readiness.set_phase("loading")
+    readiness.start_heartbeat()
+    if PIPELINE_WORKER_PROCESSES > 1:
+        limit_supervisor_threads()
+    experts = load_experts()
+    readiness.set_phase("warming_up")
+    if PIPELINE_WORKER_PROCESSES > 1:
+        # No thread may run while the workers fork, the main thread refreshes readiness until they warmed up.
+        readiness.stop_heartbeat()
+        # The workers warm up after the fork, no model may run in the supervisor before it.
+        runner = WorkerPool(make_pool_worker(experts), PIPELINE_WORKER_PROCESSES, max_in_flight=WORKER_MAX_IN_FLIGHT,
+                            fork_guard=readiness.paused)
+        runner.start()
+        runner.wait_ready(on_wait=readiness.touch_if_due)
+        # The respawns of dead workers pause it around their fork.
+        readiness.start_heartbeat()
+        dispatch_args = (pipeline_instance.job_queue, str(uuid.uuid4()))
+    else:
+        warmup_experts(experts)
+        start_metrics_server(METRICS_PORT)
+        runner = PipelineRunner(pipeline_instance, experts)
+        runner.start()
+        dispatch_args = (str(uuid.uuid4()),)
 
     ##########################
     # Clean the document first from previous url and pipeline_id if it wasn't empty.
     pipeline_dict = dict()
-    pipeline_dict["unique_key"] = "123456789"
+    pipeline_dict["unique_key"] = LEGACY_PIPELINE_URL_KEY
     pipeline_dict["url_link"] = ""
     pipeline_dict["pipeline_id"] = ""
     pipeline_dict["fetching"] = False
     pipeline_dict["current_task"] = ""
-    pipeline_instance.nre.write_doc_by_key(doc=pipeline_dict, collection_name="pipeline_url", key_list=['unique_key'])
-
-    while True:
-        time.sleep(1)
-        rc = pipeline_instance.nre.get_doc_by_key({'_key': "123456789"}, "pipeline_url")
-        pipeline_id = ''
-        url_link = ''
-        if rc:
-            url_link = rc["url_link"]
-            if rc["pipeline_id"]: # this is for my web gui
-                pipeline_id = pipeline_instance.init_pipeline(url_link, rc["pipeline_id"])
-            else: # This is for 8032 - it doesnt append pipeline id to the pipeline_url document..
-                pipeline_id = pipeline_instance.init_pipeline(url_link)
-
-
-        if url_link:
-            start_time = time.time() #"5b0c75bf-5fd6-4c1e-9f7e-5f51a9a96bd8")
-            # Necessary for videoprocessing task
-            os.environ['ARANGO_HOST'] = "172.83.9.249"
-            os.environ['EXPERT_RUN_MODE'] = 'task'
-            os.environ['PIPELINE_ID'] = pipeline_id
-            videoprocessing_instance.run_pipeline_task()
-            pipeline_instance.update_pipeline_status("videoprocessing")
-            end_time2 = time.time() - start_time
-            print("Total time it took for videprocessing: {}".format(end_time2))
-            # Get movie id for visual clues, reid and llm.
-            
-            pipeline_structure = pipeline_instance.nre.get_pipeline_structure(pipeline_id)
-            if pipeline_structure['movies']:
-                movie_id = list(pipeline_structure['movies'].keys())[0]
-
-                # run reid
-                start_time_reid = time.time()
-                test_pipeline_task(pipeline_id, reid_instance)
-                pipeline_instance.update_pipeline_status("reid")
-                end_time2 = time.time() - start_time_reid
-                print("Total time it took for REID: {}".format(end_time2))
-
-                # run visual_clues 
-                start_time_visual_clues = time.time()
-                visual_clues_test(visual_clues_instance)
-                pipeline_instance.update_pipeline_status("visual_clues")
-                end_time2 = time.time() - start_time_visual_clues
-                print("Total time it took for Visual Clues: {}".format(end_time2))
-                
-                # run fusion
-                start_time_fusion = time.time()
-                fusion_test()
-                pipeline_instance.update_pipeline_status("fusion")
-                end_time2 = time.time() - start_time_fusion
-                print("Total time it took for FUSION: {}".format(end_time2))
-                
-                # run llm
-                start_time_llm = time.time()
-                llm_test(llm_instance)
-                pipeline_instance.update_pipeline_status("llm")
-                end_time2 = time.time() - start_time_llm
-                print("Total time it took for LLM Task: {}".format(end_time2))
-
-                end_time = time.time() - start_time
-                print("Total time it took for whole pipeline: {}".format(end_time))
-
-            time.sleep(2)
-            rc2 = pipeline_instance.nre.get_doc_by_key({'_key': "123456789"}, "pipeline_url")
-            cur_url_link = rc2["url_link"]
-            pipeline_dict = dict()
-            pipeline_dict["unique_key"] = rc["unique_key"]
-            
-            pipeline_dict["url_link"] = ""
-            pipeline_dict["pipeline_id"] = ""
-            pipeline_dict["fetching"] = False
-            pipeline_dict["current_task"] = "done"
-            pipeline_instance.nre.write_doc_by_key(doc=pipeline_dict, collection_name="pipeline_url", key_list=['unique_key'])
+    upsert_doc(pipeline_instance.db, pipeline_dict, "pipeline_url", key_list=['unique_key'])
 
-        else:
-            print("Waiting for URL...")
+    stop_event = threading.Event()
+    dispatcher = threading.Thread(target=runner.dispatch_loop, args=dispatch_args + (stop_event,),
+                                    name="pipeline-dispatcher", daemon=True)
+    dispatcher.start()
+    readiness.set_phase("ready", workers=PIPELINE_WORKER_PROCESSES)
+
+    try:
+        while True:
+            time.sleep(1)
+            try:
+                pipeline_instance.drain_legacy_submission()
+            except Exception as e:
+                # E.g. the database is briefly unreachable, the next iteration tries again.
+                print("Couldn't check for a legacy submission: {}".format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # The pool workers aren't daemonic, they exit once stop() sent them None and are joined there.
+        readiness.stop()
+        stop_event.set()
+        dispatcher.join()
+        runner.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from doc_store import upsert_doc
+from const_vars import (JOBS_COLLECTION, LEGACY_PIPELINE_URL_KEY, SERVER_CACHE_MAX_ENTRIES, SERVER_CACHE_TTL,
+                        SERVER_CACHE_PENDING_TTL, TRIPLET_GRAPH_CACHE_SIZE)
+
+# Shared by server_con (Flask) and server_con_async (FastAPI).
+
+PROCESSED_IMAGE_URL_PREFIX = "http://74.82.29.209:9000/"
+
+# Status of a queued pipeline, or of the legacy single document if there is no such job.
+PIPELINE_STATUS_QUERY = '''
+LET job = @pipeline_id ? DOCUMENT(@jobs, @pipeline_id) : null
+RETURN job ? job : DOCUMENT('pipeline_url', @legacy_key)
+'''
+
+# The pipeline document, its first movie and the movie's result are resolved in a single round-trip.
+# current_task tells whether the result is final.
+PROCESSED_IMAGE_QUERY = '''
+LET pipeline = DOCUMENT('pipelines', @pipeline_id)
+LET movie_id = FIRST(ATTRIBUTES(pipeline.movies || {}, true))
+LET movie = movie_id ? DOCUMENT(movie_id) : null
+RETURN { movie_id: movie_id, url_path: movie.url_path, current_task: DOCUMENT(@jobs, @pipeline_id).current_task }
+'''
+
+LLM_OUTPUT_QUERY = '''
+LET pipeline = DOCUMENT('pipelines', @pipeline_id)
+LET movie_id = FIRST(ATTRIBUTES(pipeline.movies || {}, true))
+LET llm_output = movie_id ? FIRST(FOR doc IN s4_llm_output FILTER doc.movie_id == movie_id LIMIT 1 RETURN doc) : null
+RETURN { movie_id: movie_id, candidate: llm_output.candidate, triplets: llm_output.triplets,
+         current_task: DOCUMENT(@jobs, @pipeline_id).current_task }
+'''
+
+# Everything the GUI shows for a pipeline, in one round-trip. Visual clues and fusion are joined per frame,
+# fusion stores frame_num as a string. Returns no row for an unknown pipeline.
+PIPELINE_RESULTS_QUERY = '''
+LET job = DOCUMENT(@jobs, @pipeline_id)
+LET pipeline = DOCUMENT('pipelines', @pipeline_id)
+FILTER job != null OR pipeline != null
+LET movie_id = FIRST(ATTRIBUTES(pipeline.movies || {}, true))
+LET movie = movie_id ? DOCUMENT(movie_id) : null
+LET llm_output = movie_id ? FIRST(FOR doc IN s4_llm_output FILTER doc.movie_id == movie_id LIMIT 1 RETURN doc) : null
+LET fusion = movie_id ? (FOR doc IN s4_fusion FILTER doc.movie_id == movie_id RETURN [TO_STRING(doc.frame_num), doc.rois]) : []
+LET fusion_rois = ZIP(fusion[*][0], fusion[*][1])
+LET frames = movie_id ? (
+    FOR clue IN s4_visual_clues
+        FILTER clue.movie_id == movie_id
+        SORT clue.frame_num
+        RETURN { frame_num: clue.frame_num, url: clue.url, global_caption: clue.global_caption.blip,
+                 global_objects: clue.global_objects.blip, global_scenes: clue.global_scenes.blip, roi: clue.roi,
+                 fusion_rois: fusion_rois[TO_STRING(clue.frame_num)] }
+) : []
+RETURN { movie_id: movie_id, url_path: movie.url_path, candidate: llm_output.candidate, triplets: llm_output.triplets,
+         frames: frames, status: job.status, current_task: job.current_task, fetching: job.fetching }
+'''
+
+# The result queries filter these collections by movie_id.
+RESULT_COLLECTIONS = ("s4_llm_output", "s4_visual_clues", "s4_fusion")
+
+def ensure_result_indexes(db):
+    for collection_name in RESULT_COLLECTIONS:
+        if db.has_collection(collection_name):
+            db.collection(collection_name).add_persistent_index(fields=['movie_id'])
+
+def pipeline_status_bind_vars(pipeline_id):
+    return {'pipeline_id': pipeline_id or '', 'jobs': JOBS_COLLECTION, 'legacy_key': LEGACY_PIPELINE_URL_KEY}
+
+def pipeline_results_bind_vars(pipeline_id):
+    return {'pipeline_id': pipeline_id, 'jobs': JOBS_COLLECTION}
+
+def pipeline_result_query(field):
+    if field == 'results':
+        return PIPELINE_RESULTS_QUERY
+    return PROCESSED_IMAGE_QUERY if field == 'image_url' else LLM_OUTPUT_QUERY
+
+def pipeline_result_fields(field, result):
+    """
+    The result fields that the query of field resolves, taken from its row.
+    """
+    fields = {'movie_id': result['movie_id'] if result else None}
+    if field == 'results':
+        # The combined query resolves the single results as well.
+        fields['image_url'] = processed_image_url(result['url_path']) if result else ''
+        fields['candidate'] = (result['candidate'] or '') if result else ''
+        fields['triplets'] = (result['triplets'] or []) if result else []
+        frames = result['frames'] if result else []
+        fields['results'] = {'movie_id': fields['movie_id'], 'image_url': fields['image_url'],
+                             'caption': (frames[0]['global_caption'] or '') if frames else '',
+                             'candidate': fields['candidate'], 'triplets': fields['triplets'], 'frames': frames,
+                             'status': result['status'], 'current_task': result['current_task'],
+                             'fetching': result['fetching']} if result else None
+    elif field == 'image_url':
+        fields['image_url'] = processed_image_url(result['url_path']) if result else ''
+    else:
+        fields['candidate'] = (result['candidate'] or '') if result else ''
+        fields['triplets'] = (result['triplets'] or []) if result else []
+    return fields
+
+def get_request_pipeline_id(request_json):
+    if isinstance(request_json, dict):
+        return request_json.get('pipeline_id', '')
+    if isinstance(request_json, str):
+        return request_json
+    return ''
+
+def image_proxy_url(base_url, image_url):
+    """
+    image_url of the storage node through the server's /image_proxy (base_url ends with "/"),
+    so clients download it from the server's disk cache. Other urls are returned as they are.
+    """
+    if not image_url or not image_url.startswith(PROCESSED_IMAGE_URL_PREFIX):
+        return image_url
+    return "{}image_proxy?{}".format(base_url, urlencode({'url': image_url}))
+
+def proxied_results(base_url, results):
+    """
+    The /results payload with its image and frame urls going through /image_proxy,
+    storage_image_url keeps the url on the storage node.
+    """
+    frames = [dict(frame, url=image_proxy_url(base_url, frame['url'])) for frame in results['frames']]
+    return dict(results, image_url=image_proxy_url(base_url, results['image_url']),
+                storage_image_url=results['image_url'], frames=frames)
+
+def mark_legacy_fetching(db):
+    """
+    A submission reports fetching on the legacy "pipeline_url" document right away,
+    clients that wait for fetching to become false would otherwise stop before a worker claimed the job.
+    """
+    upsert_doc(db, {'unique_key': LEGACY_PIPELINE_URL_KEY, 'fetching': True, 'current_task': ''},
+               "pipeline_url", key_list=['unique_key'])
+
+def processed_image_url(url_path):
+    """
+    Public url of a movie's url_path on the storage server.
+    """
+    return os.path.join(PROCESSED_IMAGE_URL_PREFIX, url_path[1:]) if url_path else ''
+
+
+class PipelineResultCache:
+    """
+    Read-through LRU of the resolved results of polled pipelines (movie_id, image_url, candidate, triplets),
+    keyed by pipeline_id.
+    The results of a finished pipeline are kept for ttl seconds, the ones read while it was still running
+    for pending_ttl seconds, and are dropped as soon as a status poll sees that it became done.
+    """
+    def __init__(self, max_entries=SERVER_CACHE_MAX_ENTRIES, ttl=SERVER_CACHE_TTL, pending_ttl=SERVER_CACHE_PENDING_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, pipeline_id, field):
+        """
+        Returns (hit, value) of one field of a pipeline's results.
+        """
+        with self.lock:
+            entry = self.entries.get(pipeline_id)
+            if entry is None or field not in entry['fields']:
+                return False, None
+            value, expires_at = entry['fields'][field]
+            if expires_at < time.time():
+                del entry['fields'][field]
+                return False, None
+            self.entries.move_to_end(pipeline_id)
+            return True, value
+
+    def put(self, pipeline_id, current_task, **fields):
+        done = current_task == "done"
+        expires_at = time.time() + (self.ttl if done else self.pending_ttl)
+        with self.lock:
+            entry = self.entries.get(pipeline_id)
+            if entry is None or entry['done'] != done:
+                entry = self.entries[pipeline_id] = {'done': done, 'fields': {}}
+            entry['fields'].update((field, (value, expires_at)) for field, value in fields.items())
+            self.entries.move_to_end(pipeline_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def on_status(self, pipeline_id, current_task):
+        """
+        Called with every polled status, drops the results read before the pipeline finished.
+        """
+        if current_task != "done":
+            return
+        with self.lock:
+            entry = self.entries.get(pipeline_id)
+            if entry is not None and not entry['done']:
+                del self.entries[pipeline_id]
+
+
+TRIPLET_COLORS = ('#e04141', '#e09c41', '#e0df41')    # subject, predicate, object
+
+def build_triplet_graph(triplets):
+    """
+    Graph of (subject, predicate, object) triplets, a node per distinct label and an edge per distinct pair.
+    A label keeps the color of the position it was first seen in.
+    """
+    nodes = []
+    edges = []
+    node_ids = {}
+    edge_keys = set()
+    for triplet in triplets:
+        ids = []
+        for position, label in enumerate(triplet[:3]):
+            if label not in node_ids:
+                node_ids[label] = len(nodes)
+                nodes.append({'id': node_ids[label], 'label': label, 'color': TRIPLET_COLORS[position]})
+            ids.append(node_ids[label])
+        for edge in zip(ids, ids[1:]):
+            if edge not in edge_keys:
+                edge_keys.add(edge)
+                edges.append({'from': edge[0], 'to': edge[1]})
+    return {'graph': {'nodes': nodes, 'edges': edges}}
+
+
+_graph_cache = OrderedDict()
+_graph_cache_lock = threading.Lock()
+
+def get_triplet_graph(movie_id, triplets):
+    """
+    build_triplet_graph memoized per movie_id and triplets, a movie that is processed again may get other triplets.
+    """
+    key = (movie_id, hashlib.sha256(json.dumps(triplets, sort_keys=True).encode()).hexdigest())
+    with _graph_cache_lock:
+        graph = _graph_cache.get(key)
+        if graph is not None:
+            _graph_cache.move_to_end(key)
+            return graph
+    graph = build_triplet_graph(triplets)
+    with _graph_cache_lock:
+        _graph_cache[key] = graph
+        while len(_graph_cache) > TRIPLET_GRAPH_CACHE_SIZE:
+            _graph_cache.popitem(last=False)
+    return graph
@@ -1,12 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 
 from typing import List
 from flask_arango import Arango
 from arango import ArangoClient
 import uuid
-import os
-import json
+from const_vars import LEGACY_PIPELINE_URL_KEY
+from job_queue import JobQueue
+from readiness import get_readiness
+from admission import AdmissionController
+from image_cache import ImageDiskCache, IMAGE_SIZES, image_content_type, is_storage_url, cache_headers, etag_matches
+from pipeline_metrics import METRICS
+from server_common import (PipelineResultCache, pipeline_results_bind_vars, pipeline_result_query, pipeline_result_fields,
+                            get_request_pipeline_id, get_triplet_graph, ensure_result_indexes, mark_legacy_fetching,
+                            image_proxy_url, proxied_results, PROCESSED_IMAGE_URL_PREFIX)
 # Configuration
 arango_host = "http://172.83.9.249:8529"
 dbname = 'ipc_200'
@@ -16,69 +23,44 @@ app.config.from_object(__name__)
 arango = Arango(app)
 cors = CORS(app)
 
-wf_template = {
-    "movies": {},
-    "tasks": {},
-    "inputs": {
-        "videoprocessing": {
-            "is_async": 'true',
-            "movies": [{"movie_id": "", "url": '', "type": "image"}],
-            "output": "db",
-            "overwrite": 'true',
-            "save_movies": 'true'
-        }
-    }
-}
-
-triplets_graph = {
-    'graph': {
-        'nodes': [
-
-        ],
-        'edges': [
-
-        ],
-    }
-}
-
-node_to_index = dict()
-
 client = ArangoClient(hosts=arango_host)
 db = client.db(dbname, username='nebula', password='nebula')
+job_queue = JobQueue(db)
+ensure_result_indexes(db)
+result_cache = PipelineResultCache()
+admission = AdmissionController(db)
+image_cache = ImageDiskCache()
 
 teset = dict()
 
-def get_pipeline_data():
+def get_pipeline_data(pipeline_id=''):
+    """
+    Returns the status of a queued pipeline, or of the legacy single document if no pipeline_id is given.
+    """
     pipeline_structure = None
-    pipeline_structure = get_doc_by_key({'_key': '123456789'}, "pipeline_url")
+    if pipeline_id:
+        pipeline_structure = job_queue.get_job(pipeline_id)
+    if not pipeline_structure:
+        pipeline_structure = get_doc_by_key({'_key': LEGACY_PIPELINE_URL_KEY}, "pipeline_url")
+    elif pipeline_id:
+        result_cache.on_status(pipeline_id, pipeline_structure.get('current_task'))
     return pipeline_structure
 
-def get_processed_image_url(movie_id):
-    movie_structure = get_doc_by_key({'_id': movie_id}, "Movies")
-    url_path = ''
-    if movie_structure:
-        postfix_url_path = movie_structure["url_path"][1:]
-        prefix_url_path = "http://74.82.29.209:9000/"
-        url_path = os.path.join(prefix_url_path, postfix_url_path)
-        print("Retrieved URL Path: {}".format(url_path))
-    return url_path
-
-def get_llm_generated_text(movie_id):
-    llm_structure = get_doc_by_key({'movie_id': movie_id}, "s4_llm_output")
-    candidate = ''
-    if llm_structure:
-        candidate = llm_structure["candidate"]
-        print("Retrieved Candidate: {}".format(candidate))
-    return candidate
-
-def get_llm_generated_triplets(movie_id):
-    llm_structure = get_doc_by_key({'movie_id': movie_id}, "s4_llm_output")
-    triplets = ''
-    if llm_structure:
-        triplets = llm_structure["triplets"]
-        print("Retrieved Triplets: (Showing just first one) {}".format(triplets[0]))
-    return triplets
-
+def get_pipeline_result(pipeline_id, field):
+    """
+    Reads one of the resolved results of a pipeline through result_cache.
+    """
+    hit, value = result_cache.get(pipeline_id, field)
+    if hit:
+        METRICS.inc('server_result_cache_lookups_total', result='hit')
+        return value
+    METRICS.inc('server_result_cache_lookups_total', result='miss')
+    results = list(db.aql.execute(pipeline_result_query(field), bind_vars=pipeline_results_bind_vars(pipeline_id)))
+    result = results[0] if results else None
+    fields = pipeline_result_fields(field, result)
+    if result:
+        result_cache.put(pipeline_id, result['current_task'], **fields)
+    return fields[field]
 
 # d07d980c-1c55-430f-8f6c-52953e918226
 def get_doc_by_key2(key_dict: dict, collection: str) -> List:
@@ -91,164 +73,163 @@ def get_doc_by_key(*args, **kwargs) -> dict:
     else:
         return None
 
-def get_movie_id(pipeline_id):
-    pipeline_structure = get_doc_by_key({'_key': pipeline_id}, "pipelines")
-    movies = ''
-    if pipeline_structure:
-        movies = pipeline_structure["movies"]
-    movie_id = ''
-    if movies:
-        movie_id = list(movies.keys())[0]
-        print("Retrieved Movie ID: {}".format(movie_id))
-    else:
-        print("Couldn't retrieve Movie ID!")
-    return movie_id
-
-def update_db_with_new_data(url_link, pipeline_id):
-    pipeline_dict = dict()
-    pipeline_dict["unique_key"] = "123456789"
-    pipeline_dict["url_link"] = url_link
-    pipeline_dict["pipeline_id"] = pipeline_id
-    pipeline_dict["fetching"] = True
-    write_doc_by_key(db=db, doc=pipeline_dict, collection_name="pipeline_url", key_list=['unique_key'])
-    print("Added to DB for fast image processing.")
-
-def create_graph(triplets):
-    counter = 0
-
-    for tripletIdx, triplet in enumerate(triplets):
-        # Add all the nodes and its edges to the triplets graph
-        if triplet[0] not in node_to_index:
-            node_to_index[triplet[0]] = tripletIdx
-            triplets_graph["graph"]["nodes"].append(
-                {'id': counter, 'label': triplet[0], 'color': '#e04141'}
-            )
-            triplets_graph["graph"]["nodes"].append(
-                {'id': counter + 1, 'label': triplet[1], 'color': '#e09c41'}
-            )
-            triplets_graph["graph"]["nodes"].append(
-                {'id': counter + 2, 'label': triplet[2], 'color': '#e0df41'}
-            )
-            triplets_graph["graph"]["edges"].append(
-                {'from': counter, 'to': counter + 1}
-            )
-            triplets_graph["graph"]["edges"].append(
-                {'from': counter + 1, 'to': counter + 2}
-            )
-            counter += 3
-        else:  # Add only second and third node, and append the edges of the node which is already found.
-            node_triple_idx = node_to_index[triplet[0]]
-            triplets_graph["graph"]["nodes"].append(
-                {'id': counter, 'label': triplet[1], 'color': '#e09c41'}
-            )
-            triplets_graph["graph"]["nodes"].append(
-                {'id': counter + 1, 'label': triplet[2], 'color': '#e0df41'}
-            )
-            triplets_graph["graph"]["edges"].append(
-                {'from': node_triple_idx, 'to': counter}
-            )
-            triplets_graph["graph"]["edges"].append(
-                {'from': counter, 'to': counter + 1}
-            )
-            counter += 2
-    return triplets_graph
-    
-    
-
-
-def write_doc_by_key(db, doc , collection_name: str, overwrite : bool = True, key_list: List = []) -> bool:
-        if not db.has_collection(collection_name):
-            db.create_collection(collection_name)
-        collection = db.collection(collection_name)        
-        key_dict = {k: doc[k] for k in key_list}
-        curr_doc = collection.find(key_dict) if key_dict else None
-        if not curr_doc:           
-            result = collection.insert(doc)
-            return result, True
-        assert len(curr_doc) <= 1
-        if curr_doc and overwrite:   #update doc that exists
-            curr_doc = curr_doc.pop()
-            update_doc = {**curr_doc, **doc}
-            result = collection.update(update_doc)
-            return result, True
-
 @app.route('/get_fetching_status', methods=["POST"])
 def get_fetching_status_():
     if request.method == 'POST':
-        test = request.get_json(force=True)
-        pipeline_data = get_pipeline_data()
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
+        pipeline_data = get_pipeline_data(pipeline_id)
         fetching_status = pipeline_data['fetching']
     return jsonify(fetching_status = fetching_status)
 
 @app.route('/get_task_status', methods=["POST"])
 def get_task_status_():
     if request.method == 'POST':
-        test = request.get_json(force=True)
-        pipeline_data = get_pipeline_data()
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
+        pipeline_data = get_pipeline_data(pipeline_id)
         current_task = pipeline_data['current_task']
     return jsonify(current_task = current_task)
     
+def reject_submission(estimate):
+    """
+    429 for a submission that wouldn't finish within ADMISSION_SLO_SECONDS.
+    """
+    print("Rejected a submission, estimated to finish in {} seconds".format(estimate['estimated_seconds']))
+    return (jsonify(error = "the pipeline is overloaded, try again later", slo_seconds = admission.slo, **estimate), 429,
+            {'Retry-After': str(admission.retry_after(estimate))})
+
 @app.route('/insert_pipeline_id', methods=["POST", "GET"])
 def insert_pipeline_id_():
     if request.method == 'POST':
         url_link_json = request.get_json(force=True)
         url_link = url_link_json['urlLink']
         print("Recieved URL Link: {}".format(url_link))
-        pipeline_entry = wf_template
-        pipeline_entry['inputs']['videoprocessing']['movies'][0]["url"] = url_link
-        pipeline_entry['id'] = str(uuid.uuid4())
-        pipeline_entry['_key'] = pipeline_entry['id']
-        print(pipeline_entry)
-        # db.collection("pipelines").insert(pipeline_entry)
-        print("Successfully inserted pipeline id: {} to database.".format(pipeline_entry['id']))
-        update_db_with_new_data(url_link, pipeline_entry['id'])
-
-        # get_movie_id(pipeline_entry['id'])
-    
-    return jsonify(pipeline_id = pipeline_entry['id'])
-
+        admitted, estimate = admission.admit()
+        if not admitted:
+            return reject_submission(estimate)
+        pipeline_id = job_queue.enqueue(url_link, str(uuid.uuid4()))
+        mark_legacy_fetching(db)
+        print("Successfully enqueued pipeline id: {} to database.".format(pipeline_id))
+
+    return jsonify(pipeline_id = pipeline_id, **estimate)
+
+@app.route('/insert_dataset', methods=["POST"])
+def insert_dataset_():
+    """
+    Runs a list of urls as one pipeline, so the models process their frames in batches.
+    """
+    if request.method == 'POST':
+        url_links = request.get_json(force=True).get('urlLinks', [])
+        if not url_links:
+            return jsonify(error = "urlLinks is empty"), 400
+        print("Recieved {} URL Links".format(len(url_links)))
+        admitted, estimate = admission.admit(len(url_links))
+        if not admitted:
+            return reject_submission(estimate)
+        pipeline_id = job_queue.enqueue_dataset(url_links, str(uuid.uuid4()))
+        mark_legacy_fetching(db)
+        print("Successfully enqueued dataset pipeline id: {} to database.".format(pipeline_id))
+    return jsonify(pipeline_id = pipeline_id, **estimate)
+
+@app.route('/readiness', methods=["GET"])
+def readiness_():
+    """
+    ready is true once at least one pipeline process loaded and warmed up its models.
+    """
+    return jsonify(**get_readiness(db))
+
+@app.route('/cancel_pipeline', methods=["POST"])
+def cancel_pipeline_():
+    """
+    Cancels a queued or running pipeline, a running one stops within a few seconds.
+    """
+    if request.method == 'POST':
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
+        cancelled = job_queue.cancel(pipeline_id) if pipeline_id else False
+    return jsonify(cancelled = cancelled)
+
+@app.route('/results/<pipeline_id>', methods=["GET"])
+def results_(pipeline_id):
+    """
+    Image url, caption, candidate, triplet graph, per-frame clues and status of a pipeline, read in one query.
+    """
+    results = get_pipeline_result(pipeline_id, 'results')
+    if results is None:
+        return jsonify(error = "unknown pipeline id: {}".format(pipeline_id)), 404
+    triplets = get_triplet_graph(results['movie_id'], results['triplets']) if results['triplets'] else []
+    return jsonify(**dict(proxied_results(request.host_url, results), triplets = triplets))
+
+def send_cached_image(image_url, size):
+    """
+    Serves an image of the storage node through image_cache, size is "full" or "thumbnail".
+    """
+    if size not in IMAGE_SIZES:
+        return jsonify(error = "size must be one of {}".format(", ".join(IMAGE_SIZES))), 400
+    if not image_url:
+        return jsonify(error = "image not found"), 404
+    try:
+        blob, etag = image_cache.get(image_url, size)
+    except Exception as e:
+        print("Couldn't fetch image: {}, {}".format(image_url, e))
+        return jsonify(error = "couldn't fetch the image"), 502
+    headers = cache_headers(etag)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        blob.close()
+        return '', 304, headers
+    # send_file closes the blob once it was sent.
+    response = send_file(blob, mimetype=image_content_type(image_url, size), conditional=False, etag=False)
+    response.headers.update(headers)
+    return response
+
+@app.route('/image/<pipeline_id>', methods=["GET"])
+def image_(pipeline_id):
+    """
+    The processed image of a pipeline, ?size=thumbnail for a resized one.
+    """
+    return send_cached_image(get_pipeline_result(pipeline_id, 'image_url'), request.args.get('size', 'full'))
+
+@app.route('/image_proxy', methods=["GET"])
+def image_proxy_():
+    """
+    Any image of the storage node, e.g. the frames in /results, ?url=...&size=thumbnail.
+    """
+    image_url = request.args.get('url', '')
+    if not is_storage_url(image_url, PROCESSED_IMAGE_URL_PREFIX):
+        return jsonify(error = "only images of {} are proxied".format(PROCESSED_IMAGE_URL_PREFIX)), 400
+    return send_cached_image(image_url, request.args.get('size', 'full'))
 
 @app.route('/get_generated_caption_url', methods=["POST"])
 def get_generated_caption_url_():
     if request.method == 'POST':
-        movie_id = ''
-        pipeline_id = request.get_json(force=True)
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
         print("Pipeline ID to get Movies: {}".format(pipeline_id))
-        if pipeline_id:
-            movie_id = get_movie_id(pipeline_id)
         image_url = ''
-        if movie_id:
-            image_url = get_processed_image_url(movie_id)
-            print(image_url)
-    return jsonify(image_url = image_url)
+        if pipeline_id:
+            image_url = get_pipeline_result(pipeline_id, 'image_url')
+            print("Retrieved URL Path: {}".format(image_url))
+    # Clients load the image through the server's cache, not from the storage node.
+    return jsonify(image_url = image_proxy_url(request.host_url, image_url), storage_image_url = image_url)
 
 @app.route('/get_generated_triplets', methods=["POST"])
 def indeget_generated_triplets_():
     if request.method == 'POST':
-        pipeline_id = request.get_json(force=True)
-        movie_id = ''
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
         print("Pipeline ID to get Movies: {}".format(pipeline_id))
-        if pipeline_id:
-            movie_id = get_movie_id(pipeline_id)
         triplets = []
-        if movie_id:
-            triplets = get_llm_generated_triplets(movie_id)
+        if pipeline_id:
+            triplets = get_pipeline_result(pipeline_id, 'triplets')
             if triplets:
-                triplets = create_graph(triplets)
+                triplets = get_triplet_graph(get_pipeline_result(pipeline_id, 'movie_id'), triplets)
     return jsonify(triplets = triplets)
 
 @app.route('/get_generated_text', methods=["POST"])
 def get_generated_text_():
     if request.method == 'POST':
-        pipeline_id = request.get_json(force=True)
-        movie_id = ''
+        pipeline_id = get_request_pipeline_id(request.get_json(force=True, silent=True))
         print("Pipeline ID to get Movies: {}".format(pipeline_id))
-        if pipeline_id:
-            movie_id = get_movie_id(pipeline_id)
         candidate = ''
-        if movie_id:
-            candidate = get_llm_generated_text(movie_id)
-        print(candidate)
+        if pipeline_id:
+            candidate = get_pipeline_result(pipeline_id, 'candidate')
+        print("Retrieved Candidate: {}".format(candidate))
     return jsonify(candidate = candidate)
 
 if __name__ == "__main__":
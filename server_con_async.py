@@ -0,0 +1,278 @@
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import uvicorn
+from arango import ArangoClient
+from arango.http import DefaultHTTPClient
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from const_vars import SERVER_DB_POOL_SIZE
+from job_queue import JobQueue
+from pipeline_metrics import METRICS
+from readiness import get_readiness
+from admission import AdmissionController
+from image_cache import ImageDiskCache, IMAGE_SIZES, image_content_type, is_storage_url, cache_headers, etag_matches
+from status_stream import StatusBroadcaster, status_events
+from server_common import (PIPELINE_STATUS_QUERY, PipelineResultCache, pipeline_status_bind_vars,
+                            pipeline_results_bind_vars, pipeline_result_query, pipeline_result_fields,
+                            get_request_pipeline_id, get_triplet_graph, ensure_result_indexes, mark_legacy_fetching,
+                            image_proxy_url, proxied_results, PROCESSED_IMAGE_URL_PREFIX)
+# Configuration
+arango_host = "http://172.83.9.249:8529"
+dbname = 'ipc_200'
+
+
+class PooledDatabase:
+    """
+    Runs the blocking python-arango calls on a bounded thread pool, so the event loop keeps serving other requests.
+    All threads share one HTTP session with pool_size keep-alive connections.
+    """
+    def __init__(self, hosts, dbname, username, password, pool_size=SERVER_DB_POOL_SIZE):
+        self.client = ArangoClient(hosts=hosts, http_client=DefaultHTTPClient(pool_connections=pool_size,
+                                                                              pool_maxsize=pool_size))
+        self.db = self.client.db(dbname, username=username, password=password)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="arango")
+
+    async def run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    def _query(self, op, query, bind_vars):
+        with METRICS.db_roundtrip(op):
+            return list(self.db.aql.execute(query, bind_vars=bind_vars))
+
+    async def query(self, op, query, **bind_vars):
+        return await self.run(self._query, op, query, bind_vars)
+
+    async def query_one(self, op, query, **bind_vars):
+        results = await self.query(op, query, **bind_vars)
+        return results[0] if results else None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+
+app = FastAPI()
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+pool = None
+job_queue = None
+result_cache = PipelineResultCache()
+image_cache = ImageDiskCache()
+status_broadcaster = None
+admission = None
+
+@app.on_event("startup")
+async def startup():
+    global pool, job_queue, status_broadcaster, admission
+    pool = PooledDatabase(arango_host, dbname, 'nebula', 'nebula')
+    job_queue = await pool.run(JobQueue, pool.db)
+    await pool.run(ensure_result_indexes, pool.db)
+    admission = AdmissionController(pool.db)
+    status_broadcaster = StatusBroadcaster(pool.query, on_status=result_cache.on_status)
+    status_broadcaster.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    status_broadcaster.stop()
+    pool.close()
+
+async def get_request_json(request, silent=False):
+    try:
+        return await request.json()
+    except ValueError:
+        if silent:
+            return None
+        raise
+
+async def get_pipeline_data(pipeline_id=''):
+    """
+    Returns the status of a queued pipeline, or of the legacy single document if no pipeline_id is given.
+    """
+    pipeline_data = await pool.query_one('pipeline_status', PIPELINE_STATUS_QUERY, **pipeline_status_bind_vars(pipeline_id))
+    if pipeline_id and pipeline_data:
+        result_cache.on_status(pipeline_id, pipeline_data.get('current_task'))
+    return pipeline_data
+
+async def get_pipeline_result(pipeline_id, field):
+    """
+    Reads one of the resolved results of a pipeline through result_cache.
+    """
+    hit, value = result_cache.get(pipeline_id, field)
+    if hit:
+        METRICS.inc('server_result_cache_lookups_total', result='hit')
+        return value
+    METRICS.inc('server_result_cache_lookups_total', result='miss')
+    result = await pool.query_one('pipeline_result', pipeline_result_query(field), **pipeline_results_bind_vars(pipeline_id))
+    fields = pipeline_result_fields(field, result)
+    if result:
+        result_cache.put(pipeline_id, result['current_task'], **fields)
+    return fields[field]
+
+@app.post('/get_fetching_status')
+async def get_fetching_status_(request: Request):
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    pipeline_data = await get_pipeline_data(pipeline_id)
+    return {'fetching_status': pipeline_data['fetching']}
+
+@app.post('/get_task_status')
+async def get_task_status_(request: Request):
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    pipeline_data = await get_pipeline_data(pipeline_id)
+    return {'current_task': pipeline_data['current_task']}
+
+@app.get('/status_stream/{pipeline_id}')
+async def status_stream_(pipeline_id: str, request: Request):
+    """
+    Server-Sent Events with the status, current_task and fetching of a pipeline, sent whenever one of them changes.
+    Replaces polling /get_task_status and /get_fetching_status, the stream ends once the pipeline finished.
+    """
+    return StreamingResponse(status_events(status_broadcaster, pipeline_id, request.is_disconnected),
+                             media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+def reject_submission(estimate):
+    """
+    429 for a submission that wouldn't finish within ADMISSION_SLO_SECONDS.
+    """
+    print("Rejected a submission, estimated to finish in {} seconds".format(estimate['estimated_seconds']))
+    return JSONResponse(dict(estimate, error="the pipeline is overloaded, try again later", slo_seconds=admission.slo),
+                        status_code=429, headers={'Retry-After': str(admission.retry_after(estimate))})
+
+@app.post('/insert_pipeline_id')
+async def insert_pipeline_id_(request: Request):
+    url_link = (await get_request_json(request))['urlLink']
+    print("Recieved URL Link: {}".format(url_link))
+    admitted, estimate = await pool.run(admission.admit)
+    if not admitted:
+        return reject_submission(estimate)
+    pipeline_id = await pool.run(job_queue.enqueue, url_link, str(uuid.uuid4()))
+    await pool.run(mark_legacy_fetching, pool.db)
+    print("Successfully enqueued pipeline id: {} to database.".format(pipeline_id))
+    return dict(estimate, pipeline_id=pipeline_id)
+
+@app.post('/insert_dataset')
+async def insert_dataset_(request: Request):
+    """
+    Runs a list of urls as one pipeline, so the models process their frames in batches.
+    """
+    url_links = (await get_request_json(request)).get('urlLinks', [])
+    if not url_links:
+        return JSONResponse({'error': "urlLinks is empty"}, status_code=400)
+    print("Recieved {} URL Links".format(len(url_links)))
+    admitted, estimate = await pool.run(admission.admit, len(url_links))
+    if not admitted:
+        return reject_submission(estimate)
+    pipeline_id = await pool.run(job_queue.enqueue_dataset, url_links, str(uuid.uuid4()))
+    await pool.run(mark_legacy_fetching, pool.db)
+    print("Successfully enqueued dataset pipeline id: {} to database.".format(pipeline_id))
+    return dict(estimate, pipeline_id=pipeline_id)
+
+@app.get('/readiness')
+async def readiness_():
+    """
+    ready is true once at least one pipeline process loaded and warmed up its models.
+    """
+    return await pool.run(get_readiness, pool.db)
+
+@app.post('/cancel_pipeline')
+async def cancel_pipeline_(request: Request):
+    """
+    Cancels a queued or running pipeline, a running one stops within a few seconds.
+    """
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    cancelled = await pool.run(job_queue.cancel, pipeline_id) if pipeline_id else False
+    return {'cancelled': cancelled}
+
+@app.get('/results/{pipeline_id}')
+async def results_(pipeline_id: str, request: Request):
+    """
+    Image url, caption, candidate, triplet graph, per-frame clues and status of a pipeline, read in one query.
+    """
+    results = await get_pipeline_result(pipeline_id, 'results')
+    if results is None:
+        return JSONResponse({'error': "unknown pipeline id: {}".format(pipeline_id)}, status_code=404)
+    triplets = get_triplet_graph(results['movie_id'], results['triplets']) if results['triplets'] else []
+    return dict(proxied_results(str(request.base_url), results), triplets=triplets)
+
+def read_cached_image(image_url, size, if_none_match):
+    """
+    Returns the bytes of a cached image (None if the client's copy is current) and its ETag.
+    """
+    blob, etag = image_cache.get(image_url, size)
+    with blob:
+        return (None if etag_matches(if_none_match, etag) else blob.read()), etag
+
+async def send_cached_image(request, image_url, size):
+    """
+    Serves an image of the storage node through image_cache, size is "full" or "thumbnail".
+    """
+    if size not in IMAGE_SIZES:
+        return JSONResponse({'error': "size must be one of {}".format(", ".join(IMAGE_SIZES))}, status_code=400)
+    if not image_url:
+        return JSONResponse({'error': "image not found"}, status_code=404)
+    try:
+        # Downloads and resizing block, so they don't run on the event loop.
+        data, etag = await asyncio.to_thread(read_cached_image, image_url, size, request.headers.get('if-none-match'))
+    except Exception as e:
+        print("Couldn't fetch image: {}, {}".format(image_url, e))
+        return JSONResponse({'error': "couldn't fetch the image"}, status_code=502)
+    headers = cache_headers(etag)
+    if data is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=image_content_type(image_url, size), headers=headers)
+
+@app.get('/image/{pipeline_id}')
+async def image_(pipeline_id: str, request: Request, size: str = 'full'):
+    """
+    The processed image of a pipeline, ?size=thumbnail for a resized one.
+    """
+    return await send_cached_image(request, await get_pipeline_result(pipeline_id, 'image_url'), size)
+
+@app.get('/image_proxy')
+async def image_proxy_(request: Request, url: str = '', size: str = 'full'):
+    """
+    Any image of the storage node, e.g. the frames in /results, ?url=...&size=thumbnail.
+    """
+    if not is_storage_url(url, PROCESSED_IMAGE_URL_PREFIX):
+        return JSONResponse({'error': "only images of {} are proxied".format(PROCESSED_IMAGE_URL_PREFIX)}, status_code=400)
+    return await send_cached_image(request, url, size)
+
+@app.post('/get_generated_caption_url')
+async def get_generated_caption_url_(request: Request):
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    print("Pipeline ID to get Movies: {}".format(pipeline_id))
+    image_url = ''
+    if pipeline_id:
+        image_url = await get_pipeline_result(pipeline_id, 'image_url')
+        print("Retrieved URL Path: {}".format(image_url))
+    # Clients load the image through the server's cache, not from the storage node.
+    return {'image_url': image_proxy_url(str(request.base_url), image_url), 'storage_image_url': image_url}
+
+@app.post('/get_generated_triplets')
+async def get_generated_triplets_(request: Request):
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    print("Pipeline ID to get Movies: {}".format(pipeline_id))
+    triplets = []
+    if pipeline_id:
+        triplets = await get_pipeline_result(pipeline_id, 'triplets')
+        if triplets:
+            triplets = get_triplet_graph(await get_pipeline_result(pipeline_id, 'movie_id'), triplets)
+    return {'triplets': triplets}
+
+@app.post('/get_generated_text')
+async def get_generated_text_(request: Request):
+    pipeline_id = get_request_pipeline_id(await get_request_json(request, silent=True))
+    print("Pipeline ID to get Movies: {}".format(pipeline_id))
+    candidate = ''
+    if pipeline_id:
+        candidate = await get_pipeline_result(pipeline_id, 'candidate')
+        print("Retrieved Candidate: {}".format(candidate))
+    return {'candidate': candidate}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from const_vars import STAGE_QUEUE_SIZE
+
+class Stage:
+    """
+    A pipeline stage, task(job) is called by the stage's own worker thread(s).
+    depends_on lists the stages whose output this stage needs, a stage without dependencies starts the job.
+    A task that returns False ends the job early without running the stages that depend on it.
+    """
+    def __init__(self, name, task, depends_on=(), workers=1, queue_size=STAGE_QUEUE_SIZE):
+        self.name = name
+        self.task = task
+        self.depends_on = set(depends_on)
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+
+
+class JobState:
+    def __init__(self):
+        self.scheduled = set()
+        self.completed = set()
+        self.active = 0
+        self.stopped = False
+        self.error = None
+        self.failed_stage = None
+
+
+class StagedExecutor:
+    """
+    Runs jobs through a DAG of stages, each stage has a bounded input queue and its own workers.
+    A stage starts as soon as all the stages it depends on finished for that job, so independent
+    stages of one job run concurrently, and different jobs can be in different stages at the same time.
+    A full queue blocks the stage before it, so the number of jobs in flight stays bounded.
+    on_done and on_error run on a completion thread of their own, so their database writes
+    don't hold up the worker of the stage that finished the job.
+    """
+    def __init__(self, stages, on_stage_done=None, on_done=None, on_error=None):
+        self.stages = stages
+        self.stages_by_name = {}
+        for stage in stages:
+            missing = stage.depends_on - set(self.stages_by_name)
+            if missing:
+                raise ValueError("Stage {} depends on unknown or later stages: {}".format(stage.name, missing))
+            self.stages_by_name[stage.name] = stage
+        self.root_stages = [stage for stage in stages if not stage.depends_on]
+        self.on_stage_done = on_stage_done
+        self.on_done = on_done
+        self.on_error = on_error
+        self.threads = []
+        self.stop_event = threading.Event()
+        self.job_states = {}
+        self.lock = threading.Lock()
+        self.completions = queue.Queue()
+        self.completion_thread = None
+
+    @property
+    def in_flight(self):
+        return len(self.job_states)
+
+    def start(self):
+        for stage in self.stages:
+            for worker_idx in range(stage.workers):
+                thread = threading.Thread(target=self._stage_loop, args=(stage,), daemon=True,
+                                            name="stage-{}-{}".format(stage.name, worker_idx))
+                thread.start()
+                self.threads.append(thread)
+        self.completion_thread = threading.Thread(target=self._completion_loop, daemon=True, name="stage-completion")
+        self.completion_thread.start()
+
+    def submit(self, job):
+        """
+        Adds a job to the first stages, blocks while their queues are full.
+        """
+        state = JobState()
+        with self.lock:
+            self.job_states[id(job)] = state
+            state.scheduled.update(stage.name for stage in self.root_stages)
+            state.active += len(self.root_stages)
+        for stage in self.root_stages:
+            self._put(stage.queue, job)
+
+    def has_capacity(self):
+        return not any(stage.queue.full() for stage in self.root_stages)
+
+    def wait_for_capacity(self, stop_event=None, interval=0.05):
+        while not self.has_capacity():
+            if stop_event and stop_event.wait(interval):
+                return False
+            elif not stop_event:
+                time.sleep(interval)
+        return True
+
+    def queue_depths(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def report(self):
+        depths = ', '.join("{}: {}".format(name, depth) for name, depth in self.queue_depths().items())
+        print("Stage queue depths: {} (jobs in flight: {})".format(depths, self.in_flight))
+
+    def _stage_finished(self, job, stage, result=True, error=None):
+        """
+        Records the outcome of a stage, returns the stages that became ready to run for this job
+        and whether the job is finished.
+        """
+        ready = []
+        with self.lock:
+            state = self.job_states[id(job)]
+            state.active -= 1
+            if error is not None:
+                if state.error is None:
+                    state.error = error
+                    state.failed_stage = stage.name
+                state.stopped = True
+            elif result is False:
+                state.stopped = True
+            else:
+                state.completed.add(stage.name)
+            if not state.stopped:
+                for next_stage in self.stages:
+                    if next_stage.name not in state.scheduled and next_stage.depends_on <= state.completed:
+                        state.scheduled.add(next_stage.name)
+                        ready.append(next_stage)
+                state.active += len(ready)
+            # A stopped job still waits for its other running branches before it's finished.
+            finished = state.active == 0
+            if finished:
+                del self.job_states[id(job)]
+        return ready, finished, state
+
+    def _stage_loop(self, stage):
+        while not self.stop_event.is_set():
+            try:
+                job = stage.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            start_time = time.time()
+            result, error = None, None
+            try:
+                result = stage.task(job)
+            except Exception as e:
+                print("Error!!! stage {} failed: {}".format(stage.name, e))
+                error = e
+            finally:
+                stage.queue.task_done()
+            if error is None and self.on_stage_done:
+                self.on_stage_done(job, stage.name, time.time() - start_time)
+            ready, finished, state = self._stage_finished(job, stage, result, error)
+            self.report()
+            for next_stage in ready:
+                self._put(next_stage.queue, job)
+            if finished:
+                self.completions.put((job, state))
+
+    def _completion_loop(self):
+        # Finishes the jobs that were already done when stop() was called.
+        while not (self.stop_event.is_set() and self.completions.empty()):
+            try:
+                job, state = self.completions.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                if state.error is None:
+                    if self.on_done:
+                        self.on_done(job)
+                elif self.on_error:
+                    self.on_error(job, state.failed_stage, state.error)
+            except Exception as e:
+                print("Error!!! completing job failed: {}".format(e))
+
+    def _put(self, stage_queue, job):
+        while not self.stop_event.is_set():
+            try:
+                stage_queue.put(job, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        if self.completion_thread:
+            self.completion_thread.join()
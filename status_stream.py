@@ -0,0 +1,104 @@
+import asyncio
+import json
+from const_vars import JOBS_COLLECTION, STATUS_PUSH_INTERVAL, STATUS_KEEPALIVE_INTERVAL
+
+# not_found is sent for a pipeline id without a job document.
+FINAL_STATUSES = ("done", "failed", "cancelled", "not_found")
+
+SUBSCRIBED_STATUS_QUERY = '''
+FOR job IN @@jobs
+    FILTER job._key IN @keys
+    RETURN { pipeline_id: job._key, status: job.status, current_task: job.current_task, fetching: job.fetching }
+'''
+
+class StatusBroadcaster:
+    """
+    Pushes the status changes of pipelines to their subscribers.
+    A single query per interval reads the status of every subscribed pipeline, however many clients watch them,
+    so the database load doesn't grow with the number of open GUIs.
+    query is an async function (op, query, **bind_vars) that returns the rows.
+    """
+    def __init__(self, query, interval=STATUS_PUSH_INTERVAL, on_status=None):
+        self.query = query
+        self.interval = interval
+        self.on_status = on_status
+        self.subscribers = {}
+        self.last_status = {}
+        self.task = None
+
+    def subscribe(self, pipeline_id):
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(pipeline_id, set()).add(queue)
+        if pipeline_id in self.last_status:
+            queue.put_nowait(self.last_status[pipeline_id])
+        return queue
+
+    def unsubscribe(self, pipeline_id, queue):
+        queues = self.subscribers.get(pipeline_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[pipeline_id]
+            self.last_status.pop(pipeline_id, None)
+
+    def publish(self, status):
+        pipeline_id = status['pipeline_id']
+        if self.last_status.get(pipeline_id) == status:
+            return
+        self.last_status[pipeline_id] = status
+        if self.on_status:
+            self.on_status(pipeline_id, status['current_task'])
+        for queue in self.subscribers.get(pipeline_id, ()):
+            queue.put_nowait(status)
+
+    async def poll(self):
+        keys = list(self.subscribers)
+        rows = await self.query('status_stream', SUBSCRIBED_STATUS_QUERY, keys=keys, **{'@jobs': JOBS_COLLECTION})
+        found = set()
+        for status in rows:
+            found.add(status['pipeline_id'])
+            self.publish(status)
+        for pipeline_id in keys:
+            if pipeline_id not in found:
+                # The job is enqueued before its id is returned, so its streams end instead of waiting forever.
+                self.publish({'pipeline_id': pipeline_id, 'status': 'not_found', 'current_task': None, 'fetching': False})
+
+    async def run(self):
+        while True:
+            if self.subscribers:
+                try:
+                    await self.poll()
+                except Exception as e:
+                    print("Couldn't read the status of the subscribed pipelines: {}".format(e))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+
+async def status_events(broadcaster, pipeline_id, is_disconnected):
+    """
+    Server-Sent Events of one pipeline's status, ends after its final status or a not_found event.
+    """
+    queue = broadcaster.subscribe(pipeline_id)
+    try:
+        while True:
+            try:
+                status = await asyncio.wait_for(queue.get(), STATUS_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    break
+                # Keeps proxies from closing an idle stream.
+                yield ": keep-alive\n\n"
+                continue
+            event = "not_found" if status['status'] == "not_found" else "status"
+            yield "event: {}\ndata: {}\n\n".format(event, json.dumps(status))
+            if status['status'] in FINAL_STATUSES:
+                break
+    finally:
+        broadcaster.unsubscribe(pipeline_id, queue)
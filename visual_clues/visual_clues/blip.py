@@ -7,6 +7,8 @@ from visual_clues.models.blip import blip_decoder
 import os
 from pathlib import Path
 import wget
+import time
+from pipeline_metrics import METRICS
 
 class BLIP_Captioner():
 
@@ -46,11 +48,24 @@ class BLIP_Captioner():
     
     def generate_caption(self, frame):
 
+        start_time = time.time()
         with torch.no_grad():
             # beam search
             caption = self.model.generate(frame, sample=False, num_beams=3, max_length=20, min_length=15) 
+            METRICS.observe_model('blip_caption', time.time() - start_time, frame.shape[0])
             # nucleus sampling
             # caption = model.generate(image, sample=True, top_p=0.9, max_length=20, min_length=5) 
             return caption[0]
+
+    def generate_captions(self, frames):
+        """
+        Captions several processed frames in one beam search, returns one caption per frame.
+        """
+        batch = torch.cat(frames)
+        start_time = time.time()
+        with torch.no_grad():
+            captions = self.model.generate(batch, sample=False, num_beams=3, max_length=20, min_length=15)
+        METRICS.observe_model('blip_caption', time.time() - start_time, batch.shape[0])
+        return captions
     
     
@@ -0,0 +1,77 @@
+import io
+import os
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from pipeline_metrics import METRICS
+
+FRAME_FETCH_TIMEOUT = 30
+# Keep-alive connections to the storage node, at least the number of frames downloaded concurrently.
+FRAME_LOADER_POOL_SIZE = int(os.environ.get('FRAME_LOADER_POOL_SIZE', 16))
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36',
+           "Accept-Language": "en-US,en;q=0.5", "Accept-Encoding": "gzip, deflate"}
+
+class Frame:
+    """
+    An image that was downloaded and decoded once.
+    pil is the RGB image for the BLIP models, rgb its pixels as an ndarray and bgr a view of rgb with
+    the channels reversed for the OpenCV based models, so neither of them copies the pixels again.
+    """
+    __slots__ = ('url', 'pil', 'rgb')
+
+    def __init__(self, url, data):
+        self.url = url
+        self.pil = Image.open(io.BytesIO(data)).convert('RGB')
+        self.rgb = np.asarray(self.pil)
+
+    @property
+    def bgr(self):
+        return self.rgb[:, :, ::-1]
+
+
+class FrameLoader:
+    """
+    Downloads frames through one pooled requests.Session and decodes each of them once.
+    A failed download or decode returns None, there is no separate validity check.
+    """
+    def __init__(self, pool_size=FRAME_LOADER_POOL_SIZE, timeout=FRAME_FETCH_TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(HEADERS)
+
+    @METRICS.timed('http_fetch_seconds', target='image')
+    def fetch(self, url):
+        try:
+            resp = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            print("Image URL: {} couldn't be loaded succesfully. {}".format(url, e))
+            return None
+        if resp.status_code != 200:
+            print("Image URL: {} couldn't be loaded succesfully.".format(url))
+            return None
+        return resp.content
+
+    def decode(self, url, data):
+        try:
+            return Frame(url, data)
+        except Exception as e:
+            print("Image URL: {} couldn't be decoded. {}".format(url, e))
+            return None
+
+    def load(self, url):
+        data = self.fetch(url)
+        return self.decode(url, data) if data else None
+
+    def decode_or_load(self, url, data):
+        """
+        Decodes data, a copy of url that was downloaded elsewhere, and downloads url itself if that copy is broken.
+        """
+        frame = self.decode(url, data)
+        if frame is None:
+            print("Loading the stored copy of {} instead".format(url))
+            frame = self.load(url)
+        return frame
@@ -1,17 +1,28 @@
 from visual_clues.ontology_interface import OntologyInterface
 from visual_clues.ontology_factory import OntologyFactory
 from visual_clues.vlm_factory import VlmFactory
+from visual_clues.text_feat_bank import load_text_feats
 from visual_clues.utils import consts
 import typing
 from PIL import Image
 import requests
 import torch
+import numpy as np
 
 
 # DUMMY_IMAGE = Image.open(requests.get("http://images.cocodataset.org/val2017/000000039769.jpg", stream=True).raw)
 EMBBDING_BATCH_LIMIT_TEXT = 512
 DIV_TEXT_DENOMINATOR = 10
 
+def top_k_indices(scores, k):
+    """
+    Indices of the k highest scores of every row (or of a vector), highest first, without sorting the whole row.
+    """
+    k = min(k, scores.shape[-1])
+    indices = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=-1), axis=-1)
+    return np.take_along_axis(indices, order, axis=-1)
+
 def get_prefix_prompt_functions():
             attribute_prompt = lambda x: f'A photo of {x}'
             scene_prompt = lambda x: f'A photo of {x}'
@@ -49,34 +60,75 @@ class SingleOntologyImplementation(OntologyInterface):
 
         self.texts = [self.prompt_functions[self.ontology_name](t) for t in self.ontology]
         print(f"Length of ontology: {len(self.texts)}")
-    
-
-    def compute_scores(self, image) -> list[(str, float)]:
-        
-        outputs = []
-
+        # The precomputed text features of every prompt (text_feat_bank.py), for the VLMs that expose them.
+        self.text_feats = None
+        if hasattr(self.vlm, 'compute_text_feats'):
+            self.text_feats = load_text_feats(self.vlm, ontology_name, self.prompt_functions[ontology_name], self.texts)
+
+    def score_feats(self, image_feats):
+        """
+        Similarities of every image of image_feats to every prompt, one matrix multiply against the text feature bank.
+        """
+        with torch.no_grad():
+            return image_feats @ self.text_feats.t()
+
+    def score_vector(self, image):
+        """
+        The scores of every label of the ontology for an image, as one vector.
+        """
+        if self.text_feats is not None:
+            return self.score_matrix(self.vlm.get_cached_image_feat(image))[0]
         texts = self.texts
-
         # If VLM crashes, you can extend 10 to bigger number.
-        div_texts = len(texts) // DIV_TEXT_DENOMINATOR
-        len_texts = len(texts) 
-        for i in range(0, len_texts, div_texts):
-            if (i + div_texts) > len_texts:
-                scores = self.vlm.compute_cached_similarity(image, texts[i:i + (len_texts - i)])
-                for j, score in enumerate(scores):
-                    outputs.append((self.ontology[i + j], score))
-            else:
-                scores = self.vlm.compute_cached_similarity(image, texts[i:i + div_texts])
-                for j, score in enumerate(scores):
-                    outputs.append((self.ontology[i + j], score))
-        
-        # scores = self.vlm.compute_cached_similarity(image, texts)
-        # for i, score in enumerate(scores):
-        #     outputs.append((self.ontology[i], score))
-        
-        # outputs.sort(key=lambda a: a[1], reverse=True)
-        # print(f"Top 5: {outputs[:5]}")
-        return outputs
+        div_texts = max(1, len(texts) // DIV_TEXT_DENOMINATOR)
+        return np.concatenate([self.vlm.compute_cached_similarity(image, texts[i:i + div_texts])
+                               for i in range(0, len(texts), div_texts)])
+
+    def score_matrix(self, image_feats):
+        """
+        score_vector for a batch of images, an array of shape (number of images, size of the ontology).
+        """
+        if self.text_feats is not None:
+            return self.score_feats(image_feats).float().cpu().numpy()
+        texts = self.texts
+        div_texts = max(1, len(texts) // DIV_TEXT_DENOMINATOR)
+        return np.concatenate([self.vlm.compute_similarity_from_feats(image_feats, texts[i:i + div_texts])
+                               for i in range(0, len(texts), div_texts)], axis=1)
+
+    def compute_scores(self, image) -> list[(str, float)]:
+        return list(zip(self.ontology, self.score_vector(image)))
+
+    def compute_scores_from_feats(self, image_feats) -> list[list[(str, float)]]:
+        """
+        compute_scores for a batch of images, image_feats comes from the VLM's compute_image_feats.
+        """
+        return [list(zip(self.ontology, scores)) for scores in self.score_matrix(image_feats)]
+
+    def top_k(self, image, k=10) -> list[(str, float)]:
+        """
+        The k best scoring labels of the ontology for an image, best first.
+        Only the k winners become Python objects, the rest of the ontology stays in one vector.
+        """
+        if self.text_feats is not None:
+            return self.top_k_from_feats(self.vlm.get_cached_image_feat(image), k)[0]
+        scores = self.score_vector(image)
+        return [(self.ontology[i], scores[i]) for i in top_k_indices(scores, k)]
+
+    def top_k_from_feats(self, image_feats, k=10) -> list[list[(str, float)]]:
+        """
+        top_k for a batch of images, image_feats comes from the VLM's compute_image_feats.
+        With a text feature bank the top k are selected on the model's device, only k scores per image are copied back.
+        """
+        if self.text_feats is not None:
+            with torch.no_grad():
+                values, indices = self.score_feats(image_feats).float().topk(min(k, len(self.ontology)), dim=1)
+            values, indices = values.cpu().numpy(), indices.cpu().numpy()
+        else:
+            scores = self.score_matrix(image_feats)
+            indices = top_k_indices(scores, k)
+            values = np.take_along_axis(scores, indices, axis=1)
+        return [[(self.ontology[i], score) for i, score in zip(image_indices, image_values)]
+                for image_indices, image_values in zip(indices, values)]
     
     def compute_scores_with_bboxes(self, image, bbox) -> list[(str, float)]:
         
@@ -3,16 +3,20 @@ from run_visual_clues import TokensPipeline
 import os
 from typing import Tuple
 
-def test_pipeline_task(pipeline_id):
+def test_pipeline_task(pipeline_id, visual_clues_pipeline=None, context=None):
     class MyTask(PipelineTask):
         def __init__(self):
-            self.visual_clues_pipeline = TokensPipeline()
+            self.visual_clues_pipeline = visual_clues_pipeline if visual_clues_pipeline else TokensPipeline()
+            self.batch_results = {}
             print("Initialized successfully.")
 
         def process_movie(self, movie_id: str) -> Tuple[bool, str]:
             print (f'handling movie: {movie_id}')
 
-            output = self.visual_clues_pipeline.run_visual_clues_pipeline(movie_id)
+            if movie_id in self.batch_results:
+                output = self.batch_results[movie_id]
+            else:
+                output = self.visual_clues_pipeline.run_visual_clues_pipeline(movie_id, context)
 
             print("Finished handling movie.")
             print(output)
@@ -22,13 +26,18 @@ def test_pipeline_task(pipeline_id):
 
     pipeline = PipelineApi(None)
     task = MyTask()
+    # The movies of a dataset pipeline are processed together, process_movie then only reports their results.
+    movie_ids = task.visual_clues_pipeline.get_pipeline_movie_ids(pipeline_id)
+    if len(movie_ids) > 1:
+        task.batch_results = task.visual_clues_pipeline.run_visual_clues_batch(movie_ids, context)
     pipeline.handle_pipeline_task(task, pipeline_id, stop_on_failure=True)
 
-def test():
-    # pipeline_id = os.environ.get('PIPELINE_ID')
+def test(visual_clues_pipeline=None):
+    pipeline_id = os.environ.get('PIPELINE_ID')
     # print(pipeline_id)
-    pipeline_id='15fa01b0-8d15-44d3-8609-8950e4e125ff'
-    test_pipeline_task(pipeline_id)
+    if pipeline_id == None:
+        pipeline_id='15fa01b0-8d15-44d3-8609-8950e4e125ff'
+    test_pipeline_task(pipeline_id, visual_clues_pipeline)
 
 if __name__ == '__main__':
     test()
@@ -1,26 +1,36 @@
 import numpy as np
 from database.arangodb import DatabaseConnector, DBBase
 # from config.config import NEBULA_CONF
-import cv2
 from pathlib import Path
 import csv
-import requests
 
 # from movie.movie_db import MOVIE_DB
 import tqdm
 from PIL import Image
 import time
+from collections import deque
 
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from pipeline_metrics import METRICS
+from cancellation import check_cancelled
+from doc_store import upsert_docs
 from visual_clues.ontology_implementation import SingleOntologyImplementation
 from visual_clues.blip import BLIP_Captioner
 from visual_clues.yolov7_implementation import YoloTrackerModel
-from visual_clues.vlm_implementation import BlipItcVlmImplementation
+from visual_clues.vlm_factory import VlmFactory
+from visual_clues.frame_loader import FrameLoader
+from concurrent.futures import ThreadPoolExecutor
 
 # from visual_clues.bboxes_implementation import DetectronBBInitter
 
 URL_PREFIX = "http://74.82.29.209:9000"
+# Frames, of one movie or of several, that share one forward pass in run_visual_clues_batch.
+VISUAL_CLUES_BATCH_SIZE = int(os.environ.get('VISUAL_CLUES_BATCH_SIZE', 16))
+# Movies with several MDFs run them through the models in micro-batches of VISUAL_CLUES_BATCH_SIZE.
+VISUAL_CLUES_MOVIE_BATCHING = os.environ.get('VISUAL_CLUES_MOVIE_BATCHING', '1') == '1'
+# MDFs downloaded and decoded ahead of the one the models are working on.
+MDF_PREFETCH_DEPTH = int(os.environ.get('MDF_PREFETCH_DEPTH', 4))
 
 class TokensPipeline:
     def __init__(self):
@@ -33,48 +43,70 @@ class TokensPipeline:
         print("Connected to database: {}".format(self.nre.database))
         self.collection_name = "s4_visual_clues"
         # self.db = self.nre.db
-        self.blip_captioner = BLIP_Captioner()
-        self.ontology_objects = SingleOntologyImplementation('vg_objects', vlm_name="blip_itc")
-        self.ontology_places = SingleOntologyImplementation('scenes', vlm_name="blip_itc")
-        self.ontology_attributes = SingleOntologyImplementation('vg_attributes', vlm_name="blip_itc")
-        self.yolo_detector = YoloTrackerModel()
-        self.blip_itc = BlipItcVlmImplementation()
+        # The checkpoints are loaded concurrently, the ontologies share one BLIP ITC model with the llm task.
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="load-visual-clues") as executor:
+            blip_captioner = executor.submit(BLIP_Captioner)
+            yolo_detector = executor.submit(YoloTrackerModel)
+            blip_itc = executor.submit(VlmFactory().get_vlm, "blip_itc")
+            ontologies = [executor.submit(SingleOntologyImplementation, ontology_name, vlm_name="blip_itc")
+                            for ontology_name in ['vg_objects', 'scenes', 'vg_attributes']]
+        self.blip_captioner = blip_captioner.result()
+        self.yolo_detector = yolo_detector.result()
+        self.blip_itc = blip_itc.result()
+        self.ontology_objects, self.ontology_places, self.ontology_attributes = [ontology.result() for ontology in ontologies]
+        self.frame_loader = FrameLoader()
         # self.det_proposal = DetectronBBInitter()
 
 
+    def warmup(self):
+        """
+        Runs every model once on a synthetic image, the text features of the ontologies come from their banks.
+        """
+        start_time = time.time()
+        pil_img = Image.fromarray(np.full((384, 384, 3), 127, dtype=np.uint8))
+        for ontology in [self.ontology_objects, self.ontology_places]:
+            self.compute_scores(ontology, pil_img)
+        self.blip_captioner.generate_caption(self.blip_captioner.process_frame(pil_img))
+        self.yolo_detector.forward(np.asarray(pil_img)[:, :, ::-1].copy())
+        print("Visual clues warm-up time: {}".format(time.time() - start_time))
+
     def load_img_url(self, img_url : str, pil_type=False):
-        # Load PIL Image
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36', \
-                                 "Upgrade-Insecure-Requests": "1","DNT": "1","Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", \
-                                 "Accept-Language": "en-US,en;q=0.5","Accept-Encoding": "gzip, deflate"}
-        if pil_type:
-            resp = requests.get(img_url, stream=True, headers=headers).raw
-            image = Image.open(resp)
-        # Load OpenCV Image
-        else:
-            resp = requests.get(img_url, stream=True, headers=headers).raw
-            image = np.asarray(bytearray(resp.read()), dtype="uint8")
-            image = cv2.imdecode(image, cv2.IMREAD_COLOR)
-        return image
+        """
+        Returns the PIL (RGB) or OpenCV (BGR) image of an url, None if it couldn't be loaded.
+        Code that needs both should load a frame once with self.frame_loader.
+        """
+        frame = self.frame_loader.load(img_url)
+        if frame is None:
+            return None
+        return frame.pil if pil_type else frame.bgr
     
+    def compute_scores_batch(self, ontology, image_feats, top_n = 10):
+        """
+        compute_scores for a batch of images, image_feats comes from the VLM's compute_image_feats.
+        """
+        return [[(label, str(score)) for label, score in scores]
+                for scores in ontology.top_k_from_feats(image_feats, top_n)]
+
     def compute_scores(self, ontology, img, top_n = 10):
         """
         Returns top n ontology list and its corresponding scores sorted in reverse order.
         """
-        ontology_scores = ontology.compute_scores(img)
-        sorted_scores = sorted(ontology_scores, key=lambda x: x[1], reverse=True)
-        sorted_scores_ = [(score[0], str(score[1])) for score in sorted_scores]
-        scores = sorted_scores_[:top_n]
-        return scores
+        return [(label, str(score)) for label, score in ontology.top_k(img, top_n)]
 
     def insert_json_to_db(self, combined_json, collection_name):
         """
         Inserts a JSON with global & local tokens to the database.
         """
+        return self.insert_jsons_to_db([combined_json], collection_name)[0]
 
-        res = self.nre.write_doc_by_key(combined_json, collection_name, overwrite=True, key_list=['movie_id', 'frame_num'])
+    def insert_jsons_to_db(self, combined_jsons, collection_name):
+        """
+        Upserts the JSONs of many frames in a single round-trip.
+        """
+        res = upsert_docs(self.nre.db, combined_jsons, collection_name, key_list=['movie_id', 'frame_num'])
 
-        print("Successfully inserted to database. Collection name: {}, movie_id: {}".format(collection_name, combined_json['movie_id']))
+        print("Successfully inserted {} frames to database. Collection name: {}, movie_id: {}".format(
+                len(combined_jsons), collection_name, ', '.join(sorted(set(doc['movie_id'] for doc in combined_jsons)))))
         return res
         
 
@@ -113,24 +145,11 @@ class TokensPipeline:
         return combined_json
     
 
-    def create_local_tokens(self, img_url, movie_id, mdf):
+    def create_local_dict(self, yolo_output):
         """
-        Returns a JSON with local tokens for an image url.
+        Returns the ROIs of the YOLO detections of one image.
         """
-        start_time = time.time()
-        # cv_img = self.load_img_url(img_url, pil_type=False)
-        # bbox_proposals = self.det_proposal.compute_bbox_proposals(cv_img)
-        # bb_rescale_ratio = [inp/out for out,inp in zip(bbox_proposals['image_size'][:2], cv_img.shape)]
-        # pil_img = self.load_img_url(img_url, pil_type=True)
-
-        # bbox_propsals_objs = []
-        # bbox_propsals_attrs = []
-
         local_dict = []
-
-        cv_img = self.load_img_url(img_url, pil_type=False)
-        yolo_output = self.yolo_detector.forward(cv_img)
-
         for idx, output in enumerate(yolo_output):
             cur_obj, cur_bbox, cur_conf = output['detection_classes'], output['detections_boxes'], output['detection_scores']
 
@@ -141,6 +160,28 @@ class TokensPipeline:
                 'bbox_confidence': cur_conf,
                 'bbox_source': 'yolov7'
             })
+        return local_dict
+
+    def create_local_tokens(self, img_url, movie_id, mdf, cv_img=None):
+        """
+        Returns a JSON with local tokens for an image url, cv_img is the already loaded image if there is one.
+        """
+        start_time = time.time()
+        # cv_img = self.load_img_url(img_url, pil_type=False)
+        # bbox_proposals = self.det_proposal.compute_bbox_proposals(cv_img)
+        # bb_rescale_ratio = [inp/out for out,inp in zip(bbox_proposals['image_size'][:2], cv_img.shape)]
+        # pil_img = self.load_img_url(img_url, pil_type=True)
+
+        # bbox_propsals_objs = []
+        # bbox_propsals_attrs = []
+
+        if cv_img is None:
+            cv_img = self.load_img_url(img_url, pil_type=False)
+            if cv_img is None:
+                raise Exception("Error!!! invalid image URL: {}".format(img_url))
+        yolo_output = self.yolo_detector.forward(cv_img)
+
+        local_dict = self.create_local_dict(yolo_output)
 
         # for idx, bbox in enumerate(bbox_proposals['meta_data_det']):
         #     scaled_bbox = [bbox[0]*bb_rescale_ratio[1], bbox[1]*bb_rescale_ratio[0],
@@ -179,21 +220,24 @@ class TokensPipeline:
                                                             img_url=img_url, source="None")
                                                             
         end_time = time.time() - start_time
+        METRICS.observe('visual_clues_tokens_seconds', end_time, tokens='local')
         print("Create local tokens time: {}".format(end_time))
         return json_local_tokens
 
 
-    def create_global_tokens(self, img_url, movie_id, frame_num):
+    def create_global_tokens(self, img_url, movie_id, frame_num, pil_img=None):
         """
-        Returns a JSON with global tokens for an image url.
+        Returns a JSON with global tokens for an image url, pil_img is the already loaded image if there is one.
         """
         start_time = time.time()
-        pil_img = self.load_img_url(img_url, pil_type=True)
+        if pil_img is None:
+            pil_img = self.load_img_url(img_url, pil_type=True)
+            if pil_img is None:
+                raise Exception("Error!!! invalid image URL: {}".format(img_url))
 
         scores_objects = self.compute_scores(self.ontology_objects, pil_img, top_n = 10)
         scores_places = self.compute_scores(self.ontology_places, pil_img, top_n = 10)
 
-        pil_img = self.load_img_url(img_url, pil_type=True)
         processed_frame = self.blip_captioner.process_frame(pil_img)
         caption = self.blip_captioner.generate_caption(processed_frame)
 
@@ -201,9 +245,11 @@ class TokensPipeline:
                                                             global_caption=caption,
                                                             global_scenes=scores_places, img_url=img_url, source="None")
         end_time = time.time() - start_time
+        METRICS.observe('visual_clues_tokens_seconds', end_time, tokens='global')
         print("Create global tokens time: {}".format(end_time))
         return json_global_tokens
 
+    @METRICS.db_call('get_mdf_urls')
     def get_mdf_urls_from_db(self, movie_id, collection):
 
         data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
@@ -219,6 +265,7 @@ class TokensPipeline:
             urls.append(url)
         return urls
     
+    @METRICS.db_call('get_pipeline_id')
     def get_pipelineid_from_db(self, movie_id, collection):
 
         data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
@@ -232,6 +279,7 @@ class TokensPipeline:
 
         return pipeline_id
 
+    @METRICS.db_call('get_input_type')
     def get_input_type_from_db(self, pipeline_id, collection):
 
         pipeline_data = self.nre.get_doc_by_key({'_key': pipeline_id}, collection)
@@ -242,45 +290,212 @@ class TokensPipeline:
                 input_type = pipeline_data["inputs"]["videoprocessing"]["movies"][0]["type"]
         return input_type
     
-    def check_image_url(self, img_url):
-        resp = requests.get(img_url, stream=True).raw
-        if not resp.reason == 'OK':
-            print("Image URL: {} couldn't be loaded succesfully.".format(img_url))
-            return False
-        return True
+    @METRICS.db_call('get_pipeline_movies')
+    def get_pipeline_movie_ids(self, pipeline_id, collection="pipelines"):
+        pipeline_data = self.nre.get_doc_by_key({'_key': pipeline_id}, collection)
+        if not pipeline_data or not pipeline_data.get('movies'):
+            return []
+        return list(pipeline_data['movies'].keys())
+
+    def get_frame_num(self, img_url, num_urls, input_type):
+        if num_urls == 1 and input_type == "image":
+            return 0
+        return int(img_url.split("/")[-1].split(".jpg")[0].replace("frame",""))
+
         
-    def run_visual_clues_pipeline(self, movie_id):
+    def store_visual_clues(self, combined_json, context=None):
+        """
+        Keeps the frame's visual clues in the job's context for the next stages, the database write
+        then happens in the background. Without a context it's written synchronously.
+        """
+        if context is None:
+            return self.insert_json_to_db(combined_json, self.collection_name)
+        context.add_visual_clues(combined_json)
+        context.persist(self.insert_json_to_db, combined_json, self.collection_name)
+
+    def store_visual_clues_batch(self, combined_jsons, context=None):
+        """
+        store_visual_clues of many frames, written together.
+        """
+        if context is None:
+            return self.insert_jsons_to_db(combined_jsons, self.collection_name)
+        for combined_json in combined_jsons:
+            context.add_visual_clues(combined_json)
+        context.persist(self.insert_jsons_to_db, combined_jsons, self.collection_name)
+
+    def prefetch_frames(self, image_urls, depth=MDF_PREFETCH_DEPTH, source_image=None):
+        """
+        Yields (img_url, frame) in order, while the next depth frames are downloaded and decoded in the background.
+        source_image is the already downloaded image of an image input, its only MDF.
+        """
+        if source_image is not None:
+            yield image_urls[0], self.frame_loader.decode_or_load(image_urls[0], source_image)
+            return
+        # At least one frame is always in flight, MDF_PREFETCH_DEPTH=0 would be an empty thread pool.
+        depth = max(1, depth)
+        urls = iter(image_urls)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=depth, thread_name_prefix="mdf-prefetch") as fetcher:
+            try:
+                for img_url in urls:
+                    pending.append((img_url, fetcher.submit(self.frame_loader.load, img_url)))
+                    if len(pending) == depth:
+                        break
+                while pending:
+                    img_url, future = pending.popleft()
+                    next_url = next(urls, None)
+                    if next_url is not None:
+                        pending.append((next_url, fetcher.submit(self.frame_loader.load, next_url)))
+                    yield img_url, future.result()
+            finally:
+                # The caller stopped early, don't download the rest.
+                for _, future in pending:
+                    future.cancel()
+
+    def run_visual_clues_pipeline(self, movie_id, context=None):
         print("Starting to record time of visual clues!")
         start_time = time.time()
         image_urls = self.get_mdf_urls_from_db(movie_id, "Movies")
         pipeline_id = self.get_pipelineid_from_db(movie_id, "Movies")
+        if not image_urls:
+            # The movie or its MDFs are missing.
+            return False, None
         input_type = self.get_input_type_from_db(pipeline_id, "pipelines")
         length_urls = len(image_urls)
-        if length_urls == 0:
-            return False, None
-        for idx, img_url in enumerate(image_urls):
-            print("Working on current image url: {}".format(img_url))
-            img_url_is_valid = self.check_image_url(img_url)
-            if img_url_is_valid:
-                if len(image_urls) == 1 and input_type == "image":
-                    cur_frame_num = 0
+        if VISUAL_CLUES_MOVIE_BATCHING and length_urls > 1:
+            # All the MDFs of the movie go through the models in micro-batches.
+            return self.run_visual_clues_batch([movie_id], context, image_urls={movie_id: image_urls})[movie_id]
+        # An image input was already downloaded at submission, its MDF is the same image.
+        source_image = None
+        if context is not None and input_type == "image" and length_urls == 1:
+            source_image = context.get_source_image()
+        # One download and one decode serve the BLIP models and YOLO, the next frames are fetched meanwhile.
+        frames = self.prefetch_frames(image_urls, source_image=source_image)
+        # Without a job context the writes still overlap with the next frame's inference.
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="visual-clues-write") if context is None else None
+        writes = []
+        try:
+            for idx, (img_url, frame) in enumerate(frames):
+                check_cancelled()
+                print("Working on current image url: {}".format(img_url))
+                frame_start_time = time.time()
+                if frame is not None:
+                    cur_frame_num = self.get_frame_num(img_url, length_urls, input_type)
+                    glob_tkns_json = self.create_global_tokens(img_url, movie_id, cur_frame_num, pil_img=frame.pil)
+                    loc_tkns_json = self.create_local_tokens(img_url, movie_id, cur_frame_num, cv_img=frame.bgr)
+                    combined_json = self.create_combined_json(glob_tkns_json, loc_tkns_json)
+                    if writer:
+                        writes.append(writer.submit(self.store_visual_clues, combined_json))
+                    else:
+                        self.store_visual_clues(combined_json, context)
+                    METRICS.observe('frame_seconds', time.time() - frame_start_time, stage='visual_clues')
+                    counter = idx + 1
+                    print("Finished with {}/{}".format(counter, length_urls))
                 else:
-                    cur_frame_num = int(img_url.split("/")[-1].split(".jpg")[0].replace("frame",""))
-                glob_tkns_json = self.create_global_tokens(img_url, movie_id, cur_frame_num)
-                loc_tkns_json = self.create_local_tokens(img_url, movie_id, cur_frame_num)
-                combined_json = self.create_combined_json(glob_tkns_json, loc_tkns_json)
-                self.insert_json_to_db(combined_json, self.collection_name)
-                counter = idx + 1
-                print("Finished with {}/{}".format(counter, length_urls))
-            else:
-                counter = idx + 1
-                print("Finished with {}/{}".format(counter, length_urls))
-                print("Error!!! invalid image URL: {}".format(img_url))
-                return False, None
+                    counter = idx + 1
+                    print("Finished with {}/{}".format(counter, length_urls))
+                    print("Error!!! invalid image URL: {}".format(img_url))
+                    return False, None
+        finally:
+            frames.close()
+            if writer:
+                writer.shutdown(wait=True)
+        for write in writes:
+            # Raises the error of a failed write.
+            write.result()
         end_time = time.time() - start_time
         print("Total time it took for visual clues: {}".format(end_time))
         return True, None
 
+    def infer_batch(self, batch):
+        """
+        Runs the BLIP ITC visual encoder, the BLIP captioner and YOLO once on a micro-batch of frames.
+        batch is a list of ((movie_id, frame_num, img_url), frame), returns the combined JSON of every frame.
+        """
+        pil_imgs = [frame.pil for _, frame in batch]
+        image_feats = self.blip_itc.compute_image_feats(pil_imgs)
+        scores_objects = self.compute_scores_batch(self.ontology_objects, image_feats, top_n = 10)
+        scores_places = self.compute_scores_batch(self.ontology_places, image_feats, top_n = 10)
+        captions = self.blip_captioner.generate_captions([self.blip_captioner.process_frame(pil_img) for pil_img in pil_imgs])
+        yolo_outputs = self.yolo_detector.forward_batch([frame.bgr for _, frame in batch])
+        combined_jsons = []
+        for idx, ((movie_id, frame_num, img_url), _) in enumerate(batch):
+            glob_tkns_json = self.create_json_global_tokens(movie_id = movie_id, mdf=frame_num, global_objects=scores_objects[idx],
+                                                            global_caption=captions[idx],
+                                                            global_scenes=scores_places[idx], img_url=img_url, source="None")
+            loc_tkns_json = self.create_json_local_tokens(movie_id, frame_num, local_dict=self.create_local_dict(yolo_outputs[idx]),
+                                                            img_url=img_url, source="None")
+            combined_jsons.append(self.create_combined_json(glob_tkns_json, loc_tkns_json))
+        return combined_jsons
+
+    def run_visual_clues_batch(self, movie_ids, context=None, batch_size=VISUAL_CLUES_BATCH_SIZE, image_urls=None):
+        """
+        Processes the MDFs of several movies (e.g. the items of a dataset pipeline) together,
+        frames of different movies share the forward passes of BLIP ITC, the BLIP captioner and YOLO.
+        image_urls is {movie_id: MDF urls} of the movies whose urls were already read, the rest are read from the db.
+        Returns {movie_id: (success, error)}, the same output run_visual_clues_pipeline returns for one movie.
+        """
+        print("Starting to record time of visual clues batch!")
+        start_time = time.time()
+        results = {}
+        frames = []
+        input_types = {}
+        image_urls = image_urls or {}
+        for movie_id in movie_ids:
+            movie_urls = image_urls.get(movie_id) or self.get_mdf_urls_from_db(movie_id, "Movies")
+            if not movie_urls:
+                results[movie_id] = (False, None)
+                continue
+            pipeline_id = self.get_pipelineid_from_db(movie_id, "Movies")
+            if pipeline_id not in input_types:
+                input_types[pipeline_id] = self.get_input_type_from_db(pipeline_id, "pipelines")
+            for img_url in movie_urls:
+                frames.append((movie_id, self.get_frame_num(img_url, len(movie_urls), input_types[pipeline_id]), img_url))
+            results[movie_id] = (True, None)
+
+        # The next micro-batch is downloaded and decoded while the models work on the current one.
+        loaded_frames = self.prefetch_frames([img_url for _, _, img_url in frames], depth=batch_size)
+        # Without a job context micro-batch N is written while micro-batch N+1 is on the models.
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="visual-clues-write") if context is None else None
+        writes = []
+        try:
+            for batch_start in range(0, len(frames), batch_size):
+                check_cancelled()
+                batch_start_time = time.time()
+                batch = []
+                for frame in frames[batch_start:batch_start + batch_size]:
+                    _, loaded = next(loaded_frames)
+                    if loaded is None:
+                        print("Error!!! invalid image URL: {}".format(frame[2]))
+                        results[frame[0]] = (False, None)
+                        continue
+                    batch.append((frame, loaded))
+                if not batch:
+                    continue
+                combined_jsons = self.infer_batch(batch)
+                if writer:
+                    writes.append(writer.submit(self.store_visual_clues_batch, combined_jsons))
+                else:
+                    self.store_visual_clues_batch(combined_jsons, context)
+                batch_time = time.time() - batch_start_time
+                for _ in batch:
+                    METRICS.observe('frame_seconds', batch_time / len(batch), stage='visual_clues')
+                print("Finished with {}/{} frames".format(min(batch_start + batch_size, len(frames)), len(frames)))
+        finally:
+            loaded_frames.close()
+            if writer:
+                writer.shutdown(wait=True)
+        for write in writes:
+            # Raises the error of a failed write.
+            write.result()
+
+        end_time = time.time() - start_time
+        frames_per_second = len(frames) / end_time if end_time else 0
+        METRICS.set_gauge('visual_clues_batch_frames_per_second', frames_per_second)
+        print("Total time it took for visual clues batch: {}, {} movies, {} frames, {:.2f} frames/sec, {:.2f} movies/sec".format(
+                end_time, len(movie_ids), len(frames), frames_per_second, len(movie_ids) / end_time if end_time else 0))
+        return results
+
 
 def main():
     start_time = time.time()
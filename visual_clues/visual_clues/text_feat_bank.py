@@ -0,0 +1,105 @@
+import argparse
+import hashlib
+import warnings
+import os, sys
+import numpy as np
+import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from visual_clues.utils.config import config
+from visual_clues.ontology_factory import OntologyFactory
+
+# The banks are kept next to the BLIP checkpoint, which outlives the containers.
+TEXT_FEAT_BANK_DIR = os.environ.get('TEXT_FEAT_BANK_DIR',
+                                    os.path.join(os.path.dirname(config['blip_model_url_large']), 'text_feat_banks'))
+# Prompts per text encoder forward while a bank is built.
+TEXT_FEAT_BANK_BATCH_SIZE = int(os.environ.get('TEXT_FEAT_BANK_BATCH_SIZE', 256))
+# The ontologies of the visual clues pipeline.
+BANK_ONTOLOGIES = ['vg_objects', 'scenes', 'vg_attributes']
+# A bank is stored in the dtype the model scores in, float16 on GPU and float32 on CPU.
+BANK_DTYPES = (np.float16, np.float32)
+
+def checkpoint_id():
+    """
+    Identifies the BLIP checkpoint by its name, ViT and size, hashing the whole file would take longer than a build.
+    """
+    path = config['blip_model_url_large']
+    size = os.path.getsize(path) if os.path.isfile(path) else None
+    return "{}|{}|{}".format(os.path.basename(path), config['blip_vit_large'], size)
+
+def bank_dtype(vlm):
+    return np.float16 if vlm.half else np.float32
+
+def bank_path(ontology_name, prompt_function, dtype=np.float16, bank_dir=TEXT_FEAT_BANK_DIR):
+    """
+    A bank is keyed by the ontology file's content, the prompt template and the checkpoint,
+    a change to any of them makes a new bank instead of reusing a stale one.
+    """
+    with open(OntologyFactory().ontology_map[ontology_name], 'rb') as f:
+        ontology_hash = hashlib.sha256(f.read()).hexdigest()
+    key = "|".join([ontology_hash, prompt_function('{}'), checkpoint_id()])
+    return os.path.join(bank_dir, "{}-{}-{}.npy".format(ontology_name, hashlib.sha256(key.encode()).hexdigest()[:16],
+                                                        np.dtype(dtype).name))
+
+def build_bank(vlm, texts, path, dtype=np.float16, batch_size=TEXT_FEAT_BANK_BATCH_SIZE):
+    """
+    Encodes the texts with the VLM's text encoder and saves their normalized features as dtype.
+    """
+    print("Building the text feature bank {} of {} prompts".format(path, len(texts)))
+    feats = [vlm.compute_text_feats(texts[i:i + batch_size]).float().cpu().numpy().astype(dtype)
+             for i in range(0, len(texts), batch_size)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Pipeline processes may build the same bank at once, each writes its own file and the last rename wins.
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.concatenate(feats))
+    os.replace(tmp_path, path)
+
+def load_bank(vlm, ontology_name, prompt_function, texts):
+    """
+    Returns the memory-mapped text features of an ontology, one row per text, building the bank if it's missing.
+    """
+    dtype = bank_dtype(vlm)
+    path = bank_path(ontology_name, prompt_function, dtype)
+    if not os.path.isfile(path):
+        build_bank(vlm, texts, path, dtype)
+    bank = np.load(path, mmap_mode='r')
+    if bank.shape[0] != len(texts):
+        raise Exception("Text feature bank {} has {} rows for {} prompts".format(path, bank.shape[0], len(texts)))
+    return bank
+
+def load_text_feats(vlm, ontology_name, prompt_function, texts):
+    """
+    The text features of an ontology on the VLM's device, in the dtype of its image features.
+    On CPU the tensor is the memory-mapped bank itself, so the pipeline processes share its pages
+    instead of each holding a copy. Only a GPU gets a copy.
+    """
+    bank = load_bank(vlm, ontology_name, prompt_function, texts)
+    with warnings.catch_warnings():
+        # The mapping is read-only, which torch warns about, and nothing writes to the bank.
+        warnings.simplefilter('ignore', UserWarning)
+        text_feats = torch.from_numpy(bank)
+    if torch.device(vlm.device).type == 'cpu':
+        return text_feats
+    return text_feats.to(device=vlm.device)
+
+
+def main():
+    from visual_clues.ontology_implementation import SingleOntologyImplementation, get_prefix_prompt_functions
+    parser = argparse.ArgumentParser(description="Builds the BLIP ITC text feature banks of the ontologies.")
+    parser.add_argument('ontologies', nargs='*', default=BANK_ONTOLOGIES)
+    parser.add_argument('--rebuild', action='store_true', help="Replace the banks that already exist.")
+    args = parser.parse_args()
+    prompt_functions = get_prefix_prompt_functions()
+    for ontology_name in args.ontologies:
+        if args.rebuild:
+            for dtype in BANK_DTYPES:
+                path = bank_path(ontology_name, prompt_functions[ontology_name], dtype)
+                if os.path.isfile(path):
+                    os.remove(path)
+        # Loading the ontology builds its missing bank, in the dtype of the device the model is on.
+        ontology = SingleOntologyImplementation(ontology_name, vlm_name='blip_itc')
+        print("{}: {}".format(ontology_name, bank_path(ontology_name, prompt_functions[ontology_name], bank_dtype(ontology.vlm))))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from visual_clues.vlm_implementation import ClipVlmImplementation, BlipItcVlmImplementation, BlipItmVlmImplementation, VisualGroundingToVlmAdapter
 from visual_clues.utils.singleton import Singleton
+import threading
 # from nebula3_experts_vg.vg.vg_expert import VisualGroundingVlmImplementation
 class VlmFactory:
     _creators = {}
+    # Models are loaded from several threads at startup, each VLM must still be loaded only once.
+    _lock = threading.Lock()
     def __init__(self, metaclass=Singleton): 
         self.vlm_map = {
             'clip': ClipVlmImplementation,
@@ -24,12 +27,15 @@ class VlmFactory:
     def get_vlm(self, vlm_name):
         creator = self._creators.get(vlm_name)
         if not creator:
-            try:
-                self.register_vlm(vlm_name)
+            with self._lock:
                 creator = self._creators.get(vlm_name)
-            except:
-                dict_keys = self.vlm_map.keys()
-                raise Exception("VLM not found. please use on of these keys: {}".format(dict_keys))
+                if not creator:
+                    try:
+                        self.register_vlm(vlm_name)
+                        creator = self._creators.get(vlm_name)
+                    except:
+                        dict_keys = self.vlm_map.keys()
+                        raise Exception("VLM not found. please use on of these keys: {}".format(dict_keys))
 
         return creator
 
@@ -13,13 +13,20 @@ import os.path
 import wget
 from pathlib import Path
 from functools import lru_cache, wraps
+from collections import OrderedDict
 from time import sleep
-import io
+import time
+import hashlib
+import threading
 import torch.nn.functional as F
+from pipeline_metrics import METRICS
 
 # from nebula3_experts_vg.vg.visual_grounding_inference import OfaMultiModalVisualGrounding
 # from nebula3_videoprocessing.videoprocessing.owl_vit_impl import OwlVitImplementation
 
+# Bytes of image features BLIP ITC keeps for the frames scored recently.
+IMAGE_FEAT_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_FEAT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
 def np_cache(function):
     @lru_cache()
     def cached_wrapper(hashable_array):
@@ -36,10 +43,47 @@ def np_cache(function):
 
     return wrapper
 
+class ImageFeatureCache:
+    """
+    Image features keyed by a hash of the image's pixels, bounded to max_bytes with LRU eviction.
+    Equal frames hit whichever PIL object carries them, and the VLM instance (shared by every
+    ontology through VlmFactory) runs its visual encoder once per frame.
+    """
+    def __init__(self, max_bytes=IMAGE_FEAT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.feats = OrderedDict()
+        self.total_bytes = 0
+
+    @staticmethod
+    def key(image: Image):
+        return (image.mode, image.size, hashlib.blake2b(image.tobytes(), digest_size=16).digest())
+
+    def get(self, key):
+        with self.lock:
+            feat = self.feats.get(key)
+            if feat is not None:
+                self.feats.move_to_end(key)
+        METRICS.inc('image_feat_cache_lookups_total', result='miss' if feat is None else 'hit')
+        return feat
+
+    def put(self, key, feat):
+        size = feat.element_size() * feat.nelement()
+        with self.lock:
+            if key in self.feats:
+                return
+            self.feats[key] = feat
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.feats) > 1:
+                _, evicted = self.feats.popitem(last=False)
+                self.total_bytes -= evicted.element_size() * evicted.nelement()
+
+
 class VlmBaseImplementation(VlmInterface):
 
     def compute_similarity_url(self, url: str, text: list[str]):
-        image = self.load_image_url(url)
+        with METRICS.timer('http_fetch_seconds', target='image'):
+            image = self.load_image_url(url)
         return self.compute_similarity(image, text)
 
 class VlmChunker(VlmBaseImplementation):
@@ -98,8 +142,10 @@ class ClipVlmImplementation(VlmBaseImplementation):
     def compute_similarity(self, image : Image, text : list[str]):
 
         inputs = self.processor(text=text, images=image, return_tensors="pt", padding=True).to(device=self.device)
+        start_time = time.time()
         with torch.no_grad():
             outputs = self.model(**inputs)
+        METRICS.observe_model('clip', time.time() - start_time, len(text))
         embeds_dotproduct = (outputs.image_embeds.expand_as(outputs.text_embeds) * outputs.text_embeds).sum(dim=1)
         return embeds_dotproduct.cpu().detach().numpy()
 
@@ -141,8 +187,10 @@ class BlipItmVlmImplementation(VlmBaseImplementation):
         
         image = self.load_image(image)
 
+        start_time = time.time()
         with torch.no_grad():
             itm_output = self.model(image, text, match_head='itm')
+        METRICS.observe_model('blip_itm', time.time() - start_time, len(text))
         # Change from softmax to dotproduct
         itm_score = torch.nn.functional.softmax(itm_output,dim=1)[:,1]
         itm_scores = itm_score.cpu().detach().numpy()
@@ -171,6 +219,7 @@ class BlipItcVlmImplementation(VlmBaseImplementation):
         model.eval()
         self.model = model.to(device=self.device)
         self.model = model.half() if self.half else self.model
+        self.image_feat_cache = ImageFeatureCache()
 
     
     def load_image_url(self, url: str):
@@ -192,39 +241,72 @@ class BlipItcVlmImplementation(VlmBaseImplementation):
 
     def compute_similarity(self, image : Image, text : list[str]):
         image = self.load_image(image)
+        start_time = time.time()
         with torch.no_grad():
             itc_output = self.model(image, text, match_head='itc')
+        METRICS.observe_model('blip_itc', time.time() - start_time, len(text))
         # Check if its dotproduct
         itc_scores = itc_output.cpu().detach().numpy()[0]
         return itc_scores
 
-    @lru_cache()
-    def get_cached_image_feat(self, img_byte_arr):
-        img = img_byte_arr.getvalue()
-        image = Image.open(io.BytesIO(img))
-        image = self.load_image(image)
-        image_embeds = self.model.visual_encoder(image) 
-        image_feat = F.normalize(self.model.vision_proj(image_embeds[:,0,:]),dim=-1)
-
+    def get_cached_image_feat(self, image: Image):
+        """
+        Normalized features of one image, the visual encoder only runs for pixels it hasn't seen recently.
+        """
+        key = ImageFeatureCache.key(image)
+        image_feat = self.image_feat_cache.get(key)
+        if image_feat is None:
+            image_feat = self.compute_image_feats([image])
+            self.image_feat_cache.put(key, image_feat)
         return image_feat
     
     @lru_cache()
     def get_cached_text_feat(self, txt: tuple):
-        txt = list(txt)
-        text = self.model.tokenizer(txt, padding='max_length', truncation=True, max_length=35, 
-                              return_tensors="pt").to(self.device) 
-        text_output = self.model.text_encoder(text.input_ids, attention_mask = text.attention_mask,                      
-                                            return_dict = True, mode = 'text')  
-        text_feat = F.normalize(self.model.text_proj(text_output.last_hidden_state[:,0,:]),dim=-1)                                    
+        return self.compute_text_feats(list(txt))
+
+    def compute_text_feats(self, txt: list[str]):
+        """
+        Normalized text features of several texts, computed in one forward pass.
+        """
+        start_time = time.time()
+        with torch.no_grad():
+            text = self.model.tokenizer(txt, padding='max_length', truncation=True, max_length=35,
+                                        return_tensors="pt").to(self.device)
+            text_output = self.model.text_encoder(text.input_ids, attention_mask = text.attention_mask,
+                                                  return_dict = True, mode = 'text')
+            text_feat = F.normalize(self.model.text_proj(text_output.last_hidden_state[:,0,:]),dim=-1)
+        METRICS.observe_model('blip_itc_text', time.time() - start_time, len(txt))
         return text_feat
 
+    def compute_image_feats(self, images: list):
+        """
+        Normalized image features of several images, computed in one forward pass.
+        """
+        start_time = time.time()
+        with torch.no_grad():
+            image = torch.cat([self.load_image(image) for image in images])
+            image_embeds = self.model.visual_encoder(image)
+            image_feat = F.normalize(self.model.vision_proj(image_embeds[:,0,:]),dim=-1)
+        METRICS.observe_model('blip_itc_image', time.time() - start_time, len(images))
+        return image_feat
+
+    def compute_similarity_from_feats(self, image_feat, text: list[str]):
+        """
+        Returns the similarities of every image of image_feat (from compute_image_feats) to every text,
+        an array of shape (number of images, len(text)).
+        """
+        with torch.no_grad():
+            text_feat = self.get_cached_text_feat(tuple(text))
+            sim = image_feat @ text_feat.t()
+        return sim.cpu().detach().numpy()
+
     def compute_cached_similarity(self, image: Image, text: list[str]):
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG')
+        image_feat = self.get_cached_image_feat(image)
+        start_time = time.time()
         with torch.no_grad():
-            image_feat = self.get_cached_image_feat(img_byte_arr)
             text_feat = self.get_cached_text_feat(tuple(text))
             sim = image_feat @ text_feat.t()
+        METRICS.observe_model('blip_itc_cached', time.time() - start_time, len(text))
         sim = sim.cpu().detach().numpy()[0]
         return sim
 
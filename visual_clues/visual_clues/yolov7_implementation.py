@@ -26,6 +26,7 @@ import requests
 import numpy as np
 from visual_clues.utils.general import scale_coords
 import os.path
+from pipeline_metrics import METRICS
 
 class YoloTrackerModel(): # Inherits from TrackerModel ?
 
@@ -108,15 +109,37 @@ class YoloTrackerModel(): # Inherits from TrackerModel ?
             cv2.rectangle(img, c1, c2, color, -1, cv2.LINE_AA)  # filled
             cv2.putText(img, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
 
+    def forward_batch(self, images):
+        """
+        Input: list of OpenCV (BGR) images, of any sizes
+        Output: the detections of each image, computed in one forward pass
+        """
+        # Without auto padding every image is letterboxed to the same size, so they can be stacked.
+        batch = np.stack([letterbox(image, self.img_size, stride=self.stride, auto=False)[0] for image in images])
+        batch = np.ascontiguousarray(batch[:, :, :, ::-1].transpose(0, 3, 1, 2))  # BGR to RGB, to Nx3x640x640
+        batch = torch.from_numpy(batch).to(self.device)
+        batch = batch.half() if self.half else batch.float()  # uint8 to fp16/32
+        batch /= 255.0  # 0 - 255 to 0.0 - 1.0
+        return self.detect_batch(batch, [image.shape for image in images])
+
     def detect(self, img) -> str:
         """
         Input: processed frame
         Output: concatenated string of: class_name, bounding box, confidence
         """
+        return [output for outputs in self.detect_batch(img, [self.orig_img.shape] * img.shape[0]) for output in outputs]
+
+    def detect_batch(self, img, orig_shapes):
+        """
+        Input: batch of processed frames and the shapes of the original images
+        Output: for each image a list of class_name, bounding box, confidence
+        """
         
         # Predict
+        start_time = time.time()
         with torch.no_grad():
             pred = self.model(img, augment=False)[0]
+        METRICS.observe_model('yolov7', time.time() - start_time, img.shape[0])
 
         # Apply NMS
         pred = non_max_suppression(pred)
@@ -128,15 +151,17 @@ class YoloTrackerModel(): # Inherits from TrackerModel ?
 
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], self.orig_img.shape).round()
+                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], orig_shapes[i]).round()
 
+            image_outputs = []
             for *xyxy, conf, cls in reversed(det):
                 class_name = self.names[int(cls)]
                 bbox = str(torch.tensor(xyxy).view(1, 4).view(-1).tolist())
                 confidence = str(conf.tolist())
                 line = ' '.join((class_name, bbox, confidence))
                 print(f"Detected: {line}")
-                outputs.append({'detections_boxes': bbox, 'detection_scores': confidence, 'detection_classes': class_name})
+                image_outputs.append({'detections_boxes': bbox, 'detection_scores': confidence, 'detection_classes': class_name})
+            outputs.append(image_outputs)
         
         # PLOT BBOXES ON IMAGE - SANITY TEST - TO DELETE LATER
         # label = f'{self.names[int(cls)]} {conf:.2f}'
@@ -0,0 +1,146 @@
+import contextlib
+import gc
+import os
+import queue
+import multiprocessing
+import requests
+import torch
+from const_vars import JOB_POLL_MIN_INTERVAL, JOB_POLL_MAX_INTERVAL
+
+def close_http_sessions():
+    """
+    Closes the pooled connections of every requests.Session in this process.
+    Forked workers would otherwise share the parent's open sockets to Arango.
+    Closed sessions stay usable, they reconnect on the next request.
+    """
+    for obj in gc.get_objects():
+        if isinstance(obj, requests.Session):
+            obj.close()
+
+def limit_supervisor_threads():
+    """
+    The supervisor only loads the models, it never runs them. With a single intra-op thread
+    reading the checkpoints doesn't start torch's thread pools, which don't survive a fork.
+    """
+    torch.set_num_threads(1)
+
+
+class WorkerPool:
+    """
+    Supervisor that forks worker processes after the models were loaded and before any of them ran,
+    so all the workers share the read-only weights copy-on-write. Each worker warms its models up itself.
+    The supervisor claims the jobs and shards them to the worker with the fewest jobs in flight.
+
+    worker_main(worker_idx, job_pipe, done_queue) runs in each worker. It puts (worker_idx, None) on done_queue
+    once it's ready, then reads leased job documents from job_pipe until it gets None,
+    and puts (worker_idx, pipeline_id) on done_queue for every finished job.
+    """
+    def __init__(self, worker_main, num_workers, max_in_flight=1, fork_guard=None):
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            raise RuntimeError("Worker pool mode needs CPU models, CUDA can't be used after fork.")
+        self.worker_main = worker_main
+        self.num_workers = num_workers
+        self.max_in_flight = max_in_flight
+        self.context = multiprocessing.get_context("fork")
+        self.done_queue = self.context.Queue()
+        self.job_pipes = [None] * num_workers
+        self.processes = [None] * num_workers
+        self.in_flight = [0] * num_workers
+        self.ready = [False] * num_workers
+        # Context manager around every fork, e.g. pausing the threads that may hold a lock at that moment.
+        self.fork_guard = fork_guard or contextlib.nullcontext
+
+    def start(self):
+        close_http_sessions()
+        # Keep the loaded models out of the garbage collector, a collection in a worker
+        # would otherwise touch (and copy) every page that holds a Python object.
+        gc.freeze()
+        for worker_idx in range(self.num_workers):
+            self._spawn(worker_idx)
+        print("Started {} pipeline worker processes.".format(self.num_workers))
+
+    def _spawn(self, worker_idx):
+        self.job_pipes[worker_idx] = self.context.Queue()
+        # Not daemonic, so the experts may start processes of their own, stop() joins the workers.
+        process = self.context.Process(target=self._run_worker, args=(worker_idx,),
+                                        name="pipeline-worker-{}".format(worker_idx))
+        with self.fork_guard():
+            process.start()
+        self.processes[worker_idx] = process
+        self.in_flight[worker_idx] = 0
+        self.ready[worker_idx] = False
+
+    def _run_worker(self, worker_idx):
+        # Split the cores between the workers instead of every worker using all of them.
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.num_workers))
+        self.worker_main(worker_idx, self.job_pipes[worker_idx], self.done_queue)
+
+    def _handle_done(self, worker_idx, pipeline_id):
+        if pipeline_id is None:
+            self.ready[worker_idx] = True
+            print("Pipeline worker process {} is ready.".format(worker_idx))
+        else:
+            self.in_flight[worker_idx] = max(0, self.in_flight[worker_idx] - 1)
+
+    def _collect_done(self):
+        while True:
+            try:
+                worker_idx, pipeline_id = self.done_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._handle_done(worker_idx, pipeline_id)
+
+    def wait_ready(self, on_wait=None):
+        """
+        Blocks until every worker finished its warm-up, calling on_wait about every second.
+        """
+        while not all(self.ready):
+            if on_wait:
+                on_wait()
+            self._respawn_dead_workers()
+            try:
+                self._handle_done(*self.done_queue.get(timeout=1))
+            except queue.Empty:
+                pass
+
+    def _respawn_dead_workers(self):
+        for worker_idx, process in enumerate(self.processes):
+            if not process.is_alive():
+                # Its leased jobs become visible again once their lease expires.
+                print("Worker {} exited with code {}, restarting it.".format(worker_idx, process.exitcode))
+                self._spawn(worker_idx)
+
+    def least_loaded_worker(self):
+        # A restarted worker gets jobs only once it warmed up again.
+        ready_workers = [idx for idx in range(self.num_workers) if self.ready[idx]]
+        if not ready_workers:
+            return None
+        worker_idx = min(ready_workers, key=lambda idx: self.in_flight[idx])
+        if self.in_flight[worker_idx] >= self.max_in_flight:
+            return None
+        return worker_idx
+
+    def dispatch_loop(self, job_queue, worker_id, stop_event):
+        """
+        Claims jobs from job_queue and hands each one to the least loaded worker.
+        """
+        interval = JOB_POLL_MIN_INTERVAL
+        while not stop_event.is_set():
+            self._collect_done()
+            self._respawn_dead_workers()
+            worker_idx = self.least_loaded_worker()
+            queue_job = job_queue.try_claim(worker_id) if worker_idx is not None else None
+            if not queue_job:
+                stop_event.wait(interval)
+                interval = min(interval * 2, JOB_POLL_MAX_INTERVAL)
+                continue
+            interval = JOB_POLL_MIN_INTERVAL
+            print("Sending pipeline id: {} to worker {}".format(queue_job['pipeline_id'], worker_idx))
+            self.job_pipes[worker_idx].put(queue_job)
+            self.in_flight[worker_idx] += 1
+
+    def stop(self):
+        for job_pipe in self.job_pipes:
+            job_pipe.put(None)
+        for process in self.processes:
+            process.join()